@@ -2,9 +2,12 @@ from twisted.internet import reactor, protocol
 from twisted.protocols.basic import NetstringReceiver
 import chess
 import queue
-import pickle
 import threading
 import traceback
+import wirecodec
+
+RECONNECT_DELAY = 2
+RECONNECT_ATTEMPTS = 5
 
 
 class ChessModelProtocol(NetstringReceiver):
@@ -12,6 +15,7 @@ class ChessModelProtocol(NetstringReceiver):
         print("Connected to the server.")
         self.factory = self.factory  # This will be set by Twisted automatically
         self.factory.client_connection = self
+        self.sendString(wirecodec.encode({"type": "hello", "codecs": [wirecodec.CODEC_NAME]}))
         self.factory.on_connection()
 
     def connectionLost(self, reason):
@@ -20,14 +24,19 @@ class ChessModelProtocol(NetstringReceiver):
 
     def stringReceived(self, data):
         try:
-            message = pickle.loads(data)
+            message = wirecodec.decode(data)
+            if message["type"] == "hello":
+                return
+            if message["type"] == "ping":
+                self.send_to_server({"type": "pong"})
+                return
             self.factory.handle_server_message(message)
         except Exception as e:
             print(f"Error processing server message: {e}")
 
     def send_to_server(self, message):
         try:
-            serialized_message = pickle.dumps(message)
+            serialized_message = wirecodec.encode(message)
             self.sendString(serialized_message)
         except Exception as e:
             print(f"Error sending message to server: {e}")
@@ -39,6 +48,7 @@ class ChessModelFactory(protocol.ClientFactory):
     def __init__(self, model):
         self.model = model
         self.client_connection = None
+        self.reconnects = 0
 
     def on_connection(self):
         self.model.on_connection()
@@ -46,14 +56,24 @@ class ChessModelFactory(protocol.ClientFactory):
     def handle_server_message(self, message):
         self.model.on_server_message(message)
 
+    def reconnect(self, connector):
+        """Retry while logged in; the server keeps the session for a short grace period."""
+        if self.model.token is None or self.reconnects >= RECONNECT_ATTEMPTS:
+            return False
+        self.reconnects += 1
+        reactor.callLater(RECONNECT_DELAY, connector.connect)
+        return True
+
     def clientConnectionFailed(self, connector, reason):
         print(f"Connection failed: {reason}")
-        self.model.stop()
+        if not self.reconnect(connector):
+            self.model.stop()
 
     def clientConnectionLost(self, connector, reason):
         print(f"Connection lost: {reason}")
-        traceback.print_exc()
-        self.model.stop()
+        if not self.reconnect(connector):
+            traceback.print_exc()
+            self.model.stop()
 
 
 class ChessModel:
@@ -97,9 +117,16 @@ class ChessModel:
 
     def on_connection(self):
         print("Connection established. Ready to communicate.")
+        if self.token:
+            self.send_to_server({"type": "resume", "username": self.username})
 
     def on_server_message(self, message):
         print(f"Received message from server: {message}")
+        if message["type"] == "resume_success":
+            self.factory.reconnects = 0
+        elif message["type"] == "resume_failed":
+            self.token = None
+            self.game_id = None
         self.response_queue.put(message)
 
     def get_response(self):
@@ -129,6 +156,28 @@ class ChessModel:
     def find_game(self):
         self.send_to_server({"type": "find_game", "username": self.username})
 
+    def claim_draw(self):
+        self.send_to_server({"type": "claim_draw", "username": self.username, "game_id": self.game_id})
+
+    def request_rank(self):
+        self.send_to_server({"type": "rank", "username": self.username})
+
+    def request_leaderboard(self, start=0, count=10):
+        self.send_to_server({"type": "leaderboard", "username": self.username, "start": start, "count": count})
+
+    def request_history(self, before=None, result=None, color=None):
+        message = {"type": "game_history", "username": self.username}
+        for key, value in (("before", before), ("result", result), ("color", color)):
+            if value is not None:
+                message[key] = value
+        self.send_to_server(message)
+
+    def export_pgn(self, after=None):
+        message = {"type": "export_pgn", "username": self.username}
+        if after is not None:
+            message["after"] = after
+        self.send_to_server(message)
+
     def send_move_to_server(self, move):
         if self.token and self.game_id:
             self.send_to_server({
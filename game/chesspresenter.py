@@ -10,6 +10,8 @@ class ChessPresenter:
         self.username = ""
         self.password = ""
         self.elo = ""
+        self.rank = None
+        self.players = None
         self.input_active = "username"
         self.error_message = None
         self.selected_square = None
@@ -38,7 +40,7 @@ class ChessPresenter:
             self.model.game_id = None
             self.state = "mainmenu"
         
-        if message["type"] == "game_start":
+        if message["type"] in ("game_start", "game_resume"):
             self.model.color = message["color"]
             self.model.game_id = message["game_id"]
             self.model.board = chess.Board(message["board"])
@@ -54,19 +56,37 @@ class ChessPresenter:
             self.model.token = message["token"]
             self.state = "mainmenu"
             self.elo = message["elo"]
+            self.model.request_rank()
             
+        elif message["type"] == "rank":
+            self.rank = message["rank"]
+            self.players = message["players"]
+
+        elif message["type"] == "resume_success":
+            # A game_resume follows for every game still in progress.
+            self.elo = message["elo"]
+            self.model.request_rank()
+            self.state = "mainmenu"
+
+        elif message["type"] == "resume_failed":
+            self.error_message = "Session expired, please log in again."
+            self.state = "login"
+
         elif message["type"] == "register_success":
             self.error_message = "Registration successful! Please log in."
             
         elif message["type"] == "game_end":
             if "winner" in message:
+                on_time = " on time" if message.get("reason") == "timeout" else ""
                 if message["winner"] == self.model.color:
-                    self.view.draw_message_screen("You have won!")
+                    self.view.draw_message_screen("You have won" + on_time + "!")
                 elif message["winner"] == "draw":
                     self.view.draw_message_screen("Game has ended in a draw")
                 else:
-                    self.view.draw_message_screen("You have lost")
-                self.elo = message["elo"]
+                    self.view.draw_message_screen("You have lost" + on_time)
+                # An unrated result comes without a new rating.
+                self.elo = message.get("elo", self.elo)
+                self.model.request_rank()
             else:
                 self.view.draw_message_screen("Unknown error interrupted your game.") 
                 self.state = "mainmenu"
@@ -181,7 +201,9 @@ class ChessPresenter:
         start_button, logout_button = self.view.draw_menu_screen(
                 self.model.username,
                 elo,
-                mouse_pos
+                mouse_pos,
+                self.rank,
+                self.players,
             )
 
         for event in pygame.event.get():
@@ -210,6 +232,10 @@ class ChessPresenter:
             if event.type == pygame.MOUSEBUTTONDOWN:
                 if event.button == 1:
                     self._handle_piece_selection(event.pos)
+
+            # D claims a draw by threefold repetition or the fifty-move rule.
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_d:
+                self.model.claim_draw()
             
         self.view.draw_board(self.model.board, self.legal_moves, self.selected_square)
 
@@ -74,10 +74,12 @@ class ChessView:
         pygame.display.flip()
         return authorize_button, register_button
 
-    def draw_menu_screen(self, username, elo, mouse_pos):
+    def draw_menu_screen(self, username, elo, mouse_pos, rank=None, players=None):
         self.screen.fill((0, 0, 0))
         self.draw_text(f"Welcome, {username}!", (250, 50))
         self.draw_text(f"Elo: {elo}", (250, 150))
+        if rank is not None:
+            self.draw_text(f"Rank: #{rank} of {players}", (250, 200))
         start_button_pos = pygame.Rect(250,300,300,50)
         logout_button_pos= pygame.Rect(250,400,300,50)
 
@@ -0,0 +1,311 @@
+"""Headless load generator for the chess server.
+
+Spawns virtual players over the same Netstring/chesswire client protocol the
+game uses, without pygame. Each player registers, logs in, queues with
+``find_game`` and plays random legal moves until its games are done, then
+logs out. At the end it prints p50/p95/p99 latency per request type,
+matchmaking wait and throughput, and optionally writes them as JSON:
+
+    python loadtest.py --players 1000 --games 2 --json results.json
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+from collections import defaultdict
+
+import chess
+from twisted.internet import reactor, task
+
+from chessmodel import ChessModelFactory, ChessModelProtocol
+import wirecodec
+
+RETRY_DELAY = 0.25
+
+# The reply that completes each request type.
+REPLIES = {
+    "register": ("register_success", "register_failed"),
+    "login": ("login_success", "login_failed"),
+    "find_game": ("game_start",),
+    "move": ("update",),
+    "claim_draw": ("game_end",),
+}
+FAILURES = {"register_failed", "login_failed", "error"}
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.events = defaultdict(int)
+        self.matchmaking = []
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, message_type, seconds):
+        self.latencies[message_type].append(seconds)
+
+    def summary(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        requests = {}
+        for message_type in sorted(set(self.latencies) | set(self.errors)):
+            ordered = sorted(self.latencies[message_type])
+            requests[message_type] = {
+                "count": len(ordered),
+                "errors": self.errors[message_type],
+                **{f"p{p}_ms": _ms(percentile(ordered, p)) for p in (50, 95, 99)},
+                "max_ms": _ms(ordered[-1] if ordered else None),
+            }
+        ordered = sorted(self.matchmaking)
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "requests": requests,
+            "matchmaking": {"count": len(ordered), **{f"p{p}_ms": _ms(percentile(ordered, p)) for p in (50, 95, 99)}},
+            "throughput": {
+                "requests_per_s": round(sum(len(v) for v in self.latencies.values()) / elapsed, 1),
+                "moves_per_s": round(len(self.latencies["move"]) / elapsed, 1),
+                "games_finished": self.events["game_end"] // 2,
+            },
+            "events": dict(self.events),
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class LoadProtocol(ChessModelProtocol):
+    """ChessModelProtocol without the per-connection console output."""
+
+    def connectionMade(self):
+        self.factory.client_connection = self
+        self.sendString(wirecodec.encode({"type": "hello", "codecs": [wirecodec.CODEC_NAME]}))
+        self.factory.on_connection()
+
+    def connectionLost(self, reason):
+        self.factory.client_connection = None
+
+
+class LoadFactory(ChessModelFactory):
+    protocol = LoadProtocol
+
+    def clientConnectionFailed(self, connector, reason):
+        self.model.failed(reason)
+
+    def clientConnectionLost(self, connector, reason):
+        self.model.failed(reason)
+
+
+class VirtualPlayer:
+    """One simulated player driving the server through a full session."""
+
+    def __init__(self, harness, username, games, think_time):
+        self.harness = harness
+        self.stats = harness.stats
+        self.username = username
+        self.games_left = games
+        self.think_time = think_time
+        self.factory = LoadFactory(self)
+        self.token = None
+        self.board = None
+        self.color = None
+        self.game_id = None
+        self.pending = None
+        self.done = False
+
+    def start(self, host, port):
+        reactor.connectTCP(host, port, self.factory)
+
+    def send(self, message):
+        if self.token:
+            message["username"] = self.username
+            message["token"] = self.token
+        self.pending = (message["type"], time.perf_counter())
+        self.factory.client_connection.send_to_server(message)
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        conn = self.factory.client_connection
+        if conn is not None:
+            if self.token:
+                conn.send_to_server({"type": "logout", "username": self.username, "token": self.token})
+            conn.transport.loseConnection()
+        self.harness.player_done()
+
+    def failed(self, reason):
+        if not self.done:
+            self.stats.events["connection_lost"] += 1
+            self.finish()
+
+    def on_connection(self):
+        self.send({"type": "register", "username": self.username, "password": self.username})
+
+    def on_server_message(self, message):
+        message_type = message["type"]
+        if self.pending is not None:
+            request, sent = self.pending
+            if message_type in REPLIES[request] or message_type in FAILURES:
+                self.pending = None
+                if message_type in FAILURES:
+                    self.stats.errors[request] += 1
+                else:
+                    self.stats.record(request, time.perf_counter() - sent)
+                if request == "find_game" and message_type == "game_start":
+                    self.stats.matchmaking.append(time.perf_counter() - sent)
+        handler = getattr(self, f"on_{message_type}", None)
+        if handler is not None:
+            handler(message)
+
+    def on_register_success(self, message):
+        self.send({"type": "login", "username": self.username, "password": self.username})
+
+    def on_register_failed(self, message):
+        self.finish()
+
+    def on_login_success(self, message):
+        self.token = message["token"]
+        self.queue()
+
+    def on_login_failed(self, message):
+        self.finish()
+
+    def on_error(self, message):
+        self.stats.events[f"error: {message.get('reason')}"] += 1
+        if message.get("reason") == "Rate limit exceeded" and self.board is not None:
+            # The rejected move was never played; try again shortly.
+            reactor.callLater(RETRY_DELAY, self.maybe_move)
+
+    def queue(self):
+        if self.games_left <= 0:
+            self.finish()
+            return
+        self.games_left -= 1
+        self.board = None
+        self.send({"type": "find_game"})
+
+    def on_game_start(self, message):
+        self.stats.events["game_start"] += 1
+        self.board = chess.Board(message["board"])
+        self.color = chess.WHITE if message["color"] == "white" else chess.BLACK
+        self.game_id = message["game_id"]
+        self.maybe_move()
+
+    def on_update(self, message):
+        if self.board is None:
+            return
+        self.board.push_uci(message["move"])
+        self.maybe_move()
+
+    def maybe_move(self):
+        if self.board.turn != self.color or self.board.is_game_over():
+            return
+        if self.think_time:
+            reactor.callLater(random.uniform(0, 2 * self.think_time), self.play_move, self.board.ply())
+        else:
+            self.play_move(self.board.ply())
+
+    def play_move(self, ply):
+        if self.done or self.board is None or self.board.ply() != ply:
+            return
+        if self.board.halfmove_clock >= 100 or self.board.is_repetition(3):
+            # The server only ends these draws when a player claims them.
+            self.send({"type": "claim_draw", "game_id": self.game_id})
+            return
+        move = random.choice(list(self.board.legal_moves))
+        self.send({"type": "move", "game_id": self.game_id, "move": move.uci()})
+
+    def on_game_end(self, message):
+        self.stats.events["game_end"] += 1
+        self.queue()
+
+    def on_opponent_disconnected(self, message):
+        self.stats.events["opponent_disconnected"] += 1
+        self.pending = None
+        self.queue()
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.active = 0
+        self.players = []
+        run = uuid.uuid4().hex[:6]
+        self.usernames = (f"load{run}_{i}" for i in range(args.players))
+
+    def launch(self):
+        """Connect players at ``--rate`` per second until all are started."""
+        for _ in range(max(1, int(self.args.rate / 10))):
+            username = next(self.usernames, None)
+            if username is None:
+                self.launcher.stop()
+                return
+            player = VirtualPlayer(self, username, self.args.games, self.args.think_time)
+            self.players.append(player)
+            self.active += 1
+            player.start(self.args.host, self.args.port)
+
+    def player_done(self):
+        self.active -= 1
+        if self.active == 0 and not self.launcher.running:
+            self.stop()
+
+    def stop(self):
+        if self.stats.finished is None:
+            self.stats.finished = time.perf_counter()
+            reactor.stop()
+
+    def run(self):
+        self.launcher = task.LoopingCall(self.launch)
+        self.launcher.start(0.1)
+        if self.args.duration:
+            reactor.callLater(self.args.duration, self.stop)
+        reactor.run()
+        return self.stats.summary()
+
+
+def print_report(summary):
+    print(f"{'request':<12} {'count':>8} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, row in summary["requests"].items():
+        print(f"{name:<12} {row['count']:>8} {row['errors']:>7} " + " ".join(
+            f"{row[key] if row[key] is not None else '-':>9}" for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms")
+        ))
+    mm = summary["matchmaking"]
+    print(f"matchmaking wait: p50 {mm['p50_ms']} ms, p95 {mm['p95_ms']} ms, p99 {mm['p99_ms']} ms over {mm['count']} games")
+    tp = summary["throughput"]
+    print(f"{summary['elapsed_s']} s: {tp['requests_per_s']} requests/s, {tp['moves_per_s']} moves/s, "
+          f"{tp['games_finished']} games finished")
+    for event, count in sorted(summary["events"].items()):
+        print(f"  {event}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many players against a chess server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=65432)
+    parser.add_argument("-n", "--players", type=int, default=100, help="number of virtual players")
+    parser.add_argument("-g", "--games", type=int, default=1, help="games each player plays")
+    parser.add_argument("--rate", type=float, default=200, help="new connections per second")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean seconds before each move")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    summary = Harness(args).run()
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""Benchmarks for the server hot paths and the storage backends.
+
+    python bench_server.py -o results.json
+    python bench_server.py -o new.json --baseline results.json --threshold 0.15
+
+Every benchmark reports microseconds per operation. Storage benchmarks run
+each backend against synthetic datasets of ``--sizes`` users and games,
+seeded through the backend's own API. With ``--baseline`` the run is
+compared against an earlier results file and exits with status 1 when any
+benchmark got slower by more than the threshold.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import chess
+
+import wirecodec
+from bench_wirecodec import CODECS, MESSAGES
+
+SIZES = (1000, 10000, 100000)
+BACKENDS = ("json", "sqlite")
+# Calls per storage benchmark; scans of the whole dataset get fewer.
+STORAGE_CALLS = 500
+SCAN_CALLS = 3
+# Timing runs per benchmark; the fastest one is reported.
+REPEAT = 5
+# Plies of the line replayed through handle_move; it ends well before mate.
+OPENING = (
+    "e2e4 e7e5 g1f3 b8c6 f1b5 a7a6 b5a4 g8f6 e1g1 f8e7 f1e1 b7b5 "
+    "a4b3 d7d6 c2c3 e8g8 h2h3 c6a5 b3c2 c7c5 d2d4 d8c7 b1d2 c5d4"
+).split()
+MOVES_PER_SEEDED_GAME = 4
+FAKE_HASH = "$2b$12$" + "x" * 53
+
+
+class Results:
+    def __init__(self):
+        self.results = {}
+
+    def add(self, name, seconds, number):
+        us = seconds / number * 1e6
+        self.results[name] = {"us_per_op": round(us, 3), "ops": number}
+        print(f"{name:<52} {us:>12.2f} us/op")
+
+    def measure(self, name, func, number):
+        """Time a synchronous call, best of REPEAT runs."""
+        seconds = min(timeit.repeat(func, number=number, repeat=REPEAT))
+        self.add(name, seconds, number)
+
+    async def measure_async(self, name, make_call, number, repeat=REPEAT):
+        """Time runs of ``number`` awaited calls, best of ``repeat``.
+
+        ``make_call(i)`` returns the i-th awaitable; ``i`` keeps counting
+        across runs, so writes never repeat their arguments.
+        """
+        best = None
+        for run in range(repeat):
+            start = time.perf_counter()
+            for i in range(run * number, (run + 1) * number):
+                await make_call(i)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        self.add(name, best, number)
+
+
+def bench_codecs(results, number):
+    # What send_message encodes and stringReceived decodes for every frame.
+    for name, message in MESSAGES.items():
+        for codec, (encode, decode) in CODECS.items():
+            results.measure(f"codec/{codec}/{name}", lambda: decode(encode(message)), number)
+
+
+def bench_ratings(results, number):
+    import ratings
+
+    white = {"rating": 1520.0, "rd": 80.0, "volatility": 0.06}
+    black = {"rating": 1480.0, "rd": 120.0, "volatility": 0.06}
+    for winner in ("white", "draw"):
+        results.measure(f"ratings/game_deltas/{winner}", lambda: ratings.game_deltas(white, black, winner), number)
+
+
+def bench_matchmaker(results, number):
+    from twisted.internet.task import Clock
+
+    from matchmaker import Matchmaker
+
+    for waiting in (100, 1000):
+        matchmaker = Matchmaker(clock=Clock())
+        # Spaced wider than the initial rating range, so nobody pairs up on their own.
+        for i in range(waiting):
+            matchmaker.enqueue(f"waiting{i}", f"w{i}", 1000 + i * 101)
+
+        counter = itertools.count()
+
+        def match():
+            i = next(counter)
+            slot = i % waiting
+            opponent = matchmaker.enqueue(f"player{i}", f"p{i}", 1010 + slot * 101)
+            # The waiting player got paired; put it back for the next round.
+            matchmaker.enqueue(f"waiting{slot}", f"w{slot}", 1000 + slot * 101)
+            return opponent
+
+        results.measure(f"matchmaker/find_match/{waiting}_waiting", match, number)
+        results.measure(f"matchmaker/tick/{waiting}_waiting", matchmaker.tick, max(1, number // waiting))
+
+
+async def bench_protocol(results, games):
+    from twisted.internet import reactor
+    from twisted.internet.testing import StringTransport
+
+    import twistedserver
+    from gameregistry import GameClock, LiveGame
+    from ratelimit import RateLimiter
+
+    def connect(username, codec):
+        protocol = twistedserver.ChessFactory().buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        protocol.codec = codec
+        # Replaying a game back to back is far above any per-connection limit.
+        protocol.limiter = RateLimiter(limits={})
+        session = twistedserver.sessions.create(username, protocol)
+        return protocol, session
+
+    for codec, encode in ((wirecodec.CODEC_NAME, wirecodec.encode), (None, CODECS["pickle"][0])):
+        label = "chesswire" if codec else "pickle"
+        white, white_session = connect(f"bench_white_{label}", codec)
+        black, black_session = connect(f"bench_black_{label}", codec)
+        players = ((white, white_session), (black, black_session))
+        timings = []
+        for _ in range(games):
+            game_id = await twistedserver.chdata.create_game(
+                white_session.username, white_session.session_id,
+                black_session.username, black_session.session_id, chess.Board().fen(),
+            )
+            clock = None
+            if twistedserver.time_control is not None:
+                clock = GameClock(*twistedserver.time_control, reactor.seconds())
+            game = LiveGame(
+                game_id, chess.Board(),
+                white_session.username, white_session.session_id, white,
+                black_session.username, black_session.session_id, black,
+                clock=clock,
+            )
+            twistedserver.live_games.add(game)
+            frames = [
+                (players[ply % 2][0], encode({
+                    "type": "move", "username": players[ply % 2][1].username, "token": players[ply % 2][1].token,
+                    "game_id": game_id, "move": move,
+                }))
+                for ply, move in enumerate(OPENING)
+            ]
+            start = time.perf_counter()
+            for protocol, frame in frames:
+                protocol.stringReceived(frame)
+            timings.append(time.perf_counter() - start)
+            # Waits for the moves still being stored, outside the timing.
+            await twistedserver.chdata.find_game(game_id)
+            twistedserver.live_games.remove(game_id)
+            if game.timer is not None:
+                twistedserver.clocks.cancel(game.timer)
+            for protocol, _ in players:
+                protocol.transport.clear()
+        # The median game, so a single stall in the storage writer does not skew it.
+        results.add(f"protocol/handle_move/{label}", sorted(timings)[len(timings) // 2], len(OPENING))
+    twistedserver.clocks.stop()
+    twistedserver.hasher.close()
+    twistedserver.chdata.close()
+
+
+async def seed(chdata, size, rng):
+    """``size`` users and ``size`` finished games between random pairs of them.
+
+    Games go in before their players: the JSON backend rewrites users.json
+    after every finished game, which with 100k users already present would
+    make seeding quadratic.
+    """
+    board = chess.Board()
+    start = board.fen()
+    line = []
+    for move in OPENING[:MOVES_PER_SEEDED_GAME]:
+        board.push_uci(move)
+        line.append((move, board.fen()))
+    for _ in range(size):
+        white, black = rng.sample(range(size), 2)
+        game_id = await chdata.create_game(f"user{white}", "", f"user{black}", "", start)
+        for ply, (move, fen) in enumerate(line):
+            await chdata.append_move(game_id, ply, move, fen)
+        await chdata.finish_game(game_id, rng.choice(("white", "black", "draw")), {})
+    for i in range(size):
+        await chdata.add_user(f"user{i}", FAKE_HASH, rng.randint(800, 2400))
+
+
+async def bench_storage(results, backend, size, base_path, calls):
+    from chessdatabase import create_database
+
+    rng = random.Random(size)
+    chdata = create_database(backend, base_path)
+    try:
+        start = time.perf_counter()
+        await seed(chdata, size, rng)
+        print(f"-- {backend}: seeded {size} users and games in {time.perf_counter() - start:.1f}s")
+        prefix = f"storage/{backend}/{size}"
+
+        def user(i):
+            return f"user{rng.randrange(size)}"
+
+        async def drain(iterator):
+            async for _ in iterator:
+                pass
+
+        scans = SCAN_CALLS
+        measure = results.measure_async
+        # Reads against the seeded data.
+        await measure(f"{prefix}/find_user", lambda i: chdata.find_user(user(i)), calls)
+        await measure(f"{prefix}/get_elo", lambda i: chdata.get_elo(user(i)), calls)
+        await measure(f"{prefix}/get_rating", lambda i: chdata.get_rating(user(i)), calls)
+        await measure(f"{prefix}/get_ratings", lambda i: chdata.get_ratings(), scans)
+        await measure(f"{prefix}/find_game", lambda i: chdata.find_game(str(rng.randint(1, size))), calls)
+        await measure(f"{prefix}/get_games_involving", lambda i: chdata.get_games_involving(user(i)), calls)
+        await measure(f"{prefix}/get_game_history", lambda i: chdata.get_game_history(user(i)), calls)
+        await measure(f"{prefix}/iter_games", lambda i: drain(chdata.iter_games(user(i))), calls)
+        await measure(f"{prefix}/get_completed_games", lambda i: chdata.get_completed_games(), scans)
+
+        # Sessions and the persisted queue.
+        await measure(f"{prefix}/add_session", lambda i: chdata.add_session(f"user{i % size}", f"session{i}"), calls)
+        await measure(f"{prefix}/find_user_by_session", lambda i: chdata.find_user_by_session(f"session{i}"), calls)
+        await measure(f"{prefix}/find_session", lambda i: chdata.find_session(f"user{i % size}"), calls)
+        await measure(f"{prefix}/delete_session", lambda i: chdata.delete_session(f"session{i}"), calls)
+        await measure(f"{prefix}/add_to_queue", lambda i: chdata.add_to_queue(f"user{i % size}", f"session{i}", 1200), calls)
+        await measure(f"{prefix}/get_queue", lambda i: chdata.get_queue(), calls)
+        queue = await chdata.get_queue()
+        await measure(f"{prefix}/restore_queue", lambda i: chdata.restore_queue(queue), calls)
+        await measure(f"{prefix}/get_oldest_in_queue", lambda i: chdata.get_oldest_in_queue(), calls)
+        await measure(f"{prefix}/clear_queue", lambda i: chdata.clear_queue(f"user{i % size}"), calls)
+
+        # Writes: new users, ratings and a fresh batch of games.
+        await measure(f"{prefix}/add_user", lambda i: chdata.add_user(f"new{i}", FAKE_HASH), calls)
+        await measure(f"{prefix}/update_elo", lambda i: chdata.update_elo(user(i), 1500), calls)
+        batch = {f"user{i}": {"rating": 1500.0, "rd": 200.0, "volatility": 0.06} for i in range(min(100, size))}
+        await measure(f"{prefix}/set_ratings/100", lambda i: chdata.set_ratings(batch), scans)
+        fen = chess.Board().fen()
+        game_ids = []
+
+        async def create(i):
+            game_ids.append(await chdata.create_game(user(i), "", user(i), "", fen))
+
+        await measure(f"{prefix}/create_game", create, calls)
+        await measure(f"{prefix}/update_game", lambda i: chdata.update_game(game_ids[i], fen), calls)
+        await measure(f"{prefix}/append_move", lambda i: chdata.append_move(game_ids[i], 0, "e2e4", fen), calls)
+        half = calls // 2
+        deltas = {"user0": {"rating": 4}, "user1": {"rating": -4}}
+        await measure(f"{prefix}/finish_game", lambda i: chdata.finish_game(game_ids[i], "white", deltas), half)
+        finished = half * REPEAT
+        await measure(f"{prefix}/end_game", lambda i: chdata.end_game(game_ids[finished + i], "draw"), calls - half)
+        await measure(f"{prefix}/remove_game", lambda i: chdata.remove_game(game_ids[i]), calls)
+        await measure(f"{prefix}/delete_local_databases", lambda i: chdata.delete_local_databases(), 1, repeat=1)
+    finally:
+        chdata.close()
+
+
+def compare(results, baseline, threshold):
+    """Print the change against ``baseline``; returns the names that regressed."""
+    regressions = []
+    print(f"\n{'benchmark':<52} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = result["us_per_op"] / before["us_per_op"] - 1 if before["us_per_op"] else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<52} {before['us_per_op']:>10.2f} {result['us_per_op']:>10.2f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark server hot paths and storage backends.")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown before failing, 0.2 = 20%%")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="comma separated dataset sizes")
+    parser.add_argument("--backends", default=",".join(BACKENDS), help="comma separated storage backends")
+    parser.add_argument("--only", help="run only benchmarks whose group starts with this, e.g. storage")
+    parser.add_argument("-n", "--number", type=int, default=5000, help="calls per timing run of in-memory benchmarks")
+    parser.add_argument("--games", type=int, default=50, help="games replayed through handle_move")
+    parser.add_argument("--calls", type=int, default=STORAGE_CALLS, help="calls per storage benchmark")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chess-bench-")
+    # Read by config when twistedserver is imported for the protocol benchmarks.
+    os.environ["CHESS_DB_PATH"] = os.path.join(workdir, "server")
+    os.environ["CHESS_LOG_FILE"] = os.path.join(workdir, "server.log")
+
+    from twisted.internet import task
+    from twisted.internet.defer import ensureDeferred
+
+    results = Results()
+
+    def wanted(group):
+        return args.only is None or group.startswith(args.only)
+
+    async def run(reactor):
+        try:
+            if wanted("codec"):
+                bench_codecs(results, args.number)
+            if wanted("ratings"):
+                bench_ratings(results, args.number)
+            if wanted("matchmaker"):
+                bench_matchmaker(results, args.number)
+            if wanted("protocol"):
+                await bench_protocol(results, args.games)
+            if wanted("storage"):
+                for backend in args.backends.split(","):
+                    for size in map(int, args.sizes.split(",")):
+                        path = os.path.join(workdir, f"{backend}-{size}")
+                        await bench_storage(results, backend, size, path, args.calls)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "created_at": time.time(),
+                "results": results.results,
+            }, f, indent=2)
+        print(f"\nWrote {len(results.results)} results to {args.output}")
+
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)["results"]
+            regressions = compare(results.results, baseline, args.threshold)
+            if regressions:
+                print(f"{len(regressions)} benchmarks slower than the baseline by more than {args.threshold:.0%}")
+                sys.exit(1)
+
+    task.react(lambda reactor: ensureDeferred(run(reactor)))
+
+
+if __name__ == "__main__":
+    main()
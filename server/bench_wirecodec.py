@@ -0,0 +1,47 @@
+import argparse
+import pickle
+import timeit
+
+import wirecodec
+
+TOKEN = "3f" * 32
+
+MESSAGES = {
+    "move": {"type": "move", "username": "player1", "token": TOKEN, "game_id": "1042", "move": "e2e4"},
+    "update": {"type": "update", "move": "g7g8q"},
+    "login_success": {"type": "login_success", "username": "player1", "token": TOKEN, "elo": 1234},
+    "game_start": {
+        "type": "game_start", "color": "white", "game_id": "1042",
+        "board": "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+    },
+    "game_end": {"type": "game_end", "winner": "draw", "elo": 1200},
+}
+
+CODECS = {
+    "pickle": (pickle.dumps, pickle.loads),
+    "chesswire": (wirecodec.encode, wirecodec.decode),
+}
+
+
+def measure(func, arg, number):
+    seconds = min(timeit.repeat(lambda: func(arg), number=number, repeat=5))
+    return number / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare chesswire and pickle encode/decode throughput.")
+    parser.add_argument("-n", "--number", type=int, default=20000, help="calls per timing run")
+    args = parser.parse_args()
+
+    print(f"{'message':<14} {'codec':<10} {'bytes':>6} {'encode/s':>12} {'decode/s':>12}")
+    for name, message in MESSAGES.items():
+        for codec, (encode, decode) in CODECS.items():
+            data = encode(message)
+            assert decode(data) == message
+            encode_rate = measure(encode, message, args.number)
+            decode_rate = measure(decode, data, args.number)
+            print(f"{name:<14} {codec:<10} {len(data):>6} {encode_rate:>12,.0f} {decode_rate:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
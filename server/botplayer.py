@@ -0,0 +1,239 @@
+"""The built-in computer opponent.
+
+``EnginePool`` runs ``chessengine.py`` in a few separate processes and hands
+them searches; ``Bots`` gives players a bot opponent when the queue has
+none for them and plays the bot's side of those games.
+"""
+import json
+import os
+import random
+import sys
+import uuid
+from collections import deque
+
+import chess
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import ProcessProtocol
+
+import serverlog
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BOT_USERNAME = "ChessBot"
+# Stored instead of a bcrypt hash, so nobody can log in as the bot.
+BOT_PASSWORD = "!"
+RESTART_DELAY = 1.0
+# With a clock, a move takes at most this share of the bot's remaining time.
+CLOCK_SHARE = 1 / 30
+MIN_BUDGET = 0.05
+
+
+class EngineError(Exception):
+    pass
+
+
+class _EngineProcess(ProcessProtocol):
+    def __init__(self, pool):
+        self.pool = pool
+        self.buffer = b""
+        self.pending = None
+
+    def connectionMade(self):
+        self.pool._ready(self)
+
+    def outReceived(self, data):
+        self.buffer += data
+        while b"\n" in self.buffer:
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            d, self.pending = self.pending, None
+            if d is None:
+                continue
+            reply = json.loads(line)
+            if "error" in reply:
+                d.errback(EngineError(reply["error"]))
+            else:
+                d.callback(reply)
+            self.pool._ready(self)
+
+    def errReceived(self, data):
+        serverlog.warning("engine output", output=data.decode(errors="replace")[-500:])
+
+    def processEnded(self, reason):
+        d, self.pending = self.pending, None
+        if d is not None:
+            d.errback(EngineError(reason.getErrorMessage()))
+        self.pool._ended(self)
+
+
+class EnginePool:
+    """``chessengine.py`` processes that search off the reactor thread.
+
+    Each process runs one search at a time and requests wait in a queue for
+    an idle one. Like the supervisor's workers these are fresh interpreters,
+    not forks of the server. A process that dies is replaced after
+    RESTART_DELAY.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.processes = set()
+        self.idle = deque()
+        self.queue = deque()
+        self.stopping = False
+
+    def start(self):
+        for _ in range(self.workers):
+            self._spawn()
+
+    def _spawn(self):
+        if self.stopping:
+            return
+        process = _EngineProcess(self)
+        self.processes.add(process)
+        reactor.spawnProcess(process, sys.executable, [sys.executable, "chessengine.py"], env=os.environ, path=HERE)
+
+    def search(self, fen, moves, budget):
+        """Deferred firing with the engine's reply for ``moves`` played from ``fen``."""
+        d = Deferred()
+        request = json.dumps({"fen": fen, "moves": moves, "budget": budget}).encode() + b"\n"
+        self.queue.append((request, d))
+        self._dispatch()
+        return d
+
+    def _dispatch(self):
+        while self.idle and self.queue:
+            process = self.idle.popleft()
+            request, process.pending = self.queue.popleft()
+            process.transport.write(request)
+
+    def _ready(self, process):
+        if process in self.processes:
+            self.idle.append(process)
+            self._dispatch()
+
+    def _ended(self, process):
+        self.processes.discard(process)
+        if process in self.idle:
+            self.idle.remove(process)
+        if not self.stopping:
+            serverlog.warning("engine exited, restarting")
+            reactor.callLater(RESTART_DELAY, self._spawn)
+
+    def close(self):
+        self.stopping = True
+        for process in self.processes:
+            # chessengine.py exits when its input ends.
+            process.transport.closeStdin()
+        while self.queue:
+            _, d = self.queue.popleft()
+            d.errback(EngineError("engine pool stopped"))
+
+
+class BotPlayer:
+    """The bot's side of one game, standing in for a player's connection.
+
+    It follows the game from the messages the server sends to players and
+    asks the engine for a move whenever the bot is on move.
+    """
+
+    def __init__(self, bots, session_id):
+        self.bots = bots
+        self.session_id = session_id
+        self.game_id = None
+        self.color = None
+        self.start_fen = None
+        self.board = None
+        self.clock_left = None
+
+    def send_message(self, message):
+        kind = message["type"]
+        if kind == "game_start":
+            self.game_id = message["game_id"]
+            self.color = chess.WHITE if message["color"] == "white" else chess.BLACK
+            self.start_fen = message["board"]
+            self.board = chess.Board(self.start_fen)
+        elif kind == "update" and self.board is not None:
+            self.board.push_uci(message["move"])
+        elif kind in ("game_end", "opponent_disconnected"):
+            self.bots.release(self)
+            return
+        else:
+            if kind == "error":
+                serverlog.warning("bot move rejected", game_id=self.game_id, reason=message.get("reason"))
+            return
+
+        clock = message.get("white_clock" if self.color == chess.WHITE else "black_clock")
+        if clock is not None:
+            self.clock_left = clock / 1000
+        if self.board.turn == self.color and not self.board.is_game_over():
+            self._think()
+
+    def _think(self):
+        budget = self.bots.move_time
+        if self.clock_left is not None:
+            budget = max(MIN_BUDGET, min(budget, self.clock_left * CLOCK_SHARE))
+        ply = self.board.ply()
+        moves = [move.uci() for move in self.board.move_stack]
+        d = self.bots.engine.search(self.start_fen, moves, budget)
+        d.addCallback(lambda reply: reply["move"])
+        d.addErrback(self._fallback, ply)
+        d.addCallback(self._play, ply)
+
+    def _current(self, ply):
+        return self.session_id in self.bots.players and self.board.ply() == ply
+
+    def _fallback(self, failure, ply):
+        serverlog.warning("engine failed", game_id=self.game_id, reason=failure.getErrorMessage())
+        if not self._current(ply):
+            return None
+        # A weak move beats letting the bot's clock run out.
+        return random.choice(list(self.board.legal_moves)).uci()
+
+    def _play(self, move, ply):
+        if move is not None and self._current(ply):
+            self.bots.play(self, move)
+
+
+class Bots:
+    """Bot opponents, at most ``max_games`` of them playing at once.
+
+    ``play(player, move)`` submits a bot's move to its game the way a
+    player's move message would.
+    """
+
+    def __init__(self, engine, max_games, move_time, play):
+        self.engine = engine
+        self.max_games = max_games
+        self.move_time = move_time
+        self.play = play
+        self.players = {}
+        self.enabled = False
+
+    def __len__(self):
+        return len(self.players)
+
+    def __contains__(self, session_id):
+        return session_id in self.players
+
+    def get(self, session_id):
+        return self.players.get(session_id)
+
+    def start(self):
+        self.engine.start()
+        self.enabled = True
+
+    def available(self):
+        return self.enabled and len(self.players) < self.max_games
+
+    def opponent(self):
+        """Reserve a bot for one game, described like a matched queue entry."""
+        player = BotPlayer(self, f"bot-{uuid.uuid4()}")
+        self.players[player.session_id] = player
+        return {"username": BOT_USERNAME, "session_id": player.session_id}
+
+    def release(self, player):
+        self.players.pop(player.session_id, None)
+
+    def close(self):
+        self.enabled = False
+        self.engine.close()
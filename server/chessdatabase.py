@@ -0,0 +1,131 @@
+from abc import ABC, abstractmethod
+
+
+class InvalidCursor(ValueError):
+    """A history cursor that is malformed or no longer names one of the player's games."""
+
+
+class ChessDatabaseInterface(ABC):
+    """Coroutine API every storage backend exposes to the server."""
+
+    @abstractmethod
+    async def add_user(self, username, hashed_password, rating=1200): ...
+
+    @abstractmethod
+    async def find_user(self, username): ...
+
+    @abstractmethod
+    async def get_elo(self, username): ...
+
+    @abstractmethod
+    async def update_elo(self, username, elo): ...
+
+    @abstractmethod
+    async def get_rating(self, username):
+        """Glicko-2 state: {"rating": ..., "rd": ..., "volatility": ...}, or None."""
+
+    @abstractmethod
+    async def get_ratings(self):
+        """Glicko-2 state of every user, keyed by username."""
+
+    @abstractmethod
+    async def set_ratings(self, ratings): ...
+
+    @abstractmethod
+    async def add_session(self, username, session_id): ...
+
+    @abstractmethod
+    async def find_user_by_session(self, session_id): ...
+
+    @abstractmethod
+    async def find_session(self, username): ...
+
+    @abstractmethod
+    async def delete_session(self, session_id): ...
+
+    @abstractmethod
+    async def add_to_queue(self, username, session_id, rating): ...
+
+    @abstractmethod
+    async def get_oldest_in_queue(self): ...
+
+    @abstractmethod
+    async def clear_queue(self, username): ...
+
+    @abstractmethod
+    async def create_game(self, white_username, whitesess, black_username, blacksess, board_fen): ...
+
+    @abstractmethod
+    async def update_game(self, game_id, board_fen): ...
+
+    @abstractmethod
+    async def append_move(self, game_id, ply, move, board_fen): ...
+
+    @abstractmethod
+    async def find_game(self, game_id): ...
+
+    @abstractmethod
+    async def end_game(self, game_id, winner): ...
+
+    @abstractmethod
+    async def finish_game(self, game_id, winner, rating_deltas):
+        """Record the result and apply ``rating_deltas`` at once.
+
+        ``rating_deltas`` maps usernames to {"rating", "rd", "volatility"}
+        deltas. Returns the players' new ratings. Calling it again for a game that
+        is already completed returns the stored ratings without reapplying
+        the deltas; an unknown or aborted game returns None.
+        """
+
+    @abstractmethod
+    async def delete_local_databases(self): ...
+
+    @abstractmethod
+    async def get_games_involving(self, username): ...
+
+    @abstractmethod
+    async def get_game_history(self, username, before=None, limit=20, result=None, color=None):
+        """One page of ``username``'s completed games, newest first.
+
+        Returns ``(games, next_cursor)``. ``games`` are summaries without
+        moves; pass ``next_cursor`` back as ``before`` for the next page, it
+        is None on the last one. ``result`` is "win", "loss" or "draw" from
+        the player's side and ``color`` is "white" or "black". Raises
+        ``InvalidCursor`` if ``before`` is not a game ``username`` played.
+        """
+
+    @abstractmethod
+    def iter_games(self, username=None, since=None, until=None, after=None):
+        """Async iterator over completed games with their moves, oldest first.
+
+        Games are fetched a few at a time, so exporting a whole archive never
+        holds more than a small batch in memory. ``since``/``until`` bound
+        ``finished_at``; ``after`` resumes after that game id.
+        """
+
+    @abstractmethod
+    async def get_completed_games(self):
+        """Every completed game, in the order the games finished."""
+
+    @abstractmethod
+    async def remove_game(self, game_id):
+        """Mark an unfinished game aborted; it stays archived but out of history and exports."""
+
+    @abstractmethod
+    async def get_queue(self): ...
+
+    @abstractmethod
+    async def restore_queue(self, queue): ...
+
+    def close(self):
+        pass
+
+
+def create_database(backend="json", base_path="data"):
+    if backend == "json":
+        from chessdatabase_json import ChessDatabase
+        return ChessDatabase(base_path)
+    if backend == "sqlite":
+        from chessdatabase_sqlite import SQLiteChessDatabase
+        return SQLiteChessDatabase(base_path)
+    raise ValueError(f"Unknown database backend: {backend}")
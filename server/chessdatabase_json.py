@@ -1,165 +1,392 @@
-import asyncio
 import json
+import threading
 import time
 from pathlib import Path
 from typing import Optional
 
-class ChessDatabase:
-    def __init__(self, base_path="data"):
+from twisted.internet.threads import deferToThread
+
+from chessdatabase import ChessDatabaseInterface, InvalidCursor
+from gamearchive import GameArchive
+from movejournal import MoveJournal, replay_into
+from ratings import DEFAULT_RD, DEFAULT_VOLATILITY
+from storagewriter import GroupCommitWriter
+
+FLUSH_DELAY = 1.0
+# Number of journaled moves after which a games snapshot is forced.
+COMPACT_EVERY = 1000
+
+
+def _cursor(game_id):
+    return int(game_id) if isinstance(game_id, str) and game_id.isdigit() else None
+
+
+def _history_matches(username, white, winner, result, color):
+    own = "white" if white == username else "black"
+    if color is not None and own != color:
+        return False
+    if result is None:
+        return True
+    if winner == "draw":
+        return result == "draw"
+    return result == ("win" if winner == own else "loss")
+
+
+class ChessDatabase(ChessDatabaseInterface):
+    """JSON-file store that keeps every record in memory.
+
+    Users are indexed by username and session id, games by game id. Mutations
+    only touch the in-memory records and mark the owning file dirty; the
+    group-commit writer rewrites dirty files atomically at most
+    ``flush_delay`` seconds later, coalescing everything changed in between.
+
+    Moves do not dirty ``games.json``. They are appended to a move journal,
+    and every write of ``games.json`` doubles as a snapshot that lets the
+    journal be compacted.
+
+    ``games.json`` only holds ongoing games. Finished or removed games are
+    moved to the ``GameArchive`` under ``archive/``, so the hot set tracks
+    concurrent games rather than every game ever played.
+    """
+
+    def __init__(self, base_path="data", flush_delay=FLUSH_DELAY, compact_every=COMPACT_EVERY):
         self.base_path = Path(base_path)
         self.base_path.mkdir(parents=True, exist_ok=True)
+        self.flush_delay = flush_delay
+        self.compact_every = compact_every
 
         self.users_file = self.base_path / "users.json"
         self.sessions_file = self.base_path / "sessions.json"
         self.player_queue_file = self.base_path / "player_queue.json"
         self.games_file = self.base_path / "games.json"
+        self.journal_file = self.base_path / "moves.journal"
+        self.archive = GameArchive(self.base_path / "archive")
+
+        # Guards the in-memory records against the writer thread serializing
+        # them while a handler is mutating them. The writer snapshots a whole
+        # group under it, so the journal rotated with games.json is never
+        # discarded before a users.json that includes its finish records.
+        self._data_lock = threading.RLock()
+        self.writer = GroupCommitWriter(window=flush_delay, snapshot_lock=self._data_lock)
 
         self._initialize_file(self.users_file, [])
         self._initialize_file(self.sessions_file, [])
         self._initialize_file(self.player_queue_file, [])
         self._initialize_file(self.games_file, [])
 
+        self.users = {user["username"]: user for user in self._read_file(self.users_file)}
+        self.users_by_session = {
+            user["session_id"]: user for user in self.users.values() if user.get("session_id")
+        }
+        self.games = {game["game_id"]: game for game in self._read_file(self.games_file)}
+        self.queue = self._read_file(self.player_queue_file)
+        self._next_game_id = max(
+            (int(game_id) for game_id in (*self.games, *self.archive.by_id) if game_id.isdigit()), default=0
+        ) + 1
+
+        self.journal = MoveJournal(self.journal_file)
+        replayed = replay_into(self.games, self.journal, self.users)
+        finished = [game_id for game_id, game in self.games.items() if game["status"] != "ongoing"]
+        for game_id in finished:
+            self.archive.add(self.games.pop(game_id))
+        if replayed or finished:
+            self._mark_dirty(self.users_file)
+            self._mark_dirty(self.games_file)
+
     def _initialize_file(self, file_path, default_data):
         if not file_path.exists():
-            file_path.write_text(json.dumps(default_data))
+            self.writer.write_now(file_path, json.dumps(default_data))
 
-    async def _read_file(self, file_path):
-        async with asyncio.Lock():
+    def _read_file(self, file_path):
+        with self.writer.file_lock(file_path):
             return json.loads(file_path.read_text())
 
-    async def _write_file(self, file_path, data):
-        async with asyncio.Lock():
-            file_path.write_text(json.dumps(data, indent=4))
+    def _serialize(self, file_path):
+        with self._data_lock:
+            if file_path == self.users_file:
+                return json.dumps(list(self.users.values()), indent=4)
+            if file_path == self.player_queue_file:
+                return json.dumps(self.queue, indent=4)
+            # The games snapshot and the journal rotation happen under the same
+            # lock, so every journaled move lands in exactly one of them.
+            payload = json.dumps(list(self.games.values()), indent=4)
+            self.journal.rotate()
+            return payload
+
+    def _mark_dirty(self, file_path):
+        if file_path == self.games_file:
+            return self.writer.submit(
+                file_path, lambda: self._serialize(file_path), self.journal.discard_rotated, self.archive.sync
+            )
+        return self.writer.submit(file_path, lambda: self._serialize(file_path))
+
+    def flush(self):
+        self.writer.commit()
+
+    def storage_stats(self):
+        return self.writer.stats.as_dict()
+
+    def close(self):
+        self._mark_dirty(self.games_file)
+        self.writer.close()
+        self.journal.close()
+        self.archive.close()
 
     async def add_user(self, username, hashed_password, rating=1200):
-        users = await self._read_file(self.users_file)
-        if any(user["username"] == username for user in users):
-            return False
-        users.append({"username": username, "password": hashed_password, "session_id": "", "rating": rating})
-        await self._write_file(self.users_file, users)
+        with self._data_lock:
+            if username in self.users:
+                return False
+            self.users[username] = {
+                "username": username, "password": hashed_password, "session_id": "", "rating": rating,
+                "rd": DEFAULT_RD, "volatility": DEFAULT_VOLATILITY,
+            }
+            self._mark_dirty(self.users_file)
         return True
 
-    async def find_user(self, username):
-        users = await self._read_file(self.users_file)
-        return next((user for user in users if user["username"] == username), None)
+    async def find_user(self, username) -> Optional[dict]:
+        user = self.users.get(username)
+        return dict(user) if user else None
 
     async def get_elo(self, username):
-        user = await self.find_user(username)
+        user = self.users.get(username)
         return user["rating"] if user else None
-    
+
+    def _rating_of(self, user):
+        return {
+            "rating": user["rating"],
+            "rd": user.get("rd", DEFAULT_RD),
+            "volatility": user.get("volatility", DEFAULT_VOLATILITY),
+        }
+
+    async def get_rating(self, username):
+        user = self.users.get(username)
+        return self._rating_of(user) if user else None
+
+    async def get_ratings(self):
+        return {username: self._rating_of(user) for username, user in self.users.items()}
+
+    async def set_ratings(self, ratings):
+        with self._data_lock:
+            for username, state in ratings.items():
+                user = self.users.get(username)
+                if user:
+                    user.update(rating=state["rating"], rd=state["rd"], volatility=state["volatility"])
+            self._mark_dirty(self.users_file)
+
     async def update_elo(self, username, elo):
-        users = await self._read_file(self.users_file)
-        for user in users:
-            if user["username"] == username:
+        with self._data_lock:
+            user = self.users.get(username)
+            if user:
                 user["rating"] = elo
-                break
-        await self._write_file(self.users_file, users)
+                self._mark_dirty(self.users_file)
 
     async def add_session(self, username, session_id):
-        users = await self._read_file(self.users_file)
-        for user in users:
-            if user["username"] == username:
-                user["session_id"] = session_id
-                break
-        await self._write_file(self.users_file, users)
-
-    async def find_user_by_session(self, session_id):
-        users = await self._read_file(self.users_file)
-        return next((users for user in users if user["session_id"] == session_id), None)
-    
+        with self._data_lock:
+            user = self.users.get(username)
+            if not user:
+                return
+            if user.get("session_id"):
+                self.users_by_session.pop(user["session_id"], None)
+            user["session_id"] = session_id
+            if session_id:
+                self.users_by_session[session_id] = user
+            self._mark_dirty(self.users_file)
+
+    async def find_user_by_session(self, session_id) -> Optional[dict]:
+        user = self.users_by_session.get(session_id)
+        return dict(user) if user else None
+
     async def find_session(self, username):
-        users = await self._read_file(self.users_file)
-        for user in users:
-            if user["username"] == username:
-                return user["session_id"]
-        else:
-            return None
+        user = self.users.get(username)
+        return user["session_id"] if user else None
 
     async def delete_session(self, session_id):
-        users = await self._read_file(self.sessions_file)
-        for user in users:
-            if "session" in user and user["session"]["session_id"] == session_id:
-                user["session"] = ""
-                break
-        await self._write_file(self.sessions_file, users)
+        with self._data_lock:
+            user = self.users_by_session.pop(session_id, None)
+            if user:
+                user["session_id"] = ""
+                self._mark_dirty(self.users_file)
 
     async def add_to_queue(self, username, session_id, rating):
-        queue = await self._read_file(self.player_queue_file)
-        queue.append({"username": username, "session_id": session_id, "rating": rating, "queueStartTime": time.time()})
-        await self._write_file(self.player_queue_file, queue)
+        with self._data_lock:
+            self.queue.append({"username": username, "session_id": session_id, "rating": rating, "queueStartTime": time.time()})
+            self._mark_dirty(self.player_queue_file)
 
     async def get_oldest_in_queue(self):
-        queue = await self._read_file(self.player_queue_file)
-        if queue:
-            oldest = queue.pop(0)
-            await self._write_file(self.player_queue_file, queue)
-            return oldest
+        with self._data_lock:
+            if self.queue:
+                oldest = self.queue.pop(0)
+                self._mark_dirty(self.player_queue_file)
+                return oldest
         return None
 
     async def clear_queue(self, username):
-        queue = await self._read_file(self.player_queue_file)
-        queue = [player for player in queue if player["username"] != username]
-        await self._write_file(self.player_queue_file, queue)
+        with self._data_lock:
+            self.queue = [player for player in self.queue if player["username"] != username]
+            self._mark_dirty(self.player_queue_file)
 
     async def create_game(self, white_username, whitesess, black_username, blacksess, board_fen):
-        games = await self._read_file(self.games_file)
-        game_id = str(len(games) + 1)
-        games.append({
-            "game_id": game_id,
-            "white": white_username,
-            "whitesess": whitesess,
-            "black": black_username,
-            "blacksess": blacksess,
-            "board_fen": board_fen,
-            "status": "ongoing"
-        })
-        await self._write_file(self.games_file, games)
+        with self._data_lock:
+            game_id = str(self._next_game_id)
+            self._next_game_id += 1
+            self.games[game_id] = {
+                "game_id": game_id,
+                "white": white_username,
+                "whitesess": whitesess,
+                "black": black_username,
+                "blacksess": blacksess,
+                "board_fen": board_fen,
+                "status": "ongoing",
+                "created_at": time.time(),
+                "moves": [],
+            }
+            self._mark_dirty(self.games_file)
         return game_id
 
     async def update_game(self, game_id, board_fen):
-        games = await self._read_file(self.games_file)
-        for game in games:
-            if game["game_id"] == game_id:
+        with self._data_lock:
+            game = self.games.get(game_id)
+            if game:
                 game["board_fen"] = board_fen
-                break
-        await self._write_file(self.games_file, games)
+                self._mark_dirty(self.games_file)
+
+    async def append_move(self, game_id, ply, move, board_fen):
+        with self._data_lock:
+            game = self.games.get(game_id)
+            if not game:
+                return
+            game["board_fen"] = board_fen
+            moves = game.setdefault("moves", [])
+            if len(moves) == ply:
+                moves.append(move)
+            self.journal.append(game_id, ply, move)
+            if self.journal.records >= self.compact_every:
+                self._mark_dirty(self.games_file)
+
+    async def find_game(self, game_id) -> Optional[dict]:
+        game = self.games.get(game_id)
+        if game:
+            return dict(game)
+        return self.archive.get(game_id)
 
-    async def find_game(self, game_id):
-        games = await self._read_file(self.games_file)
-        return next((game for game in games if game["game_id"] == game_id), None)
+    def _archive_game(self, game_id):
+        # The archive is fsynced before the games.json without this game is
+        # written (see _mark_dirty), so a crash in between leaves a copy in
+        # both places, which startup resolves.
+        game = self.games[game_id]
+        self.archive.add(game)
+        del self.games[game_id]
+        self._mark_dirty(self.games_file)
 
     async def end_game(self, game_id, winner):
-        games = await self._read_file(self.games_file)
-        for game in games:
-            if game["game_id"] == game_id:
+        with self._data_lock:
+            game = self.games.get(game_id)
+            if game:
                 game["status"] = "completed"
                 game["winner"] = winner
-                break
-        await self._write_file(self.games_file, games)
+                self._archive_game(game_id)
+
+    async def finish_game(self, game_id, winner, rating_deltas):
+        with self._data_lock:
+            game = self.games.get(game_id)
+            if game is None:
+                archived = self.archive.get(game_id)
+                if archived and archived["status"] == "completed":
+                    return archived.get("ratings", {})
+                return None
+
+            ratings = {}
+            deviations = {}
+            for username, delta in rating_deltas.items():
+                user = self.users.get(username)
+                if user is None:
+                    continue
+                state = self._rating_of(user)
+                ratings[username] = round(state["rating"] + delta["rating"])
+                deviations[username] = {
+                    "rd": state["rd"] + delta.get("rd", 0),
+                    "volatility": state["volatility"] + delta.get("volatility", 0),
+                }
+            finished_at = time.time()
+            # One fsynced journal record makes the result and both ratings
+            # durable together; the files below catch up on the next commit.
+            handle = self.journal.append_finish(game_id, winner, ratings, deviations, finished_at)
+            for username, rating in ratings.items():
+                self.users[username]["rating"] = rating
+                self.users[username].update(deviations[username])
+            game["status"] = "completed"
+            game["winner"] = winner
+            game["ratings"] = ratings
+            game["finished_at"] = finished_at
+            self._mark_dirty(self.users_file)
+            self._archive_game(game_id)
+        await deferToThread(MoveJournal.sync, handle)
+        return ratings
 
     async def delete_local_databases(self):
-        users = await self._read_file(self.sessions_file)
-        for user in users:
-            if "session" in user:
-                user["session"] = ""
-        await self._write_file(self.users_file, users)
-        await self._write_file(self.player_queue_file, [])
-        await self._write_file(self.games_file, [])
-        
+        with self._data_lock:
+            for user in self.users.values():
+                user["session_id"] = ""
+            self.users_by_session.clear()
+            self.queue = []
+            self.games.clear()
+            self.archive.clear()
+            self._mark_dirty(self.users_file)
+            self._mark_dirty(self.player_queue_file)
+            self._mark_dirty(self.games_file)
+
     async def get_games_involving(self, username):
-        games = await self._read_file(self.games_file)
-        return [game for game in games if game["white"] == username or game["black"] == username]
+        ongoing = [dict(game) for game in self.games.values() if game["white"] == username or game["black"] == username]
+        return [*self.archive.games_for(username), *ongoing]
+
+    async def get_game_history(self, username, before=None, limit=20, result=None, color=None):
+        if before is not None:
+            summary = self.archive.summary(before) if _cursor(before) is not None else None
+            if summary is None or username not in summary[:2]:
+                raise InvalidCursor(before)
+        games = []
+        for game_id in self.archive.player_games(username, before=_cursor(before)):
+            white, black, status, winner, finished_at = self.archive.summary(game_id)
+            if status != "completed" or not _history_matches(username, white, winner, result, color):
+                continue
+            if len(games) == limit:
+                return games, games[-1]["game_id"]
+            games.append({"game_id": game_id, "white": white, "black": black, "winner": winner, "finished_at": finished_at})
+        return games, None
+
+    def _next_archived(self, username, last):
+        if username is not None:
+            return next(self.archive.player_games(username, after=last, newest_first=False), None)
+        # Game ids are dense, so walking them needs no snapshot of the index.
+        return str(last + 1) if last + 1 < self._next_game_id else None
+
+    async def iter_games(self, username=None, since=None, until=None, after=None):
+        last = _cursor(after) or 0
+        while (game_id := self._next_archived(username, last)) is not None:
+            last = int(game_id)
+            summary = self.archive.summary(game_id)
+            if summary is None or summary[2] != "completed":
+                continue
+            finished_at = summary[4] or 0
+            if (since is not None and finished_at < since) or (until is not None and finished_at >= until):
+                continue
+            yield self.archive.get(game_id)
+
+    async def get_completed_games(self):
+        games = (self.archive.get(game_id) for game_id in list(self.archive.by_id))
+        return [game for game in games if game and game["status"] == "completed"]
 
     async def remove_game(self, game_id):
-        games = await self._read_file(self.games_file)
-        games = [game for game in games if game["game_id"] != game_id]
-        await self._write_file(self.games_file, games)
-        
+        with self._data_lock:
+            game = self.games.get(game_id)
+            if game:
+                game["status"] = "aborted"
+                self._archive_game(game_id)
+
     async def get_queue(self):
-        return await self._read_file(self.player_queue_file)
-    
+        return [dict(player) for player in self.queue]
+
     async def restore_queue(self, queue):
-        await self._write_file(self.player_queue_file, queue)
-        
-    
-        
\ No newline at end of file
+        with self._data_lock:
+            self.queue = [dict(player) for player in queue]
+            self._mark_dirty(self.player_queue_file)
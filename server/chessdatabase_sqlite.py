@@ -0,0 +1,452 @@
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from chessdatabase import ChessDatabaseInterface, InvalidCursor
+from ratings import DEFAULT_RD, DEFAULT_VOLATILITY
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    session_id TEXT NOT NULL DEFAULT '',
+    rating INTEGER NOT NULL,
+    rd REAL,
+    volatility REAL
+);
+CREATE INDEX IF NOT EXISTS users_session_id ON users(session_id);
+
+CREATE TABLE IF NOT EXISTS games (
+    game_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    white TEXT NOT NULL,
+    whitesess TEXT NOT NULL,
+    black TEXT NOT NULL,
+    blacksess TEXT NOT NULL,
+    board_fen TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'ongoing',
+    winner TEXT,
+    ratings TEXT,
+    finished_at REAL,
+    created_at REAL
+);
+CREATE INDEX IF NOT EXISTS games_white ON games(white);
+CREATE INDEX IF NOT EXISTS games_black ON games(black);
+
+CREATE TABLE IF NOT EXISTS moves (
+    game_id INTEGER NOT NULL,
+    ply INTEGER NOT NULL,
+    move TEXT NOT NULL,
+    PRIMARY KEY (game_id, ply)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS player_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    rating INTEGER NOT NULL,
+    queueStartTime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS player_queue_username ON player_queue(username);
+"""
+
+# Columns added after the first release, created on databases that predate them.
+MIGRATIONS = {
+    "users": [("rd", "REAL"), ("volatility", "REAL")],
+    "games": [("ratings", "TEXT"), ("finished_at", "REAL"), ("created_at", "REAL")],
+}
+
+# Statements are kept as constants so sqlite3's statement cache reuses the
+# prepared form on every call.
+INSERT_USER = "INSERT OR IGNORE INTO users (username, password, session_id, rating) VALUES (?, ?, '', ?)"
+SELECT_USER = "SELECT username, password, session_id, rating FROM users WHERE username = ?"
+SELECT_USER_BY_SESSION = "SELECT username, password, session_id, rating FROM users WHERE session_id = ?"
+SELECT_RATING = "SELECT rating, rd, volatility FROM users WHERE username = ?"
+SELECT_RATINGS = "SELECT username, rating, rd, volatility FROM users"
+UPDATE_RATING = "UPDATE users SET rating = ? WHERE username = ?"
+UPDATE_RATING_STATE = "UPDATE users SET rating = ?, rd = ?, volatility = ? WHERE username = ?"
+UPDATE_SESSION = "UPDATE users SET session_id = ? WHERE username = ?"
+CLEAR_SESSION = "UPDATE users SET session_id = '' WHERE session_id = ?"
+CLEAR_ALL_SESSIONS = "UPDATE users SET session_id = ''"
+
+INSERT_QUEUE = "INSERT INTO player_queue (username, session_id, rating, queueStartTime) VALUES (?, ?, ?, ?)"
+SELECT_QUEUE = "SELECT id, username, session_id, rating, queueStartTime FROM player_queue ORDER BY id"
+SELECT_OLDEST_QUEUE = "SELECT id, username, session_id, rating, queueStartTime FROM player_queue ORDER BY id LIMIT 1"
+DELETE_QUEUE_ID = "DELETE FROM player_queue WHERE id = ?"
+DELETE_QUEUE_USER = "DELETE FROM player_queue WHERE username = ?"
+DELETE_QUEUE = "DELETE FROM player_queue"
+
+GAME_COLUMNS = "game_id, white, whitesess, black, blacksess, board_fen, status, winner, ratings, finished_at, created_at"
+INSERT_GAME = "INSERT INTO games (white, whitesess, black, blacksess, board_fen, created_at) VALUES (?, ?, ?, ?, ?, ?)"
+SELECT_GAME = f"SELECT {GAME_COLUMNS} FROM games WHERE game_id = ?"
+SELECT_GAMES_INVOLVING = (
+    f"SELECT {GAME_COLUMNS} FROM games WHERE white = ? "
+    f"UNION ALL SELECT {GAME_COLUMNS} FROM games WHERE black = ? AND white != ? "
+    "ORDER BY game_id"
+)
+UPDATE_GAME_FEN = "UPDATE games SET board_fen = ? WHERE game_id = ?"
+INSERT_MOVE = "INSERT OR REPLACE INTO moves (game_id, ply, move) VALUES (?, ?, ?)"
+SELECT_GAME_RESULT = "SELECT status, ratings FROM games WHERE game_id = ?"
+END_GAME = "UPDATE games SET status = 'completed', winner = ? WHERE game_id = ?"
+FINISH_GAME = "UPDATE games SET status = 'completed', winner = ?, ratings = ?, finished_at = ? WHERE game_id = ?"
+ABORT_GAME = "UPDATE games SET status = 'aborted' WHERE game_id = ? AND status = 'ongoing'"
+SELECT_COMPLETED_GAMES = (
+    "SELECT game_id, white, black, winner, finished_at FROM games WHERE status = 'completed' "
+    "ORDER BY finished_at, game_id"
+)
+SELECT_GAME_MOVES = "SELECT move FROM moves WHERE game_id = ? ORDER BY ply"
+HISTORY_COLUMNS = "game_id, white, black, winner, finished_at"
+SELECT_PLAYER_GAME = "SELECT 1 FROM games WHERE game_id = ? AND (white = ? OR black = ?)"
+# Largest SQLite integer, the "before" of a first history page.
+NO_CURSOR = 2 ** 63 - 1
+EXPORT_BATCH = 100
+DELETE_GAMES = "DELETE FROM games"
+DELETE_MOVES = "DELETE FROM moves"
+
+
+def _game_key(game_id):
+    try:
+        return int(game_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _history_branch(color, result):
+    """One side of the history query: the player's games as ``color``.
+
+    ``games_white``/``games_black`` index (player, rowid), so each branch is
+    a backwards range scan from the cursor that stops after LIMIT rows.
+    """
+    opponent = "black" if color == "white" else "white"
+    sql = f"SELECT {HISTORY_COLUMNS} FROM games WHERE {color} = ? AND game_id < ? AND status = 'completed'"
+    if color == "black":
+        sql += " AND white != ?"
+    if result == "win":
+        sql += f" AND winner = '{color}'"
+    elif result == "loss":
+        sql += f" AND winner = '{opponent}'"
+    elif result == "draw":
+        sql += " AND winner = 'draw'"
+    return sql + " ORDER BY game_id DESC LIMIT ?"
+
+
+# (color filter, result filter) -> statement, built once per combination.
+HISTORY_QUERIES = {}
+for _color in (None, "white", "black"):
+    for _result in (None, "win", "loss", "draw"):
+        _branches = [_history_branch(c, _result) for c in ("white", "black") if _color in (None, c)]
+        HISTORY_QUERIES[_color, _result] = (
+            " UNION ALL ".join(f"SELECT * FROM ({branch})" for branch in _branches) + " ORDER BY game_id DESC LIMIT ?"
+        )
+
+
+def _game_from_row(row):
+    game = dict(row)
+    game["game_id"] = str(game["game_id"])
+    if game["winner"] is None:
+        del game["winner"]
+    if game["ratings"] is None:
+        del game["ratings"]
+    else:
+        game["ratings"] = json.loads(game["ratings"])
+    for column in ("finished_at", "created_at"):
+        if game[column] is None:
+            del game[column]
+    return game
+
+
+def _rating_from_row(row):
+    return {
+        "rating": row["rating"],
+        "rd": DEFAULT_RD if row["rd"] is None else row["rd"],
+        "volatility": DEFAULT_VOLATILITY if row["volatility"] is None else row["volatility"],
+    }
+
+
+def _queue_entry_from_row(row):
+    entry = dict(row)
+    del entry["id"]
+    return entry
+
+
+class SQLiteChessDatabase(ChessDatabaseInterface):
+    """SQLite store running in WAL mode.
+
+    Statements run on a dedicated worker thread, so the reactor thread never
+    blocks on disk I/O.
+    """
+
+    def __init__(self, base_path="data", filename="chess.sqlite3"):
+        self.base_path = Path(base_path)
+        self.base_path.mkdir(parents=True, exist_ok=True)
+        self.db_file = self.base_path / filename
+
+        self._conn = sqlite3.connect(self.db_file, check_same_thread=False, cached_statements=64)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._conn.commit()
+
+        # A single worker owns the connection after setup, so statements are
+        # serialized without any extra locking.
+        self._pool = ThreadPool(minthreads=1, maxthreads=1, name="chessdatabase-sqlite")
+        self._pool.start()
+
+    def _migrate(self):
+        for table, columns in MIGRATIONS.items():
+            existing = {row["name"] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            for name, kind in columns:
+                if name not in existing:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {kind}")
+
+    def _run(self, func, *args):
+        return deferToThreadPool(reactor, self._pool, func, *args)
+
+    def _fetch_one(self, sql, params):
+        row = self._conn.execute(sql, params).fetchone()
+        return dict(row) if row else None
+
+    def _execute(self, sql, params=()):
+        with self._conn:
+            return self._conn.execute(sql, params).rowcount
+
+    def close(self):
+        if self._pool.started:
+            self._pool.stop()
+            self._conn.close()
+
+    async def add_user(self, username, hashed_password, rating=1200):
+        return await self._run(self._execute, INSERT_USER, (username, hashed_password, rating)) == 1
+
+    async def find_user(self, username):
+        return await self._run(self._fetch_one, SELECT_USER, (username,))
+
+    async def get_elo(self, username):
+        user = await self.find_user(username)
+        return user["rating"] if user else None
+
+    def _select_rating(self, username):
+        row = self._conn.execute(SELECT_RATING, (username,)).fetchone()
+        return _rating_from_row(row) if row else None
+
+    async def get_rating(self, username):
+        return await self._run(self._select_rating, username)
+
+    def _select_ratings(self):
+        return {row["username"]: _rating_from_row(row) for row in self._conn.execute(SELECT_RATINGS)}
+
+    async def get_ratings(self):
+        return await self._run(self._select_ratings)
+
+    def _update_ratings(self, ratings):
+        with self._conn:
+            self._conn.executemany(UPDATE_RATING_STATE, [
+                (state["rating"], state["rd"], state["volatility"], username) for username, state in ratings.items()
+            ])
+
+    async def set_ratings(self, ratings):
+        await self._run(self._update_ratings, ratings)
+
+    async def update_elo(self, username, elo):
+        await self._run(self._execute, UPDATE_RATING, (elo, username))
+
+    async def add_session(self, username, session_id):
+        await self._run(self._execute, UPDATE_SESSION, (session_id, username))
+
+    async def find_user_by_session(self, session_id):
+        if not session_id:
+            return None
+        return await self._run(self._fetch_one, SELECT_USER_BY_SESSION, (session_id,))
+
+    async def find_session(self, username):
+        user = await self.find_user(username)
+        return user["session_id"] if user else None
+
+    async def delete_session(self, session_id):
+        await self._run(self._execute, CLEAR_SESSION, (session_id,))
+
+    async def add_to_queue(self, username, session_id, rating):
+        await self._run(self._execute, INSERT_QUEUE, (username, session_id, rating, time.time()))
+
+    def _pop_oldest(self):
+        with self._conn:
+            row = self._conn.execute(SELECT_OLDEST_QUEUE).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(DELETE_QUEUE_ID, (row["id"],))
+            return _queue_entry_from_row(row)
+
+    async def get_oldest_in_queue(self):
+        return await self._run(self._pop_oldest)
+
+    async def clear_queue(self, username):
+        await self._run(self._execute, DELETE_QUEUE_USER, (username,))
+
+    def _insert_game(self, params):
+        with self._conn:
+            return str(self._conn.execute(INSERT_GAME, params).lastrowid)
+
+    async def create_game(self, white_username, whitesess, black_username, blacksess, board_fen):
+        return await self._run(
+            self._insert_game, (white_username, whitesess, black_username, blacksess, board_fen, time.time())
+        )
+
+    async def update_game(self, game_id, board_fen):
+        await self._run(self._execute, UPDATE_GAME_FEN, (board_fen, _game_key(game_id)))
+
+    def _record_move(self, game_id, ply, move, board_fen):
+        with self._conn:
+            self._conn.execute(INSERT_MOVE, (game_id, ply, move))
+            self._conn.execute(UPDATE_GAME_FEN, (board_fen, game_id))
+
+    async def append_move(self, game_id, ply, move, board_fen):
+        await self._run(self._record_move, _game_key(game_id), ply, move, board_fen)
+
+    def _select_game(self, game_id):
+        row = self._conn.execute(SELECT_GAME, (game_id,)).fetchone()
+        return _game_from_row(row) if row else None
+
+    async def find_game(self, game_id):
+        key = _game_key(game_id)
+        if key is None:
+            return None
+        return await self._run(self._select_game, key)
+
+    async def end_game(self, game_id, winner):
+        await self._run(self._execute, END_GAME, (winner, _game_key(game_id)))
+
+    def _finish(self, game_id, winner, rating_deltas):
+        with self._conn:
+            row = self._conn.execute(SELECT_GAME_RESULT, (game_id,)).fetchone()
+            if row is None or row["status"] == "aborted":
+                return None
+            if row["status"] == "completed":
+                return json.loads(row["ratings"]) if row["ratings"] else {}
+
+            ratings = {}
+            for username, delta in rating_deltas.items():
+                row = self._conn.execute(SELECT_RATING, (username,)).fetchone()
+                if row is None:
+                    continue
+                state = _rating_from_row(row)
+                ratings[username] = round(state["rating"] + delta["rating"])
+                self._conn.execute(UPDATE_RATING_STATE, (
+                    ratings[username],
+                    state["rd"] + delta.get("rd", 0),
+                    state["volatility"] + delta.get("volatility", 0),
+                    username,
+                ))
+            self._conn.execute(FINISH_GAME, (winner, json.dumps(ratings), time.time(), game_id))
+            return ratings
+
+    async def finish_game(self, game_id, winner, rating_deltas):
+        key = _game_key(game_id)
+        if key is None:
+            return None
+        return await self._run(self._finish, key, winner, rating_deltas)
+
+    def _reset(self):
+        with self._conn:
+            self._conn.execute(CLEAR_ALL_SESSIONS)
+            self._conn.execute(DELETE_QUEUE)
+            self._conn.execute(DELETE_GAMES)
+            self._conn.execute(DELETE_MOVES)
+
+    async def delete_local_databases(self):
+        await self._run(self._reset)
+
+    def _select_games_involving(self, username):
+        rows = self._conn.execute(SELECT_GAMES_INVOLVING, (username, username, username))
+        return [_game_from_row(row) for row in rows]
+
+    async def get_games_involving(self, username):
+        return await self._run(self._select_games_involving, username)
+
+    def _select_history(self, username, before, limit, result, color):
+        if before != NO_CURSOR and self._conn.execute(SELECT_PLAYER_GAME, (before, username, username)).fetchone() is None:
+            return None
+        params = []
+        for branch_color in ("white", "black"):
+            if color in (None, branch_color):
+                params += [username, before]
+                if branch_color == "black":
+                    params.append(username)
+                params.append(limit + 1)
+        params.append(limit + 1)
+        rows = self._conn.execute(HISTORY_QUERIES[color, result], params).fetchall()
+        return [{**row, "game_id": str(row["game_id"])} for row in map(dict, rows)]
+
+    async def get_game_history(self, username, before=None, limit=20, result=None, color=None):
+        if before is None:
+            key = NO_CURSOR
+        elif isinstance(before, str) and before.isdigit():
+            key = int(before)
+        else:
+            raise InvalidCursor(before)
+        games = await self._run(self._select_history, username, key, limit, result, color)
+        if games is None:
+            raise InvalidCursor(before)
+        if len(games) > limit:
+            return games[:limit], games[limit - 1]["game_id"]
+        return games, None
+
+    def _select_export_batch(self, username, since, until, after):
+        sql = f"SELECT {GAME_COLUMNS} FROM games WHERE game_id > ? AND status = 'completed'"
+        params = [after]
+        if username is not None:
+            sql += " AND (white = ? OR black = ?)"
+            params += [username, username]
+        if since is not None:
+            sql += " AND finished_at >= ?"
+            params.append(since)
+        if until is not None:
+            sql += " AND finished_at < ?"
+            params.append(until)
+        sql += " ORDER BY game_id LIMIT ?"
+        params.append(EXPORT_BATCH)
+        games = [_game_from_row(row) for row in self._conn.execute(sql, params).fetchall()]
+        for game in games:
+            game["moves"] = [row["move"] for row in self._conn.execute(SELECT_GAME_MOVES, (int(game["game_id"]),))]
+        return games
+
+    async def iter_games(self, username=None, since=None, until=None, after=None):
+        last = _game_key(after) or 0
+        while True:
+            games = await self._run(self._select_export_batch, username, since, until, last)
+            for game in games:
+                yield game
+            if len(games) < EXPORT_BATCH:
+                return
+            last = int(games[-1]["game_id"])
+
+    def _select_completed_games(self):
+        return [{**row, "game_id": str(row["game_id"])} for row in map(dict, self._conn.execute(SELECT_COMPLETED_GAMES))]
+
+    async def get_completed_games(self):
+        return await self._run(self._select_completed_games)
+
+    async def remove_game(self, game_id):
+        await self._run(self._execute, ABORT_GAME, (_game_key(game_id),))
+
+    def _select_queue(self):
+        return [_queue_entry_from_row(row) for row in self._conn.execute(SELECT_QUEUE)]
+
+    async def get_queue(self):
+        return await self._run(self._select_queue)
+
+    def _replace_queue(self, queue):
+        with self._conn:
+            self._conn.execute(DELETE_QUEUE)
+            self._conn.executemany(INSERT_QUEUE, [
+                (player["username"], player["session_id"], player["rating"], player["queueStartTime"])
+                for player in queue
+            ])
+
+    async def restore_queue(self, queue):
+        await self._run(self._replace_queue, queue)
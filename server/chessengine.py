@@ -0,0 +1,301 @@
+"""Alpha-beta search for the built-in computer opponent.
+
+Run as a script it serves searches for ``botplayer.EnginePool``: one JSON
+request per line on stdin, one JSON reply per line on stdout. Searching is
+pure Python and CPU bound, so it never runs in the server process itself.
+"""
+import json
+import signal
+import sys
+import time
+from operator import itemgetter
+
+import chess
+
+from positioncache import position_key
+
+PIECE_VALUES = {
+    chess.PAWN: 100, chess.KNIGHT: 320, chess.BISHOP: 330, chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0,
+}
+# Piece-square bonuses for white as the board is drawn, rank 8 first; a white
+# piece on ``square`` reads entry ``square ^ 56``, a black one entry ``square``.
+PIECE_SQUARES = {
+    chess.PAWN: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ),
+    chess.KNIGHT: (
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ),
+    chess.BISHOP: (
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ),
+    chess.ROOK: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ),
+    chess.QUEEN: (
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ),
+    chess.KING: (
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ),
+}
+
+MATE = 100000
+INFINITY = MATE + 1
+MAX_DEPTH = 20
+# Transposition table entries kept between searches before it is cleared.
+TABLE_SIZE = 500000
+# Nodes between looks at the clock.
+CHECK_EVERY = 1024
+EXACT, LOWER, UPPER = 0, 1, 2
+
+
+class TimeUp(Exception):
+    pass
+
+
+def evaluate(board):
+    """Material and piece placement in centipawns, for the side to move."""
+    score = 0
+    for piece_type, value in PIECE_VALUES.items():
+        table = PIECE_SQUARES[piece_type]
+        for square in chess.scan_forward(board.pieces_mask(piece_type, chess.WHITE)):
+            score += value + table[square ^ 56]
+        for square in chess.scan_forward(board.pieces_mask(piece_type, chess.BLACK)):
+            score -= value + table[square]
+    return score if board.turn == chess.WHITE else -score
+
+
+class Searcher:
+    """Iterative deepening alpha-beta with a transposition table.
+
+    Moves are tried best-first: the table's move for the position, then
+    captures by most valuable victim and least valuable attacker, then
+    promotions and the two killer moves of the ply. The table outlives a
+    single search, so consecutive moves of a game start from what the
+    previous search already learned.
+    """
+
+    def __init__(self, table_size=TABLE_SIZE):
+        self.table_size = table_size
+        self.table = {}
+        self.killers = []
+        self.nodes = 0
+        self.deadline = 0.0
+
+    def search(self, board, budget, max_depth=MAX_DEPTH):
+        """Best move found within ``budget`` seconds, with its depth and score."""
+        started = time.monotonic()
+        self.deadline = started + budget
+        self.nodes = 0
+        self.killers = [[None, None] for _ in range(max_depth + 1)]
+        if len(self.table) > self.table_size:
+            self.table.clear()
+
+        moves = list(board.legal_moves)
+        if not moves:
+            raise ValueError("no legal moves")
+        best, depth_done, score = moves[0], 0, 0
+        if len(moves) == 1:
+            return best, depth_done, score
+        for depth in range(1, max_depth + 1):
+            try:
+                score, move = self._root(board, depth)
+            except TimeUp:
+                break
+            best, depth_done = move, depth
+            if abs(score) >= MATE - max_depth:
+                break
+            # The next iteration takes several times longer than this one.
+            if time.monotonic() - started > budget / 2:
+                break
+        return best, depth_done, score
+
+    def _root(self, board, depth):
+        alpha, beta = -INFINITY, INFINITY
+        best_move = None
+        for move in self._ordered(board, self._table_move(board), 0):
+            board.push(move)
+            score = -self._negamax(board, depth - 1, -beta, -alpha, 1)
+            board.pop()
+            if best_move is None or score > alpha:
+                alpha, best_move = score, move
+        self.table[position_key(board)] = (depth, alpha, EXACT, best_move)
+        return alpha, best_move
+
+    def _table_move(self, board):
+        entry = self.table.get(position_key(board))
+        return entry[3] if entry else None
+
+    def _tick(self):
+        self.nodes += 1
+        if self.nodes % CHECK_EVERY == 0 and time.monotonic() > self.deadline:
+            raise TimeUp()
+
+    def _negamax(self, board, depth, alpha, beta, ply):
+        self._tick()
+        if board.halfmove_clock >= 100 or board.is_repetition(2):
+            return 0
+        if board.is_check():
+            depth += 1
+        if depth <= 0 or ply >= len(self.killers):
+            return self._quiesce(board, alpha, beta)
+
+        key = position_key(board)
+        entry = self.table.get(key)
+        table_move = None
+        if entry is not None:
+            entry_depth, entry_score, flag, table_move = entry
+            if entry_depth >= depth:
+                if flag == EXACT:
+                    return entry_score
+                if flag == LOWER:
+                    alpha = max(alpha, entry_score)
+                else:
+                    beta = min(beta, entry_score)
+                if alpha >= beta:
+                    return entry_score
+
+        original_alpha = alpha
+        best_score, best_move = -INFINITY, None
+        for move in self._ordered(board, table_move, ply):
+            board.push(move)
+            score = -self._negamax(board, depth - 1, -beta, -alpha, ply + 1)
+            board.pop()
+            if score > best_score:
+                best_score, best_move = score, move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if not board.is_capture(move):
+                    killers = self.killers[ply]
+                    if killers[0] != move:
+                        killers[1], killers[0] = killers[0], move
+                break
+
+        if best_move is None:
+            # Mated sooner is worse, so the search prefers the quickest mate.
+            return -(MATE - ply) if board.is_check() else 0
+
+        if best_score <= original_alpha:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table[key] = (depth, best_score, flag, best_move)
+        return best_score
+
+    def _quiesce(self, board, alpha, beta):
+        """Resolve captures so the static evaluation is not taken mid-exchange."""
+        self._tick()
+        stand_pat = evaluate(board)
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+        for move in self._captures(board):
+            board.push(move)
+            score = -self._quiesce(board, -beta, -alpha)
+            board.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def _capture_order(self, board, move):
+        # En passant leaves the target square empty; the victim is a pawn.
+        victim = board.piece_type_at(move.to_square) or chess.PAWN
+        return 10 * PIECE_VALUES[victim] - PIECE_VALUES[board.piece_type_at(move.from_square)]
+
+    def _captures(self, board):
+        scored = [(self._capture_order(board, move), move) for move in board.generate_legal_captures()]
+        scored.sort(key=itemgetter(0), reverse=True)
+        return [move for _, move in scored]
+
+    def _ordered(self, board, table_move, ply):
+        killers = self.killers[ply] if ply < len(self.killers) else ()
+        scored = []
+        for move in board.generate_legal_moves():
+            if move == table_move:
+                order = 1000000
+            elif board.is_capture(move):
+                order = 100000 + self._capture_order(board, move)
+            elif move.promotion:
+                order = 90000 + PIECE_VALUES[move.promotion]
+            elif move in killers:
+                order = 80000
+            else:
+                order = 0
+            scored.append((order, move))
+        scored.sort(key=itemgetter(0), reverse=True)
+        return [move for _, move in scored]
+
+
+def serve(requests, replies):
+    """Answer ``{"fen", "moves", "budget"}`` requests with ``{"move", "depth", "score", "nodes"}``.
+
+    ``moves`` are played from ``fen`` before searching, so the search knows
+    which positions already occurred in the game.
+    """
+    searcher = Searcher()
+    for line in requests:
+        try:
+            request = json.loads(line)
+            board = chess.Board(request["fen"])
+            for move in request.get("moves", ()):
+                board.push_uci(move)
+            move, depth, score = searcher.search(board, float(request["budget"]))
+            reply = {"move": move.uci(), "depth": depth, "score": score, "nodes": searcher.nodes}
+        except (ValueError, KeyError, TypeError) as e:
+            reply = {"error": str(e)}
+        replies.write(json.dumps(reply) + "\n")
+        replies.flush()
+
+
+if __name__ == "__main__":
+    # The server stops engines by closing their stdin; Ctrl+C in the server's
+    # terminal reaches this process too and should not kill it mid-reply.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    serve(sys.stdin, sys.stdout)
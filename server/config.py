@@ -0,0 +1,66 @@
+import os
+
+# Storage backend used by the server: "json" or "sqlite".
+DB_BACKEND = os.environ.get("CHESS_DB_BACKEND", "json")
+DB_PATH = os.environ.get("CHESS_DB_PATH", "data")
+
+# Accept pickled frames from clients that never negotiated the binary codec.
+# Unpickling client data lets any client run code on the server, so this is
+# opt-in, for a trusted network with legacy clients only.
+ALLOW_PICKLE = os.environ.get("CHESS_ALLOW_PICKLE", "0") == "1"
+
+# bcrypt runs on a separate thread pool; requests beyond the queue limit are
+# answered with "server busy".
+HASH_WORKERS = int(os.environ.get("CHESS_HASH_WORKERS", "4"))
+HASH_QUEUE_LIMIT = int(os.environ.get("CHESS_HASH_QUEUE_LIMIT", "64"))
+
+# Seconds a session stays valid after its last authenticated message.
+SESSION_TTL = int(os.environ.get("CHESS_SESSION_TTL", "3600"))
+
+# Number of server processes sharing the port. More than one needs the sqlite
+# backend; the processes coordinate through the state service socket.
+WORKERS = int(os.environ.get("CHESS_WORKERS", "1"))
+STATE_SOCKET = os.environ.get("CHESS_STATE_SOCKET", os.path.join(DB_PATH, "state.sock"))
+
+# Prometheus metrics on http://127.0.0.1:<port>/metrics; 0 turns it off.
+# Worker N of a multi-process server listens on port + N.
+METRICS_PORT = int(os.environ.get("CHESS_METRICS_PORT", "9108"))
+
+# Structured JSON logs. An empty CHESS_LOG_FILE logs to stdout. Chatty message
+# types are sampled: "move=100" keeps one move in a hundred at INFO level.
+# Send SIGUSR1 to switch full DEBUG payload logging on or off.
+LOG_FILE = os.environ.get("CHESS_LOG_FILE", "server.log")
+LOG_LEVEL = os.environ.get("CHESS_LOG_LEVEL", "INFO")
+LOG_MAX_BYTES = int(os.environ.get("CHESS_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get("CHESS_LOG_BACKUPS", "5"))
+LOG_SAMPLE = os.environ.get("CHESS_LOG_SAMPLE", "move=100,watch_game=10")
+
+# Per-connection limits: largest accepted frame in bytes, handlers running at
+# once, and further messages queued behind them before new ones are refused.
+MAX_FRAME = int(os.environ.get("CHESS_MAX_FRAME", "8192"))
+MAX_IN_FLIGHT = int(os.environ.get("CHESS_MAX_IN_FLIGHT", "4"))
+MAX_QUEUED = int(os.environ.get("CHESS_MAX_QUEUED", "32"))
+
+# Time control for every game as "base+increment" in seconds, e.g. "600+5".
+# An empty value plays without clocks.
+TIME_CONTROL = os.environ.get("CHESS_TIME_CONTROL", "600+5")
+
+# Heartbeats: a connection quiet for HEARTBEAT_INTERVAL seconds is pinged and
+# one quiet for IDLE_TIMEOUT is closed. A player whose connection drops keeps
+# the session and its games for RESUME_GRACE seconds to reconnect and resume.
+HEARTBEAT_INTERVAL = float(os.environ.get("CHESS_HEARTBEAT_INTERVAL", "15"))
+IDLE_TIMEOUT = float(os.environ.get("CHESS_IDLE_TIMEOUT", "45"))
+RESUME_GRACE = float(os.environ.get("CHESS_RESUME_GRACE", "30"))
+
+# Positions whose legal moves and mate/stalemate status are kept in memory,
+# shared by all games of a process. 0 turns the cache off.
+POSITION_CACHE_SIZE = int(os.environ.get("CHESS_POSITION_CACHE_SIZE", "20000"))
+
+# Built-in computer opponent. A player still waiting after BOT_WAIT seconds
+# is matched against it, with at most BOT_GAMES bot games at once per server
+# process (0 turns the bot off). Searches run in BOT_WORKERS engine processes
+# and take at most BOT_MOVE_TIME seconds per move.
+BOT_WAIT = float(os.environ.get("CHESS_BOT_WAIT", "30"))
+BOT_GAMES = int(os.environ.get("CHESS_BOT_GAMES", "4"))
+BOT_WORKERS = int(os.environ.get("CHESS_BOT_WORKERS", "2"))
+BOT_MOVE_TIME = float(os.environ.get("CHESS_BOT_MOVE_TIME", "1.0"))
@@ -0,0 +1,181 @@
+import bisect
+import json
+import os
+import threading
+import zlib
+from collections import defaultdict
+from pathlib import Path
+
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+
+class GameArchive:
+    """Append-only store for finished games.
+
+    Each game is zlib-compressed and appended to the current segment file;
+    a new segment is started once the current one exceeds ``segment_size``.
+    ``index.jsonl`` records where every game lives along with both player
+    names and its result, and is loaded at startup into in-memory lookups by
+    game id and by player, so a single game is one seek and one read.
+
+    Each player's game ids are kept sorted, so history pages walk backwards
+    from a cursor with a bisect and answer result filters from the index
+    without opening the segments.
+
+    ``add`` only flushes; ``sync`` fsyncs every file appended to since the
+    last call, once for a whole batch of games.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.index_file = self.path / "index.jsonl"
+
+        self.by_id = {}
+        # game id -> (white, black, status, winner, finished_at)
+        self.summaries = {}
+        # username -> sorted integer game ids
+        self.by_player = defaultdict(list)
+        self.segment = 0
+        # Files with appends not yet fsynced, shared with the thread calling sync().
+        self._unsynced = set()
+        self._unsynced_lock = threading.Lock()
+        if self.index_file.exists():
+            with open(self.index_file, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    self._index(entry)
+                    self.segment = max(self.segment, entry["segment"])
+
+        self._segment_file = open(self._segment_path(self.segment), "ab")
+        self._index_writer = open(self.index_file, "a", encoding="utf-8")
+
+    def _segment_path(self, segment):
+        return self.path / f"segment-{segment:05d}.bin"
+
+    def _index(self, entry):
+        game_id = entry["game_id"]
+        self.by_id[game_id] = (entry["segment"], entry["offset"], entry["length"])
+        if "status" in entry:
+            self.summaries[game_id] = (
+                entry["white"], entry["black"], entry["status"], entry.get("winner"), entry.get("finished_at")
+            )
+        if not game_id.isdigit():
+            return
+        key = int(game_id)
+        for username in {entry["white"], entry["black"]}:
+            game_ids = self.by_player[username]
+            if not game_ids or game_ids[-1] < key:
+                game_ids.append(key)
+            else:
+                bisect.insort(game_ids, key)
+
+    def __contains__(self, game_id):
+        return game_id in self.by_id
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def add(self, game):
+        if game["game_id"] in self.by_id:
+            return
+        if self._segment_file.tell() >= self.segment_size:
+            self._segment_file.close()
+            self.segment += 1
+            self._segment_file = open(self._segment_path(self.segment), "ab")
+
+        data = zlib.compress(json.dumps(game).encode())
+        offset = self._segment_file.tell()
+        self._segment_file.write(data)
+        self._segment_file.flush()
+
+        entry = {
+            "game_id": game["game_id"],
+            "segment": self.segment,
+            "offset": offset,
+            "length": len(data),
+            "white": game["white"],
+            "black": game["black"],
+            "status": game["status"],
+            "winner": game.get("winner"),
+            "finished_at": game.get("finished_at"),
+        }
+        self._index_writer.write(json.dumps(entry) + "\n")
+        self._index_writer.flush()
+        self._index(entry)
+        with self._unsynced_lock:
+            self._unsynced.update((self._segment_path(self.segment), self.index_file))
+
+    def sync(self):
+        """Fsync the games added so far; safe to call from another thread."""
+        with self._unsynced_lock:
+            paths, self._unsynced = self._unsynced, set()
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                # Removed by clear() meanwhile.
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                with self._unsynced_lock:
+                    self._unsynced.update(paths)
+                raise
+            finally:
+                os.close(fd)
+
+    def get(self, game_id):
+        location = self.by_id.get(game_id)
+        if location is None:
+            return None
+        segment, offset, length = location
+        with open(self._segment_path(segment), "rb") as f:
+            f.seek(offset)
+            return json.loads(zlib.decompress(f.read(length)))
+
+    def summary(self, game_id):
+        """(white, black, status, winner, finished_at) of an archived game."""
+        summary = self.summaries.get(game_id)
+        if summary is None and game_id in self.by_id:
+            # Index lines written before results were indexed.
+            game = self.get(game_id)
+            summary = self.summaries[game_id] = (
+                game["white"], game["black"], game["status"], game.get("winner"), game.get("finished_at")
+            )
+        return summary
+
+    def player_games(self, username, before=None, after=None, newest_first=True):
+        """Archived game ids of ``username`` strictly between ``after`` and ``before``."""
+        game_ids = self.by_player.get(username, ())
+        start = 0 if after is None else bisect.bisect_right(game_ids, after)
+        stop = len(game_ids) if before is None else bisect.bisect_left(game_ids, before)
+        ids = range(stop - 1, start - 1, -1) if newest_first else range(start, stop)
+        for i in ids:
+            yield str(game_ids[i])
+
+    def games_for(self, username):
+        for game_id in self.player_games(username, newest_first=False):
+            yield self.get(game_id)
+
+    def clear(self):
+        self.close()
+        for segment in range(self.segment + 1):
+            self._segment_path(segment).unlink(missing_ok=True)
+        self.index_file.unlink(missing_ok=True)
+        with self._unsynced_lock:
+            self._unsynced.clear()
+        self.by_id.clear()
+        self.summaries.clear()
+        self.by_player.clear()
+        self.segment = 0
+        self._segment_file = open(self._segment_path(self.segment), "ab")
+        self._index_writer = open(self.index_file, "a", encoding="utf-8")
+
+    def close(self):
+        self._segment_file.close()
+        self._index_writer.close()
@@ -0,0 +1,140 @@
+from collections import defaultdict
+
+import chess
+
+from positioncache import Repetitions
+
+
+def parse_time_control(text):
+    """``"600+5"`` -> (600.0, 5.0): base seconds and increment per move. Empty -> None."""
+    if not text:
+        return None
+    base, _, increment = text.partition("+")
+    return float(base), float(increment or 0)
+
+
+class GameClock:
+    """Chess clock with a base time and a per-move increment, in seconds.
+
+    Only the side to move is running; its remaining time is computed from
+    when its turn started, so nothing ticks between moves.
+    """
+
+    __slots__ = ("base", "increment", "remaining", "running", "turn_started")
+
+    def __init__(self, base, increment, now):
+        self.base = base
+        self.increment = increment
+        self.remaining = {"white": float(base), "black": float(base)}
+        self.running = "white"
+        self.turn_started = now
+
+    def left(self, color, now):
+        if color == self.running:
+            return self.remaining[color] - (now - self.turn_started)
+        return self.remaining[color]
+
+    def deadline(self):
+        return self.turn_started + self.remaining[self.running]
+
+    def press(self, now):
+        """End the running side's turn. Returns False if its flag had already fallen."""
+        color = self.running
+        left = self.left(color, now)
+        if left <= 0:
+            self.remaining[color] = 0.0
+            return False
+        self.remaining[color] = left + self.increment
+        self.running = "black" if color == "white" else "white"
+        self.turn_started = now
+        return True
+
+    def as_message(self, now):
+        return {
+            "white_clock": max(0, round(self.left("white", now) * 1000)),
+            "black_clock": max(0, round(self.left("black", now) * 1000)),
+        }
+
+
+class LiveGame:
+    """A game in progress: its board with full move stack and both players."""
+
+    __slots__ = (
+        "game_id", "board", "white", "black", "whitesess", "blacksess", "whiteconn", "blackconn", "clock", "timer",
+        "repetitions",
+    )
+
+    def __init__(self, game_id, board, white, whitesess, whiteconn, black, blacksess, blackconn, clock=None):
+        self.game_id = game_id
+        self.board = board
+        self.white = white
+        self.whitesess = whitesess
+        self.whiteconn = whiteconn
+        self.black = black
+        self.blacksess = blacksess
+        self.blackconn = blackconn
+        self.clock = clock
+        self.timer = None
+        self.repetitions = Repetitions(board)
+
+    def color_of(self, session_id):
+        if session_id == self.whitesess:
+            return "white"
+        if session_id == self.blacksess:
+            return "black"
+        return None
+
+    def to_move(self):
+        return "white" if self.board.turn == chess.WHITE else "black"
+
+    def username(self, color):
+        return self.white if color == "white" else self.black
+
+    def session(self, color):
+        return self.whitesess if color == "white" else self.blacksess
+
+    def connection(self, color):
+        return self.whiteconn if color == "white" else self.blackconn
+
+    def connections(self):
+        return (self.whiteconn, self.blackconn)
+
+    def recent_moves(self, count):
+        return [move.uci() for move in self.board.move_stack[-count:]]
+
+
+class GameRegistry:
+    """Live games keyed by game id, with a session index for disconnects."""
+
+    def __init__(self):
+        self.games = {}
+        self.by_session = defaultdict(set)
+
+    def __len__(self):
+        return len(self.games)
+
+    def __contains__(self, game_id):
+        return game_id in self.games
+
+    def add(self, game):
+        self.games[game.game_id] = game
+        self.by_session[game.whitesess].add(game.game_id)
+        self.by_session[game.blacksess].add(game.game_id)
+
+    def get(self, game_id):
+        return self.games.get(game_id)
+
+    def remove(self, game_id):
+        game = self.games.pop(game_id, None)
+        if game is None:
+            return None
+        for session_id in (game.whitesess, game.blacksess):
+            game_ids = self.by_session.get(session_id)
+            if game_ids is not None:
+                game_ids.discard(game_id)
+                if not game_ids:
+                    del self.by_session[session_id]
+        return game
+
+    def for_session(self, session_id):
+        return [self.games[game_id] for game_id in self.by_session.get(session_id, ())]
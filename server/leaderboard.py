@@ -0,0 +1,197 @@
+import random
+
+MAX_LEVEL = 24
+MAX_PAGE = 50
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        # Positions skipped by following next[i]; lets a search count as it goes.
+        self.width = [1] * level
+
+
+class RankedSkipList:
+    """Sorted keys with O(log n) insert, remove, rank and positional lookup.
+
+    An indexable skip list: besides its forward pointers every node stores
+    how many bottom-level positions each pointer jumps over, so the number
+    of keys passed on the way down is the position of the key found.
+    """
+
+    def __init__(self, max_level=MAX_LEVEL):
+        self.max_level = max_level
+        self.tail = _Node(None, 0)
+        self.head = _Node(None, max_level)
+        self.head.next = [self.tail] * max_level
+        self.size = 0
+        # Levels above this one only link the head to the tail.
+        self.level = 1
+
+    def __len__(self):
+        return self.size
+
+    def _search(self, key):
+        """Rightmost node before ``key`` on every level, and its position."""
+        chain = [self.head] * self.max_level
+        steps_at = [0] * self.max_level
+        node = self.head
+        steps = 0
+        for level in reversed(range(self.level)):
+            while node.next[level] is not self.tail and node.next[level].key < key:
+                steps += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+            steps_at[level] = steps
+        return chain, steps_at
+
+    def _random_level(self):
+        level = 1
+        while level < self.max_level and random.getrandbits(1):
+            level += 1
+        return level
+
+    def insert(self, key):
+        chain, steps_at = self._search(key)
+        steps = steps_at[0]
+        level = self._random_level()
+        self.level = max(self.level, level)
+        node = _Node(key, level)
+        for i in range(level):
+            prev = chain[i]
+            skipped = steps - steps_at[i]
+            node.next[i] = prev.next[i]
+            node.width[i] = prev.width[i] - skipped
+            prev.next[i] = node
+            prev.width[i] = skipped + 1
+        for i in range(level, self.max_level):
+            chain[i].width[i] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain, _ = self._search(key)
+        node = chain[0].next[0]
+        if node is self.tail or node.key != key:
+            raise KeyError(key)
+        for i in range(len(node.next)):
+            prev = chain[i]
+            prev.width[i] += node.width[i] - 1
+            prev.next[i] = node.next[i]
+        for i in range(len(node.next), self.max_level):
+            chain[i].width[i] -= 1
+        self.size -= 1
+
+    def load_sorted(self, keys):
+        """Build an empty list from already sorted keys in O(n)."""
+        if self.size:
+            raise ValueError("load_sorted needs an empty list")
+        last = [self.head] * self.max_level
+        last_position = [0] * self.max_level
+        position = 0
+        for position, key in enumerate(keys, 1):
+            level = self._random_level()
+            self.level = max(self.level, level)
+            node = _Node(key, level)
+            for i in range(level):
+                last[i].next[i] = node
+                last[i].width[i] = position - last_position[i]
+                last[i] = node
+                last_position[i] = position
+        for i in range(self.max_level):
+            last[i].next[i] = self.tail
+            last[i].width[i] = position + 1 - last_position[i]
+        self.size = position
+
+    def count_less(self, key):
+        node = self.head
+        steps = 0
+        for level in reversed(range(self.level)):
+            while node.next[level] is not self.tail and node.next[level].key < key:
+                steps += node.width[level]
+                node = node.next[level]
+        return steps
+
+    def slice(self, start, count):
+        """Up to ``count`` keys starting at 0-based position ``start``."""
+        if start < 0 or start >= self.size or count <= 0:
+            return []
+        node = self.head
+        remaining = start + 1
+        for level in reversed(range(self.level)):
+            while node.width[level] <= remaining and node.next[level] is not self.tail:
+                remaining -= node.width[level]
+                node = node.next[level]
+        keys = []
+        while node is not self.tail and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class Leaderboard:
+    """Every player ordered by rating, kept current on each rating change.
+
+    Keys are ``(-rating, username)`` so position 0 is the top player. Tied
+    players share a rank: a player's rank is one more than the number of
+    players rated strictly higher.
+    """
+
+    def __init__(self):
+        self.ratings = {}
+        self.index = RankedSkipList()
+
+    def __len__(self):
+        return len(self.ratings)
+
+    def load(self, ratings):
+        """Seed from ``get_ratings()`` output, replacing what was there."""
+        self.ratings = {username: round(state["rating"]) for username, state in ratings.items()}
+        self.index = RankedSkipList()
+        self.index.load_sorted(sorted((-rating, username) for username, rating in self.ratings.items()))
+
+    def update(self, username, rating):
+        rating = round(rating)
+        old = self.ratings.get(username)
+        if old == rating:
+            return
+        if old is not None:
+            self.index.remove((-old, username))
+        self.ratings[username] = rating
+        self.index.insert((-rating, username))
+
+    def remove(self, username):
+        rating = self.ratings.pop(username, None)
+        if rating is not None:
+            self.index.remove((-rating, username))
+
+    def rank(self, username):
+        rating = self.ratings.get(username)
+        if rating is None:
+            return None
+        return self.index.count_less((-rating, "")) + 1
+
+    def _entries(self, start, count):
+        entries = []
+        rank = None
+        previous = None
+        for position, (negative, username) in enumerate(self.index.slice(start, count), start):
+            if negative != previous:
+                rank = position + 1 if rank is not None else self.index.count_less((negative, "")) + 1
+                previous = negative
+            entries.append({"username": username, "rating": -negative, "rank": rank})
+        return entries
+
+    def top(self, count, start=0):
+        return self._entries(start, min(count, MAX_PAGE))
+
+    def around(self, username, count):
+        """About ``count`` players centred on ``username``."""
+        rating = self.ratings.get(username)
+        if rating is None:
+            return []
+        count = min(count, MAX_PAGE)
+        position = self.index.count_less((-rating, username))
+        return self._entries(max(0, position - count // 2), count)
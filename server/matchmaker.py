@@ -0,0 +1,136 @@
+import bisect
+import itertools
+
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+
+TICK_INTERVAL = 0.5
+# A waiting player accepts opponents within BASE_RANGE rating points, widened
+# by RANGE_STEP for every WIDEN_EVERY seconds spent in the queue.
+BASE_RANGE = 50
+RANGE_STEP = 50
+WIDEN_EVERY = 5
+
+
+class QueueEntry:
+    __slots__ = ("username", "session_id", "rating", "queued_at", "key", "deferred")
+
+    def __init__(self, username, session_id, rating, queued_at, seq):
+        self.username = username
+        self.session_id = session_id
+        self.rating = rating
+        self.queued_at = queued_at
+        self.key = (rating, seq, session_id)
+        self.deferred = None
+
+    def as_dict(self):
+        return {
+            "username": self.username,
+            "session_id": self.session_id,
+            "rating": self.rating,
+            "queueStartTime": self.queued_at,
+        }
+
+
+class Matchmaker:
+    """In-memory matchmaking queue.
+
+    Waiting players are kept in a list sorted by rating, so the closest
+    opponent of any player is one of its direct neighbours. A new player is
+    matched immediately if possible; otherwise a single ``LoopingCall`` re-runs
+    the pairing every ``tick_interval`` seconds while the queue is non-empty,
+    letting each player's acceptable range widen as it waits.
+
+    ``enqueue`` returns a Deferred. When a pair is formed the player that
+    triggered the match gets the opponent's queue entry and is expected to
+    create the game; the opponent's Deferred fires with None.
+    """
+
+    def __init__(self, clock=reactor, tick_interval=TICK_INTERVAL):
+        self.clock = clock
+        self.tick_interval = tick_interval
+        self.entries = {}
+        self._index = []
+        self._seq = itertools.count()
+        self._loop = LoopingCall(self.tick)
+        self._loop.clock = clock
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, session_id):
+        return session_id in self.entries
+
+    def elo_range(self, entry, now):
+        return BASE_RANGE + RANGE_STEP * int((now - entry.queued_at) // WIDEN_EVERY)
+
+    def enqueue(self, username, session_id, rating, queued_at=None):
+        """Queue a player; ``queued_at`` keeps the wait of one put back in the queue."""
+        self.cancel(session_id)
+        if queued_at is None:
+            queued_at = self.clock.seconds()
+        entry = QueueEntry(username, session_id, rating, queued_at, next(self._seq))
+        entry.deferred = defer.Deferred(lambda d: self._remove(entry))
+        self.entries[session_id] = entry
+        bisect.insort(self._index, entry.key)
+
+        partner = self._find_partner(entry, entry.queued_at)
+        if partner:
+            self._pair(entry, partner)
+        elif not self._loop.running:
+            self._loop.start(self.tick_interval, now=False)
+        return entry.deferred
+
+    def cancel(self, session_id):
+        """Take ``session_id`` out of the queue; True if it was still waiting."""
+        entry = self.entries.get(session_id)
+        if not entry:
+            return False
+        self._remove(entry)
+        entry.deferred.callback(None)
+        return True
+
+    def queue(self):
+        return [entry.as_dict() for entry in self.entries.values()]
+
+    def tick(self):
+        now = self.clock.seconds()
+        # Oldest first: they have the widest range and the strongest claim.
+        for entry in list(self.entries.values()):
+            if entry.session_id not in self.entries:
+                continue
+            partner = self._find_partner(entry, now)
+            if partner:
+                self._pair(entry, partner)
+        if not self.entries and self._loop.running:
+            self._loop.stop()
+
+    def _remove(self, entry):
+        if self.entries.pop(entry.session_id, None) is None:
+            return
+        del self._index[bisect.bisect_left(self._index, entry.key)]
+
+    def _find_partner(self, entry, now):
+        limit = self.elo_range(entry, now)
+        position = bisect.bisect_left(self._index, entry.key)
+        best, best_diff = None, None
+
+        for step in (-1, 1):
+            i = position + step
+            while 0 <= i < len(self._index):
+                rating, _, session_id = self._index[i]
+                diff = abs(rating - entry.rating)
+                if diff > limit or (best_diff is not None and diff >= best_diff):
+                    break
+                candidate = self.entries[session_id]
+                if candidate.username != entry.username:
+                    best, best_diff = candidate, diff
+                    break
+                i += step
+        return best
+
+    def _pair(self, entry, partner):
+        self._remove(entry)
+        self._remove(partner)
+        entry.deferred.callback(partner.as_dict())
+        partner.deferred.callback(None)
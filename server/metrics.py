@@ -0,0 +1,195 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Recording is a dictionary lookup plus a bisect into a fixed bucket list, so
+the instrumentation can stay on in production. ``MetricsResource`` serves
+``registry.render()`` over twisted.web.
+"""
+import functools
+import inspect
+import time
+from bisect import bisect_left
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_INTERVAL = 0.5
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    """A counter incremented with ``inc``, or read from ``func`` at scrape time."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=(), func=None):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.func = func
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        if self.func:
+            yield self.name, "", self.func()
+            return
+        for labels, value in self.values.items():
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+class Gauge:
+    """A gauge whose value is read from ``func`` at scrape time, or set directly."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, func=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, "", self.func() if self.func else self.value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                cumulative += count
+                le = _labels((*self.labelnames, "le"), (*labels, bound))
+                yield f"{self.name}_bucket", le, cumulative
+            yield f"{self.name}_sum", _labels(self.labelnames, labels), series[-1]
+            yield f"{self.name}_count", _labels(self.labelnames, labels), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=(), func=None):
+        return self.add(Counter(name, help, labelnames, func))
+
+    def gauge(self, name, help, func=None):
+        return self.add(Gauge(name, help, func))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+handler_seconds = registry.histogram(
+    "chess_handler_seconds", "Time from receiving a frame to its handler finishing, queueing included.", ("type",)
+)
+handler_errors = registry.counter("chess_handler_errors_total", "Handlers that raised.", ("type",))
+rejected_frames = registry.counter(
+    "chess_rejected_frames_total", "Frames refused by rate limits or a full handler queue.", ("type",)
+)
+storage_seconds = registry.histogram("chess_storage_seconds", "Time spent in each storage method.", ("method",))
+reactor_lag = registry.histogram("chess_reactor_lag_seconds", "Delay of a periodic reactor timer past its deadline.")
+
+
+class InstrumentedDatabase:
+    """Wraps a storage backend and times every coroutine method it exposes."""
+
+    def __init__(self, database):
+        self._database = database
+
+    def __getattr__(self, name):
+        attr = getattr(self._database, name)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await attr(*args, **kwargs)
+            finally:
+                storage_seconds.observe(time.perf_counter() - start, name)
+
+        # Cache the wrapper so later lookups skip __getattr__.
+        setattr(self, name, timed)
+        return timed
+
+
+def time_handler(message_type, d, start):
+    """Record the time from ``start``, when the frame arrived, until Deferred ``d`` fires."""
+
+    def done(result):
+        handler_seconds.observe(time.perf_counter() - start, message_type)
+        if hasattr(result, "getErrorMessage"):
+            handler_errors.inc(message_type)
+        return result
+
+    return d.addBoth(done)
+
+
+def start_lag_monitor(interval=LAG_INTERVAL, clock=reactor):
+    """Measure how late a repeating timer fires; that lateness is reactor lag."""
+    state = {"deadline": clock.seconds() + interval}
+
+    def tick():
+        now = clock.seconds()
+        reactor_lag.observe(max(0.0, now - state["deadline"]))
+        state["deadline"] = now + interval
+
+    loop = LoopingCall(tick)
+    loop.clock = clock
+    loop.start(interval, now=False)
+    return loop
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, registry=registry):
+        super().__init__()
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4; charset=utf-8")
+        return self.registry.render().encode()
@@ -0,0 +1,134 @@
+import json
+import os
+from pathlib import Path
+
+import chess
+
+
+class MoveJournal:
+    """Append-only log of accepted moves, one ``(game_id, ply, move)`` line each.
+
+    Game results are journaled too: a finish record carries the winner, the
+    finish time and both players' new rating state. It is the only durable
+    copy of the result until the next snapshot, so ``append_finish`` returns
+    a handle that ``sync`` fsyncs; that can run off the reactor thread, and
+    still works if the journal is rotated meanwhile.
+
+    The journal only has to cover moves made since the last games snapshot.
+    ``rotate()`` is called while a snapshot is being taken: the current log is
+    set aside, a fresh one is started, and ``discard_rotated()`` removes the old
+    log once the snapshot is safely on disk.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = Path(path)
+        self.rotated_path = self.path.with_name(self.path.name + ".1")
+        self.fsync = fsync
+        self.records = self._count(self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _count(self, path):
+        if not path.exists():
+            return 0
+        with open(path, "rb") as f:
+            return sum(1 for _ in f)
+
+    def _write(self, record, fsync):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+        self.records += 1
+
+    def append(self, game_id, ply, move):
+        self._write({"game_id": game_id, "ply": ply, "move": move}, self.fsync)
+
+    def append_finish(self, game_id, winner, ratings, deviations, finished_at):
+        record = {"game_id": game_id, "finish": winner, "ratings": ratings, "deviations": deviations, "finished_at": finished_at}
+        self._write(record, False)
+        return os.dup(self._file.fileno())
+
+    @staticmethod
+    def sync(handle):
+        """Fsync and close a handle returned by ``append_finish``."""
+        try:
+            os.fsync(handle)
+        finally:
+            os.close(handle)
+
+    def replay(self):
+        for path in (self.rotated_path, self.path):
+            if not path.exists():
+                continue
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn final line from a crash mid-write.
+                        break
+
+    def rotate(self):
+        self._file.close()
+        if self.rotated_path.exists():
+            # The previous snapshot never made it to disk; keep its records.
+            with open(self.rotated_path, "ab") as rotated, open(self.path, "rb") as current:
+                rotated.write(current.read())
+            self.path.unlink()
+        elif self.path.exists():
+            os.replace(self.path, self.rotated_path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self.records = 0
+
+    def discard_rotated(self):
+        self.rotated_path.unlink(missing_ok=True)
+
+    def close(self):
+        self._file.close()
+
+
+def replay_into(games, journal, users=None):
+    """Apply journaled moves to the ``board_fen`` and move list of the loaded games.
+
+    A record is applied only when its ply matches the board's current ply, so
+    moves already contained in the snapshot are skipped. Finish records mark
+    the game completed and set the stored ratings in ``users``; both are
+    absolute values, so replaying them twice is harmless. Returns the number
+    of records applied.
+    """
+    boards = {}
+    applied = 0
+    for record in journal.replay():
+        game = games.get(record["game_id"])
+        if "finish" in record:
+            if game is not None:
+                game["status"] = "completed"
+                game["winner"] = record["finish"]
+                game["ratings"] = record["ratings"]
+                if "finished_at" in record:
+                    game["finished_at"] = record["finished_at"]
+            for username, rating in record["ratings"].items():
+                if users is not None and username in users:
+                    users[username]["rating"] = rating
+                    users[username].update(record.get("deviations", {}).get(username, {}))
+            applied += 1
+            continue
+        if game is None:
+            continue
+        board = boards.get(record["game_id"])
+        if board is None:
+            board = boards[record["game_id"]] = chess.Board(game["board_fen"] or None)
+        if record["ply"] != board.ply():
+            continue
+        try:
+            board.push_uci(record["move"])
+        except ValueError:
+            continue
+        moves = game.setdefault("moves", [])
+        if len(moves) == record["ply"]:
+            moves.append(record["move"])
+        applied += 1
+
+    for game_id, board in boards.items():
+        games[game_id]["board_fen"] = board.fen()
+    return applied
@@ -0,0 +1,56 @@
+import bcrypt
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+class ServerBusy(Exception):
+    pass
+
+
+def _hash(password):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+
+
+def _verify(password, hashed):
+    try:
+        return bcrypt.checkpw(password.encode(), hashed.encode())
+    except ValueError:
+        return False
+
+
+class PasswordHasher:
+    """Runs bcrypt on a dedicated thread pool instead of the reactor thread.
+
+    bcrypt releases the GIL while hashing, so up to ``max_workers`` hashes run
+    in parallel. At most ``max_pending`` requests (running or waiting) are
+    accepted; beyond that ``hash``/``verify`` raise ``ServerBusy`` right away.
+    """
+
+    def __init__(self, max_workers=4, max_pending=64):
+        self.max_pending = max_pending
+        self.pending = 0
+        self._pool = ThreadPool(minthreads=1, maxthreads=max_workers, name="password-hasher")
+        self._pool.start()
+
+    def _submit(self, func, *args):
+        if self.pending >= self.max_pending:
+            raise ServerBusy()
+        self.pending += 1
+        d = deferToThreadPool(reactor, self._pool, func, *args)
+        d.addBoth(self._done)
+        return d
+
+    def _done(self, result):
+        self.pending -= 1
+        return result
+
+    def hash(self, password):
+        return self._submit(_hash, password)
+
+    def verify(self, password, hashed):
+        return self._submit(_verify, password, hashed)
+
+    def close(self):
+        if self._pool.started:
+            self._pool.stop()
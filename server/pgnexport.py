@@ -0,0 +1,80 @@
+"""PGN export of finished games.
+
+``export`` pulls games from the storage backend's ``iter_games`` and writes
+each one as soon as it is formatted, so exporting a player with tens of
+thousands of games keeps a single game in memory at a time.
+"""
+import argparse
+import datetime
+
+import chess
+import chess.pgn
+
+RESULTS = {"white": "1-0", "black": "0-1", "draw": "1/2-1/2"}
+
+
+def game_pgn(game):
+    board = chess.Board()
+    for move in game.get("moves", ()):
+        try:
+            board.push_uci(move)
+        except ValueError:
+            break
+    pgn = chess.pgn.Game.from_board(board)
+    pgn.headers["Event"] = "Online game"
+    pgn.headers["Site"] = "Chess Multiplayer"
+    if game.get("finished_at"):
+        pgn.headers["Date"] = datetime.datetime.fromtimestamp(game["finished_at"], datetime.timezone.utc).strftime("%Y.%m.%d")
+    pgn.headers["Round"] = game["game_id"]
+    pgn.headers["White"] = game["white"]
+    pgn.headers["Black"] = game["black"]
+    pgn.headers["Result"] = RESULTS.get(game.get("winner"), "*")
+    return str(pgn) + "\n\n"
+
+
+async def export(chdata, out, username=None, since=None, until=None):
+    """Write every matching completed game to ``out``; returns how many."""
+    count = 0
+    async for game in chdata.iter_games(username, since, until):
+        out.write(game_pgn(game))
+        count += 1
+    return count
+
+
+def _timestamp(date):
+    return datetime.datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def main():
+    import sys
+
+    from twisted.internet import task
+    from twisted.internet.defer import ensureDeferred
+
+    import config
+    from chessdatabase import create_database
+
+    parser = argparse.ArgumentParser(description="Export finished games as PGN.")
+    parser.add_argument("--player", help="only games of this player")
+    parser.add_argument("--since", type=_timestamp, help="first day, YYYY-MM-DD (UTC)")
+    parser.add_argument("--until", type=_timestamp, help="day after the last one, YYYY-MM-DD (UTC)")
+    parser.add_argument("-o", "--output", help="output file, stdout by default")
+    args = parser.parse_args()
+
+    async def run(reactor):
+        # With the JSON backend, run it while the server is stopped.
+        chdata = create_database(config.DB_BACKEND, config.DB_PATH)
+        out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+        try:
+            count = await export(chdata, out, args.player, args.since, args.until)
+        finally:
+            chdata.close()
+            if args.output:
+                out.close()
+        print(f"Exported {count} games", file=sys.stderr)
+
+    task.react(lambda reactor: ensureDeferred(run(reactor)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+from collections import Counter, OrderedDict
+
+import chess
+
+POSITION_CACHE_SIZE = 20000
+
+
+def position_key(board):
+    """Identity of a position for legality and repetition purposes.
+
+    Pieces, side to move, castling rights and a capturable en passant
+    square, as in python-chess's own repetition detection, built from the
+    public bitboards. That costs about a microsecond; ``board.epd()`` and
+    ``chess.polyglot.zobrist_hash`` make validating a move several times
+    slower and cost the engine a tenth of its search speed.
+    """
+    return (
+        board.pawns,
+        board.knights,
+        board.bishops,
+        board.rooks,
+        board.queens,
+        board.kings,
+        board.occupied_co[chess.WHITE],
+        board.occupied_co[chess.BLACK],
+        board.turn,
+        board.clean_castling_rights(),
+        board.ep_square if board.has_legal_en_passant() else None,
+    )
+
+
+class Position:
+    """What can be said about a position without knowing how it was reached."""
+
+    __slots__ = ("legal_moves", "termination", "winner")
+
+    def __init__(self, board):
+        self.legal_moves = frozenset(board.generate_legal_moves())
+        self.termination = None
+        self.winner = None
+        # Same precedence as Board.outcome().
+        if not self.legal_moves and board.is_check():
+            self.termination = chess.Termination.CHECKMATE
+            self.winner = not board.turn
+        elif board.is_insufficient_material():
+            self.termination = chess.Termination.INSUFFICIENT_MATERIAL
+        elif not self.legal_moves:
+            self.termination = chess.Termination.STALEMATE
+
+
+class PositionCache:
+    """Bounded LRU of ``Position`` entries shared by every live game.
+
+    Games mostly walk through the same openings, so move validation and the
+    checkmate/stalemate checks after each move are answered from here
+    instead of generating legal moves again. Facts that depend on the game's
+    history (move counters, repetitions) are checked per game in
+    ``outcome``.
+    """
+
+    def __init__(self, size=POSITION_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, board, key=None):
+        if key is None:
+            key = position_key(board)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        entry = Position(board)
+        if self.size > 0:
+            self.entries[key] = entry
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def outcome(self, board, repetitions):
+        """``board.outcome()``, using the cache and a repetition count.
+
+        Only results that end a game by themselves count: threefold
+        repetition and the fifty-move rule are draws a player has to claim
+        (see ``claimable_draw``). ``repetitions`` counts the positions
+        reached since the last irreversible move, current one included (see
+        ``Repetitions``).
+        """
+        key = position_key(board)
+        entry = self.lookup(board, key)
+        if entry.termination is not None:
+            return chess.Outcome(entry.termination, entry.winner)
+        if board.is_seventyfive_moves():
+            return chess.Outcome(chess.Termination.SEVENTYFIVE_MOVES, None)
+        if repetitions.counts[key] >= 5:
+            return chess.Outcome(chess.Termination.FIVEFOLD_REPETITION, None)
+        return None
+
+
+def claimable_draw(board, repetitions):
+    """The draw a player may claim in the position on ``board``, if any.
+
+    Unlike ``Board.can_claim_draw`` this does not look at moves that could
+    still be played: a claim that comes with its move is checked after the
+    move is made.
+    """
+    if board.halfmove_clock >= 100:
+        return chess.Outcome(chess.Termination.FIFTY_MOVES, None)
+    if repetitions.counts[position_key(board)] >= 3:
+        return chess.Outcome(chess.Termination.THREEFOLD_REPETITION, None)
+    return None
+
+
+class Repetitions:
+    """Positions seen since a game's last irreversible move.
+
+    Kept up to date move by move, so checking for a repetition does not have
+    to pop the move stack back to the last capture or pawn move the way
+    ``Board.is_repetition`` does.
+    """
+
+    __slots__ = ("counts",)
+
+    def __init__(self, board):
+        self.counts = Counter((position_key(board),))
+
+    def record(self, board, irreversible):
+        """Count ``board`` after a move; ``irreversible`` is ``board.is_irreversible(move)``."""
+        if irreversible:
+            self.counts.clear()
+        self.counts[position_key(board)] += 1
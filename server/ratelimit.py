@@ -0,0 +1,63 @@
+from twisted.internet import reactor
+
+# Message type -> (tokens per second, burst). "*" applies to every frame.
+LIMITS = {
+    "*": (30.0, 60),
+    "register": (0.2, 3),
+    "login": (0.5, 5),
+    "find_game": (0.5, 3),
+    "move": (10.0, 20),
+    "claim_draw": (1.0, 5),
+    "watch_game": (2.0, 10),
+    "unwatch_game": (2.0, 10),
+    "game_history": (2.0, 10),
+    "export_pgn": (1.0, 5),
+    "rank": (2.0, 10),
+    "leaderboard": (2.0, 10),
+}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
+class RateLimiter:
+    """Token buckets for one connection: one shared by all frames, one per type.
+
+    Buckets are created on first use, so a connection only pays for the
+    message types it actually sends.
+    """
+
+    def __init__(self, limits=LIMITS, clock=reactor):
+        self.limits = limits
+        self.clock = clock
+        self.buckets = {}
+
+    def _take(self, key):
+        now = self.clock.seconds()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits[key]
+            bucket = self.buckets[key] = TokenBucket(rate, burst, now)
+        return bucket.take(now)
+
+    def allow_frame(self):
+        return "*" not in self.limits or self._take("*")
+
+    def allow(self, message_type):
+        return message_type not in self.limits or self._take(message_type)
@@ -0,0 +1,274 @@
+"""Glicko-2 ratings.
+
+A player's state is a dict with ``rating``, ``rd`` (rating deviation) and
+``volatility``. The server rates each finished game on its own as a
+one-game rating period (``game_deltas``), which costs a few floating point
+operations. ``recompute`` rebuilds every player's state from the whole game
+history with proper rating periods; with NumPy installed each period is a
+handful of array operations over all games in it, without NumPy it falls
+back to a plain loop.
+
+    python ratings.py recompute --period-days 7
+
+See Glickman, "Example of the Glicko-2 system" for the formulas.
+"""
+import argparse
+import math
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_RATING = 1200
+DEFAULT_RD = 350.0
+DEFAULT_VOLATILITY = 0.06
+TAU = 0.5
+PERIOD_DAYS = 7
+
+# Glicko-2 works on a scale centred on 1500 and divided by this factor.
+SCALE = 173.7178
+CENTER = 1500
+EPSILON = 1e-6
+MAX_ITERATIONS = 100
+
+WINNER_SCORES = {"white": 1.0, "black": 0.0, "draw": 0.5}
+
+
+def new_rating(rating=DEFAULT_RATING):
+    return {"rating": rating, "rd": DEFAULT_RD, "volatility": DEFAULT_VOLATILITY}
+
+
+def _g(phi):
+    return 1 / math.sqrt(1 + 3 * phi * phi / (math.pi * math.pi))
+
+
+def _volatility(phi, sigma, v, delta, tau=TAU):
+    """New volatility by the Illinois variant of regula falsi (step 5)."""
+    a = math.log(sigma * sigma)
+    phi2 = phi * phi
+    delta2 = delta * delta
+
+    def f(x):
+        ex = math.exp(x)
+        return ex * (delta2 - phi2 - v - ex) / (2 * (phi2 + v + ex) ** 2) - (x - a) / (tau * tau)
+
+    big_a = a
+    if delta2 > phi2 + v:
+        big_b = math.log(delta2 - phi2 - v)
+    else:
+        k = 1
+        while f(a - k * tau) < 0:
+            k += 1
+        big_b = a - k * tau
+    f_a, f_b = f(big_a), f(big_b)
+    for _ in range(MAX_ITERATIONS):
+        if abs(big_b - big_a) <= EPSILON:
+            break
+        big_c = big_a + (big_a - big_b) * f_a / (f_b - f_a)
+        f_c = f(big_c)
+        if f_c * f_b <= 0:
+            big_a, f_a = big_b, f_b
+        else:
+            f_a /= 2
+        big_b, f_b = big_c, f_c
+    return math.exp(big_a / 2)
+
+
+def rate(player, results, tau=TAU):
+    """Rate one player over one period; ``results`` is [(opponent, score), ...]."""
+    mu = (player["rating"] - CENTER) / SCALE
+    phi = player["rd"] / SCALE
+    sigma = player["volatility"]
+    if not results:
+        return {"rating": player["rating"], "rd": min(math.sqrt(phi * phi + sigma * sigma) * SCALE, DEFAULT_RD),
+                "volatility": sigma}
+
+    v_inv = 0.0
+    improvement = 0.0
+    for opponent, score in results:
+        g = _g(opponent["rd"] / SCALE)
+        expected = 1 / (1 + math.exp(-g * (mu - (opponent["rating"] - CENTER) / SCALE)))
+        v_inv += g * g * expected * (1 - expected)
+        improvement += g * (score - expected)
+    v = 1 / v_inv
+
+    sigma = _volatility(phi, sigma, v, v * improvement, tau)
+    phi_star = math.sqrt(phi * phi + sigma * sigma)
+    phi = 1 / math.sqrt(1 / (phi_star * phi_star) + v_inv)
+    mu += phi * phi * improvement
+    return {"rating": mu * SCALE + CENTER, "rd": phi * SCALE, "volatility": sigma}
+
+
+def game_deltas(white, black, winner, tau=TAU):
+    """Incremental update for one finished game, as deltas for ``finish_game``."""
+    score = WINNER_SCORES[winner]
+    new_white = rate(white, [(black, score)], tau)
+    new_black = rate(black, [(white, 1 - score)], tau)
+    return _delta(white, new_white), _delta(black, new_black)
+
+
+def _delta(before, after):
+    return {key: after[key] - before[key] for key in ("rating", "rd", "volatility")}
+
+
+def _periods(games, period):
+    """Group games into consecutive rating periods of ``period`` seconds.
+
+    Games without a finish time (recorded before it was stored) all fall
+    into the first period.
+    """
+    grouped = defaultdict(list)
+    for game in games:
+        if game.get("winner") not in WINNER_SCORES:
+            continue
+        finished_at = game.get("finished_at")
+        grouped[int(finished_at // period) if finished_at else -1].append(game)
+    return [grouped[key] for key in sorted(grouped)]
+
+
+def recompute(games, period_days=PERIOD_DAYS, initial=None, tau=TAU):
+    """Rate all players from scratch over ``games`` in finish order.
+
+    ``initial`` maps usernames to starting states (default ``new_rating()``).
+    Returns {username: state} for every player that appears in the games or
+    in ``initial``; ratings are rounded to integers as stored.
+    """
+    periods = _periods(games, period_days * 86400)
+    players = {}
+    for username in initial or ():
+        players.setdefault(username, len(players))
+    for period in periods:
+        for game in period:
+            players.setdefault(game["white"], len(players))
+            players.setdefault(game["black"], len(players))
+
+    start = [dict((initial or {}).get(username) or new_rating()) for username in players]
+    run = _recompute_numpy if np is not None else _recompute_python
+    states = run(players, start, periods, tau)
+    for state in states.values():
+        state["rating"] = round(state["rating"])
+    return states
+
+
+def _recompute_python(players, start, periods, tau):
+    states = dict(zip(players, start))
+    for period in periods:
+        results = defaultdict(list)
+        for game in period:
+            score = WINNER_SCORES[game["winner"]]
+            results[game["white"]].append((states[game["black"]], score))
+            results[game["black"]].append((states[game["white"]], 1 - score))
+        states = {username: rate(state, results.get(username, ()), tau) for username, state in states.items()}
+    return states
+
+
+def _volatility_numpy(phi, sigma, v, delta, tau):
+    """Vectorized ``_volatility``: every player converges independently."""
+    a = np.log(sigma * sigma)
+    phi2 = phi * phi
+    delta2 = delta * delta
+
+    def f(x):
+        ex = np.exp(x)
+        return ex * (delta2 - phi2 - v - ex) / (2 * (phi2 + v + ex) ** 2) - (x - a) / (tau * tau)
+
+    big = delta2 > phi2 + v
+    big_a = a
+    big_b = np.where(big, np.log(np.where(big, delta2 - phi2 - v, 1.0)), a - tau)
+    f_b = f(big_b)
+    low = ~big & (f_b < 0)
+    while low.any():
+        big_b = np.where(low, big_b - tau, big_b)
+        f_b = f(big_b)
+        low &= f_b < 0
+    f_a = f(big_a)
+    for _ in range(MAX_ITERATIONS):
+        active = np.abs(big_b - big_a) > EPSILON
+        if not active.any():
+            break
+        big_c = np.where(active, big_a + (big_a - big_b) * f_a / np.where(active, f_b - f_a, 1.0), big_b)
+        f_c = f(big_c)
+        swap = active & (f_c * f_b <= 0)
+        big_a = np.where(swap, big_b, big_a)
+        f_a = np.where(swap, f_b, np.where(active, f_a / 2, f_a))
+        big_b = np.where(active, big_c, big_b)
+        f_b = np.where(active, f_c, f_b)
+    return np.exp(big_a / 2)
+
+
+def _recompute_numpy(players, start, periods, tau):
+    count = len(players)
+    mu = np.array([(state["rating"] - CENTER) / SCALE for state in start], dtype=float)
+    phi = np.array([state["rd"] / SCALE for state in start], dtype=float)
+    sigma = np.array([state["volatility"] for state in start], dtype=float)
+    max_phi = DEFAULT_RD / SCALE
+
+    for period in periods:
+        white = np.fromiter((players[game["white"]] for game in period), dtype=np.intp, count=len(period))
+        black = np.fromiter((players[game["black"]] for game in period), dtype=np.intp, count=len(period))
+        score = np.fromiter((WINNER_SCORES[game["winner"]] for game in period), dtype=float, count=len(period))
+
+        # Every game seen from both sides.
+        me = np.concatenate((white, black))
+        them = np.concatenate((black, white))
+        score = np.concatenate((score, 1 - score))
+
+        g = 1 / np.sqrt(1 + 3 * phi[them] ** 2 / math.pi ** 2)
+        expected = 1 / (1 + np.exp(-g * (mu[me] - mu[them])))
+        v_inv = np.bincount(me, g * g * expected * (1 - expected), minlength=count)
+        improvement = np.bincount(me, g * (score - expected), minlength=count)
+
+        played = v_inv > 0
+        v = 1 / v_inv[played]
+        new_sigma = sigma.copy()
+        new_sigma[played] = _volatility_numpy(phi[played], sigma[played], v, v * improvement[played], tau)
+
+        phi_star = np.sqrt(phi * phi + new_sigma * new_sigma)
+        new_phi = np.minimum(phi_star, max_phi)
+        new_phi[played] = 1 / np.sqrt(1 / phi_star[played] ** 2 + v_inv[played])
+        mu = mu + np.where(played, new_phi * new_phi * improvement, 0.0)
+        phi, sigma = new_phi, new_sigma
+
+    return {
+        username: {"rating": float(mu[i] * SCALE + CENTER), "rd": float(phi[i] * SCALE), "volatility": float(sigma[i])}
+        for username, i in players.items()
+    }
+
+
+async def recompute_database(chdata, period_days=PERIOD_DAYS):
+    games = await chdata.get_completed_games()
+    # Everyone starts over, including players with no rated games.
+    users = await chdata.get_ratings()
+    states = recompute(games, period_days, {username: new_rating() for username in users})
+    await chdata.set_ratings(states)
+    return len(games), len(states)
+
+
+def main():
+    from twisted.internet import task
+    from twisted.internet.defer import ensureDeferred
+
+    import config
+    from chessdatabase import create_database
+
+    parser = argparse.ArgumentParser(description="Glicko-2 rating tools.")
+    parser.add_argument("command", choices=["recompute"])
+    parser.add_argument("--period-days", type=float, default=PERIOD_DAYS, help="length of a rating period")
+    args = parser.parse_args()
+
+    async def run(reactor):
+        # Run with the server stopped: the JSON backend keeps users in memory.
+        chdata = create_database(config.DB_BACKEND, config.DB_PATH)
+        try:
+            games, players = await recompute_database(chdata, args.period_days)
+        finally:
+            chdata.close()
+        print(f"Rated {players} players over {games} games")
+
+    task.react(lambda reactor: ensureDeferred(run(reactor)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Structured JSON-lines logging that stays off the reactor thread.
+
+Log calls only build a record and put it on a bounded queue; a listener
+thread formats it and writes it to a size-rotated file. When the queue is
+full the record is dropped and counted instead of blocking the reactor.
+
+Received messages are logged per type with sampling (``move=100`` keeps one
+in a hundred). Full payload dumps are DEBUG level and can be switched on and
+off at runtime with ``kill -USR1 <pid>``.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import signal
+import sys
+from collections import defaultdict
+
+QUEUE_SIZE = 10000
+REDACTED_FIELDS = ("password", "token")
+
+logger = logging.getLogger("chess")
+logger.propagate = False
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": round(record.created, 3), "level": record.levelname, "event": record.getMessage()}
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update((key, value) for key, value in fields.items() if value is not None)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread, dropping them when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class Sampler:
+    """Keeps one in every N records of a message type; types without a rate keep all."""
+
+    def __init__(self, rates=None):
+        self.rates = rates or {}
+        self.seen = defaultdict(int)
+
+    def keep(self, message_type):
+        every = self.rates.get(message_type)
+        if not every or every <= 1:
+            return True
+        count = self.seen[message_type]
+        self.seen[message_type] = count + 1
+        return count % every == 0
+
+
+def parse_rates(spec):
+    """``"move=100,update=100"`` -> {"move": 100, "update": 100}"""
+    rates = {}
+    for part in filter(None, (item.strip() for item in spec.split(","))):
+        message_type, _, every = part.partition("=")
+        rates[message_type.strip()] = int(every)
+    return rates
+
+
+sampler = Sampler()
+_handler = None
+_listener = None
+_level = logging.INFO
+
+
+def setup(path="", max_bytes=10 * 1024 * 1024, backups=5, level="INFO", sample=""):
+    """Start the writer thread. An empty ``path`` writes JSON lines to stdout."""
+    global _handler, _listener, _level
+    if path:
+        output = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    else:
+        output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+
+    _handler = NonBlockingQueueHandler(queue.Queue(QUEUE_SIZE))
+    _listener = logging.handlers.QueueListener(_handler.queue, output)
+    _listener.start()
+    logger.addHandler(_handler)
+    _level = logging.getLevelName(level.upper())
+    logger.setLevel(_level)
+    sampler.rates = parse_rates(sample)
+
+
+def shutdown():
+    """Flush everything still queued and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped():
+    return _handler.dropped if _handler else 0
+
+
+def toggle_debug(*_):
+    debug = logger.level != logging.DEBUG
+    logger.setLevel(logging.DEBUG if debug else _level)
+    info("debug logging", enabled=debug)
+
+
+def install_debug_toggle():
+    # Windows has no SIGUSR1; the level can only be set at startup there.
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, toggle_debug)
+
+
+def log(level, event, exc_info=False, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+
+def debug(event, **fields):
+    log(logging.DEBUG, event, **fields)
+
+
+def info(event, **fields):
+    log(logging.INFO, event, **fields)
+
+
+def warning(event, **fields):
+    log(logging.WARNING, event, **fields)
+
+
+def error(event, exc_info=False, **fields):
+    log(logging.ERROR, event, exc_info, **fields)
+
+
+def redact(message):
+    return {key: "***" if key in REDACTED_FIELDS else value for key, value in message.items()}
+
+
+def received(message, session=None):
+    """Log one incoming message: the whole payload at DEBUG, sampled per type at INFO."""
+    message_type = message.get("type")
+    if logger.isEnabledFor(logging.DEBUG):
+        debug("message", type=message_type, session=session, game_id=message.get("game_id"), payload=redact(message))
+    elif sampler.keep(message_type):
+        info("message", type=message_type, session=session, game_id=message.get("game_id"))
@@ -0,0 +1,148 @@
+import hmac
+import secrets
+import uuid
+from collections import defaultdict
+
+from twisted.internet import reactor
+
+SESSION_TTL = 3600
+TOKEN_LENGTH = 32
+
+
+class Session:
+    __slots__ = ("session_id", "username", "token", "connection", "expires_at")
+
+    def __init__(self, session_id, username, token, connection, expires_at):
+        self.session_id = session_id
+        self.username = username
+        self.token = token
+        self.connection = connection
+        self.expires_at = expires_at
+
+
+class SessionRegistry:
+    """Logged-in sessions indexed by id, by connection and by username.
+
+    Every lookup the protocol needs is a dictionary access. Sessions expire
+    ``ttl`` seconds after their last successful authentication; ``expire``
+    drops them in bulk and is meant to be called periodically.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, clock=reactor):
+        self.ttl = ttl
+        self.clock = clock
+        self.by_id = {}
+        self.by_connection = {}
+        self.by_username = defaultdict(set)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self, session_id):
+        return session_id in self.by_id
+
+    def create(self, username, connection):
+        return self.adopt(str(uuid.uuid4()), username, secrets.token_hex(TOKEN_LENGTH), connection)
+
+    def adopt(self, session_id, username, token, connection):
+        """Register a session under a given id and token, e.g. one handed over by another worker.
+
+        ``connection`` may be None for a session whose player is away.
+        """
+        previous = self.by_connection.get(connection)
+        if previous is not None:
+            self.remove(previous.session_id)
+        session = Session(session_id, username, token, connection, self.clock.seconds() + self.ttl)
+        self.by_id[session_id] = session
+        if connection is not None:
+            self.by_connection[connection] = session
+        self.by_username[username].add(session_id)
+        return session
+
+    def get(self, session_id):
+        return self.by_id.get(session_id)
+
+    def for_connection(self, connection):
+        return self.by_connection.get(connection)
+
+    def connection(self, session_id):
+        session = self.by_id.get(session_id)
+        return session.connection if session else None
+
+    def authenticate(self, username, token, connection):
+        session = self.by_connection.get(connection)
+        if session is None or session.username != username or not isinstance(token, str):
+            return None
+        if not hmac.compare_digest(session.token.encode(), token.encode()):
+            return None
+        now = self.clock.seconds()
+        if session.expires_at < now:
+            return None
+        session.expires_at = now + self.ttl
+        return session
+
+    def find(self, username, token):
+        """The unexpired session of ``username`` with this token, on any connection."""
+        if not isinstance(token, str):
+            return None
+        now = self.clock.seconds()
+        for session_id in self.by_username.get(username, ()):
+            session = self.by_id[session_id]
+            if session.expires_at >= now and hmac.compare_digest(session.token.encode(), token.encode()):
+                return session
+        return None
+
+    def attach(self, session, connection):
+        """Move ``session`` onto ``connection``, e.g. after the client reconnected."""
+        if session.connection is not None and self.by_connection.get(session.connection) is session:
+            del self.by_connection[session.connection]
+        current = self.by_connection.get(connection)
+        if current is not None and current is not session:
+            self.remove(current.session_id)
+        session.connection = connection
+        session.expires_at = self.clock.seconds() + self.ttl
+        self.by_connection[connection] = session
+
+    def detach(self, connection):
+        """Unbind the session from a closed connection, keeping it for a resume."""
+        session = self.by_connection.pop(connection, None)
+        if session is not None:
+            session.connection = None
+        return session
+
+    def remove(self, session_id):
+        session = self.by_id.pop(session_id, None)
+        if session is None:
+            return None
+        if self.by_connection.get(session.connection) is session:
+            del self.by_connection[session.connection]
+        sessions = self.by_username.get(session.username)
+        if sessions is not None:
+            sessions.discard(session_id)
+            if not sessions:
+                del self.by_username[session.username]
+        return session
+
+    def expiring(self):
+        """Sessions ``expire`` would look at now, left in place."""
+        now = self.clock.seconds()
+        return [session for session in self.by_id.values() if session.expires_at < now]
+
+    def expire(self, keep=None):
+        """Remove and return expired sessions; ``keep(session)`` can spare some."""
+        now = self.clock.seconds()
+        expired = []
+        for session in list(self.by_id.values()):
+            if session.expires_at >= now:
+                continue
+            if keep is not None and keep(session):
+                session.expires_at = now + self.ttl
+                continue
+            self.remove(session.session_id)
+            expired.append(session)
+        return expired
+
+    def clear(self):
+        self.by_id.clear()
+        self.by_connection.clear()
+        self.by_username.clear()
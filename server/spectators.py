@@ -0,0 +1,174 @@
+from collections import defaultdict
+
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+RECENT_MOVES = 20
+MAX_MISSED = 200
+
+
+def netstring(data):
+    return b"%d:%s," % (len(data), data)
+
+
+def fan_out(connections, message, frames=None):
+    """Send ``message`` to every connection, encoding it once per codec.
+
+    Local protocols get the same framed bytes written straight to their
+    transport; anything else (a RemoteConnection) gets ``send_message``.
+    """
+    if frames is None:
+        frames = {}
+    for conn in connections:
+        transport = getattr(conn, "transport", None)
+        if transport is None:
+            conn.send_message(message)
+            continue
+        frame = frames.get(conn.codec)
+        if frame is None:
+            frame = frames[conn.codec] = netstring(conn.encode(message))
+        transport.write(frame)
+
+
+@implementer(IPushProducer)
+class Observer:
+    """A spectating connection, registered as the producer for its transport.
+
+    The transport pauses us once its write buffer is full. While paused,
+    updates are not queued; only the games that changed are remembered, and
+    on resume each of them is brought up to date with a single snapshot.
+    A spectator that misses more than ``MAX_MISSED`` updates stops watching.
+    """
+
+    def __init__(self, hub, connection):
+        self.hub = hub
+        self.connection = connection
+        self.games = set()
+        self.paused = False
+        self.stale = set()
+        self.missed = 0
+        self.dropped = False
+        self.remote = getattr(connection, "transport", None) is None
+        if not self.remote:
+            connection.transport.registerProducer(self, True)
+
+    def deliver(self, game_id, message, frames):
+        if not self.paused:
+            fan_out((self.connection,), message, frames)
+            return
+        self.stale.add(game_id)
+        self.missed += 1
+        if self.missed > MAX_MISSED:
+            self.dropped = True
+            self.hub.drop(self.connection)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        stale, self.stale = self.stale, set()
+        self.missed = 0
+        if self.dropped:
+            self.connection.send_message({"type": "error", "reason": "Stopped watching: connection too slow"})
+            self.unregister()
+            return
+        for game_id in stale:
+            self.hub.send_snapshot(self, game_id)
+
+    def stopProducing(self):
+        self.hub.drop(self.connection)
+
+    def unregister(self):
+        if not self.remote and self.connection.transport.producer is self:
+            self.connection.transport.unregisterProducer()
+
+
+class SpectatorHub:
+    """Who is watching which live game.
+
+    Late joiners receive a ``game_snapshot`` with the position and the last
+    ``RECENT_MOVES`` moves rather than the whole history.
+    """
+
+    def __init__(self):
+        self.games = {}
+        self.watchers = defaultdict(set)
+        self.observers = {}
+
+    def __len__(self):
+        return len(self.observers)
+
+    def watch(self, connection, game):
+        observer = self.observers.get(connection)
+        if observer is None or observer.dropped:
+            observer = self.observers[connection] = Observer(self, connection)
+        observer.games.add(game.game_id)
+        self.games[game.game_id] = game
+        self.watchers[game.game_id].add(observer)
+        self.send_snapshot(observer, game.game_id)
+
+    def unwatch(self, connection, game_id):
+        observer = self.observers.get(connection)
+        if observer is None or game_id not in observer.games:
+            return False
+        observer.games.discard(game_id)
+        observer.stale.discard(game_id)
+        self._discard_watcher(game_id, observer)
+        if not observer.games:
+            del self.observers[connection]
+            observer.unregister()
+        return True
+
+    def drop(self, connection):
+        """Stop everything ``connection`` watches; its producer stays until resumed."""
+        observer = self.observers.pop(connection, None)
+        if observer is None:
+            return
+        for game_id in observer.games:
+            self._discard_watcher(game_id, observer)
+        observer.games.clear()
+        if not observer.dropped:
+            observer.unregister()
+
+    def _discard_watcher(self, game_id, observer):
+        watchers = self.watchers.get(game_id)
+        if watchers is None:
+            return
+        watchers.discard(observer)
+        if not watchers:
+            del self.watchers[game_id]
+            self.games.pop(game_id, None)
+
+    def send_snapshot(self, observer, game_id):
+        game = self.games.get(game_id)
+        if game is None:
+            return
+        snapshot = {
+            "type": "game_snapshot",
+            "game_id": game_id,
+            "board": game.board.fen(),
+            "white": game.white,
+            "black": game.black,
+            "moves": game.recent_moves(RECENT_MOVES),
+        }
+        if game.clock is not None:
+            snapshot.update(game.clock.as_message(reactor.seconds()))
+        observer.connection.send_message(snapshot)
+
+    def broadcast(self, game_id, message):
+        frames = {}
+        for observer in list(self.watchers.get(game_id, ())):
+            observer.deliver(game_id, message, frames)
+
+    def close_game(self, game_id, message):
+        """Send the final message for a game and forget its spectators.
+
+        The result is queued even for paused spectators: unlike a position,
+        it cannot be caught up on from a later snapshot.
+        """
+        frames = {}
+        for observer in list(self.watchers.get(game_id, ())):
+            fan_out((observer.connection,), message, frames)
+            self.unwatch(observer.connection, game_id)
@@ -0,0 +1,212 @@
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.protocols.basic import NetstringReceiver
+
+import wirecodec
+from gameregistry import GameRegistry
+from sessionregistry import SessionRegistry
+
+
+class StateClientProtocol(NetstringReceiver):
+    MAX_LENGTH = 1024 * 1024
+
+    def connectionMade(self):
+        self.factory.resetDelay()
+        self.factory.client.connected(self)
+
+    def connectionLost(self, reason):
+        self.factory.client.disconnected(self)
+
+    def stringReceived(self, data):
+        try:
+            message = wirecodec.decode(data)
+        except wirecodec.CodecError as e:
+            print(f"Dropping malformed frame from state service: {e}")
+            return
+        handler = self.factory.client.handlers.get(message["type"])
+        if handler is None:
+            print(f"Unknown state message: {message['type']}")
+            return
+        handler(message)
+
+
+class StateClientFactory(ReconnectingClientFactory):
+    protocol = StateClientProtocol
+    maxDelay = 5
+
+    def __init__(self, client):
+        self.client = client
+
+
+class StateClient:
+    """A worker's connection to the shared state service.
+
+    Messages sent while disconnected are queued and flushed on connect;
+    ``on_connect`` callbacks re-announce local state after a reconnect.
+    """
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.protocol = None
+        self.pending = []
+        self.handlers = {}
+        self.on_connect = []
+
+    def connect(self, socket_path):
+        reactor.connectUNIX(socket_path, StateClientFactory(self))
+
+    def on(self, message_type, handler):
+        self.handlers[message_type] = handler
+
+    def connected(self, protocol):
+        self.protocol = protocol
+        self.send({"type": "register_worker", "worker_id": self.worker_id})
+        for callback in self.on_connect:
+            callback()
+        pending, self.pending = self.pending, []
+        for message in pending:
+            self.send(message)
+
+    def disconnected(self, protocol):
+        if self.protocol is protocol:
+            self.protocol = None
+
+    def send(self, message):
+        if self.protocol is None:
+            self.pending.append(message)
+        else:
+            self.protocol.sendString(wirecodec.encode(message))
+
+
+class RemoteConnection:
+    """Stands in for the connection of a player logged in on another worker."""
+
+    __slots__ = ("client", "session_id")
+
+    def __init__(self, client, session_id):
+        self.client = client
+        self.session_id = session_id
+
+    def __eq__(self, other):
+        return isinstance(other, RemoteConnection) and other.session_id == self.session_id
+
+    def __hash__(self):
+        return hash(self.session_id)
+
+    def send_message(self, message):
+        self.client.send({"type": "route", "session_id": self.session_id, "message": message})
+
+
+class RemoteMatchmaker:
+    """Matchmaker API backed by the single queue in the state service.
+
+    A match may already be on its way when a player cancels, so a cancel is
+    only settled when the service confirms it (see ``StateService``).
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.waiting = {}
+        # Session id -> (its enqueue Deferred, Deferred returned by cancel).
+        self.cancelling = {}
+        client.on("mm_result", self._result)
+        client.on("mm_cancelled", self._cancelled)
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def __contains__(self, session_id):
+        return session_id in self.waiting
+
+    def enqueue(self, username, session_id, rating):
+        self.cancel(session_id)
+        d = Deferred()
+        self.waiting[session_id] = d
+        self.client.send({"type": "mm_enqueue", "username": username, "session_id": session_id, "rating": rating})
+        return d
+
+    def cancel(self, session_id):
+        """Deferred firing True if the player left the queue, False if their game opened first.
+
+        The enqueue Deferred fires with None either way, once the service answers.
+        """
+        d = self.waiting.pop(session_id, None)
+        if d is None:
+            return succeed(False)
+        confirmed = Deferred()
+        self.cancelling[session_id] = (d, confirmed)
+        self.client.send({"type": "mm_cancel", "session_id": session_id})
+        return confirmed
+
+    def _result(self, message):
+        session_id = message["session_id"]
+        d = self.waiting.pop(session_id, None)
+        if d is not None:
+            d.callback(message["opponent"])
+        elif message["opponent"] is None and session_id in self.cancelling:
+            # The partner's game opened before the cancel got there; it stands.
+            d, confirmed = self.cancelling.pop(session_id)
+            confirmed.callback(False)
+            d.callback(None)
+        # A match for a cancelling creator is dropped; the service requeues its partner.
+
+    def _cancelled(self, message):
+        pending = self.cancelling.pop(message["session_id"], None)
+        if pending is not None:
+            d, confirmed = pending
+            confirmed.callback(message["cancelled"])
+            d.callback(None)
+
+
+class SharedSessionRegistry(SessionRegistry):
+    """SessionRegistry that tells the state service which sessions live here."""
+
+    def __init__(self, client, ttl):
+        super().__init__(ttl)
+        self.client = client
+        client.on_connect.append(self.announce)
+
+    def _open(self, session):
+        self.client.send({"type": "session_open", "session_id": session.session_id, "username": session.username})
+
+    def announce(self):
+        for session in self.by_id.values():
+            self._open(session)
+
+    def adopt(self, session_id, username, token, connection):
+        session = super().adopt(session_id, username, token, connection)
+        self._open(session)
+        return session
+
+    def remove(self, session_id):
+        session = super().remove(session_id)
+        if session is not None:
+            self.client.send({"type": "session_close", "session_id": session_id})
+        return session
+
+
+class SharedGameRegistry(GameRegistry):
+    """GameRegistry that tells the state service which games this worker owns."""
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        client.on_connect.append(self.announce)
+
+    def _open(self, game):
+        self.client.send({"type": "game_open", "game_id": game.game_id, "sessions": [game.whitesess, game.blacksess]})
+
+    def announce(self):
+        for game in self.games.values():
+            self._open(game)
+
+    def add(self, game):
+        super().add(game)
+        self._open(game)
+
+    def remove(self, game_id):
+        game = super().remove(game_id)
+        if game is not None:
+            self.client.send({"type": "game_close", "game_id": game_id})
+        return game
@@ -0,0 +1,367 @@
+import argparse
+import itertools
+import os
+from collections import defaultdict
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import NetstringReceiver
+
+import wirecodec
+from matchmaker import Matchmaker
+
+
+class StateServiceProtocol(NetstringReceiver):
+    """One connected server worker."""
+
+    MAX_LENGTH = 1024 * 1024
+
+    def connectionMade(self):
+        self.worker_id = None
+
+    def connectionLost(self, reason):
+        self.factory.service.worker_lost(self)
+
+    def stringReceived(self, data):
+        try:
+            message = wirecodec.decode(data)
+        except wirecodec.CodecError as e:
+            print(f"Dropping malformed frame from worker {self.worker_id}: {e}")
+            return
+        handler = getattr(self.factory.service, f"handle_{message['type']}", None)
+        if handler is None:
+            print(f"Unknown state message from worker {self.worker_id}: {message['type']}")
+            return
+        handler(self, message)
+
+    def send_message(self, message):
+        self.sendString(wirecodec.encode(message))
+
+
+class Pair:
+    """Two players the queue matched, until the creator's worker opens their game."""
+
+    __slots__ = ("creator", "partner", "partner_worker", "withdrawn")
+
+    def __init__(self, creator, partner, partner_worker):
+        self.creator = creator
+        # The partner's queue entry, kept to put it back in the queue.
+        self.partner = partner
+        self.partner_worker = partner_worker
+        self.withdrawn = False
+
+
+class Handoff:
+    """A resume on a worker that does not hold the session, while its holder is looked for."""
+
+    __slots__ = ("worker", "request_id", "username", "token", "candidates", "asked")
+
+    def __init__(self, worker, request_id, username, token, candidates):
+        self.worker = worker
+        self.request_id = request_id
+        self.username = username
+        self.token = token
+        # Ids of the workers holding a session of this user, still to be asked.
+        self.candidates = candidates
+        self.asked = None
+
+
+class StateService:
+    """State shared by all server workers: who is where, and matchmaking.
+
+    Workers announce their sessions and the games they own. Everything a
+    worker cannot do locally goes through here: messages for a session on
+    another worker are relayed to it, moves for a game owned by another
+    worker are forwarded to the owner, and the matchmaking queue is global.
+
+    A match is sent to the player that completed it (the creator), whose
+    worker starts the game. The partner only hears back once that game is
+    open, so either of them can still cancel until then: a creator that
+    cancels puts the partner back in the queue, and the game of a partner
+    that cancelled is ended as soon as it opens.
+
+    A reconnecting player lands on any worker. If that worker does not hold
+    the session, the workers holding one of the player's sessions are asked
+    in turn to release it; the one whose token matches hands it over, and
+    keeps running its games for the player through the new worker.
+    """
+
+    def __init__(self):
+        self.workers = {}
+        self.session_workers = {}
+        self.session_users = {}
+        self.user_sessions = defaultdict(set)
+        self.game_owners = {}
+        self.game_sessions = {}
+        self.session_games = defaultdict(set)
+        self.matchmaker = Matchmaker()
+        # Queued session -> the worker that queued it.
+        self.queue_workers = {}
+        # Both sessions of each pair whose game is not open yet -> Pair.
+        self.pairs = {}
+        self.handoffs = {}
+        self._handoff_ids = itertools.count(1)
+
+    def _worker_of_session(self, session_id):
+        return self.workers.get(self.session_workers.get(session_id))
+
+    def deliver(self, session_id, message):
+        worker = self._worker_of_session(session_id)
+        if worker is not None:
+            worker.send_message({"type": "deliver", "session_id": session_id, "message": message})
+
+    def handle_register_worker(self, worker, message):
+        worker.worker_id = message["worker_id"]
+        self.workers[worker.worker_id] = worker
+        print(f"Worker {worker.worker_id} registered")
+
+    def handle_session_open(self, worker, message):
+        session_id = message["session_id"]
+        self.session_workers[session_id] = worker.worker_id
+        username = message.get("username")
+        if username is not None:
+            self.session_users[session_id] = username
+            self.user_sessions[username].add(session_id)
+
+    def _forget_session(self, session_id):
+        del self.session_workers[session_id]
+        username = self.session_users.pop(session_id, None)
+        sessions = self.user_sessions.get(username)
+        if sessions is not None:
+            sessions.discard(session_id)
+            if not sessions:
+                del self.user_sessions[username]
+
+    def handle_session_close(self, worker, message):
+        session_id = message["session_id"]
+        if self.session_workers.get(session_id) == worker.worker_id:
+            self._forget_session(session_id)
+        pair = self.pairs.get(session_id)
+        # A creator's worker settles its match itself: it opens the game or cancels.
+        if pair is None or pair.creator != session_id:
+            self._cancel(session_id)
+
+    def handle_player_lost(self, worker, message):
+        session_id = message["session_id"]
+        for game_id in list(self.session_games.get(session_id, ())):
+            owner = self.workers.get(self.game_owners.get(game_id))
+            if owner is not None and owner is not worker:
+                owner.send_message({"type": "session_lost", "session_id": session_id})
+                break
+
+    def _enqueue(self, worker, username, session_id, rating, queued_at=None):
+        self.queue_workers[session_id] = worker
+        d = self.matchmaker.enqueue(username, session_id, rating, queued_at)
+        d.addCallback(self._matched, session_id)
+
+    def _matched(self, opponent, session_id):
+        if opponent is None:
+            # Cancelled, or the partner of a pair; partners hear back in _game_opened.
+            return
+        worker = self.queue_workers.pop(session_id)
+        partner_id = opponent["session_id"]
+        pair = Pair(session_id, opponent, self.queue_workers.pop(partner_id, None))
+        self.pairs[session_id] = self.pairs[partner_id] = pair
+        worker.send_message({"type": "mm_result", "session_id": session_id, "opponent": opponent})
+
+    def _unpair(self, pair):
+        for session_id in (pair.creator, pair.partner["session_id"]):
+            if self.pairs.get(session_id) is pair:
+                del self.pairs[session_id]
+
+    def _cancel(self, session_id):
+        """Take a session out of matchmaking; False once its game is open."""
+        if self.matchmaker.cancel(session_id):
+            del self.queue_workers[session_id]
+            return True
+        pair = self.pairs.get(session_id)
+        if pair is None:
+            return False
+        if session_id == pair.creator:
+            # Its worker drops the match; the partner waits on as if never matched.
+            self._unpair(pair)
+            if not pair.withdrawn and pair.partner_worker is not None:
+                partner = pair.partner
+                self._enqueue(
+                    pair.partner_worker, partner["username"], partner["session_id"], partner["rating"],
+                    partner["queueStartTime"],
+                )
+        else:
+            # The creator may be starting the game already; see _game_opened.
+            pair.withdrawn = True
+            del self.pairs[session_id]
+        return True
+
+    def handle_mm_enqueue(self, worker, message):
+        self._enqueue(worker, message["username"], message["session_id"], message["rating"])
+
+    def handle_mm_cancel(self, worker, message):
+        session_id = message["session_id"]
+        cancelled = self._cancel(session_id)
+        worker.send_message({"type": "mm_cancelled", "session_id": session_id, "cancelled": cancelled})
+
+    def _game_opened(self, worker, session_id):
+        pair = self.pairs.get(session_id)
+        if pair is None or pair.creator != session_id:
+            return
+        self._unpair(pair)
+        partner_id = pair.partner["session_id"]
+        if pair.withdrawn:
+            worker.send_message({"type": "session_lost", "session_id": partner_id})
+        elif pair.partner_worker is not None:
+            pair.partner_worker.send_message({"type": "mm_result", "session_id": partner_id, "opponent": None})
+
+    def handle_game_open(self, worker, message):
+        game_id = message["game_id"]
+        self.game_owners[game_id] = worker.worker_id
+        self.game_sessions[game_id] = tuple(message["sessions"])
+        for session_id in message["sessions"]:
+            self.session_games[session_id].add(game_id)
+        for session_id in message["sessions"]:
+            self._game_opened(worker, session_id)
+
+    def _close_game(self, game_id):
+        self.game_owners.pop(game_id, None)
+        for session_id in self.game_sessions.pop(game_id, ()):
+            game_ids = self.session_games.get(session_id)
+            if game_ids is not None:
+                game_ids.discard(game_id)
+                if not game_ids:
+                    del self.session_games[session_id]
+
+    def handle_game_close(self, worker, message):
+        self._close_game(message["game_id"])
+
+    def handle_route(self, worker, message):
+        self.deliver(message["session_id"], message["message"])
+
+    def handle_forward_move(self, worker, message):
+        owner = self.workers.get(self.game_owners.get(message["game_id"]))
+        if owner is None:
+            self.deliver(message["session_id"], {"type": "error", "reason": "Game not found"})
+            return
+        owner.send_message({
+            "type": "remote_move",
+            "game_id": message["game_id"],
+            "session_id": message["session_id"],
+            "move": message["move"],
+            "claim_draw": message.get("claim_draw", False),
+        })
+
+    def handle_forward_watch(self, worker, message):
+        owner = self.workers.get(self.game_owners.get(message["game_id"]))
+        if owner is None:
+            if message["watch"]:
+                self.deliver(message["session_id"], {"type": "error", "reason": "Game not found"})
+            return
+        owner.send_message({
+            "type": "remote_watch",
+            "game_id": message["game_id"],
+            "session_id": message["session_id"],
+            "watch": message["watch"],
+        })
+
+    def handle_resume_games(self, worker, message):
+        """A session was resumed: games owned by other workers send it their state."""
+        session_id = message["session_id"]
+        for game_id in self.session_games.get(session_id, ()):
+            owner = self.workers.get(self.game_owners.get(game_id))
+            if owner is not None and owner is not worker:
+                owner.send_message({"type": "remote_resume", "game_id": game_id, "session_id": session_id})
+
+    def handle_resume_request(self, worker, message):
+        """A worker was asked to resume a session it does not hold."""
+        candidates = []
+        for session_id in self.user_sessions.get(message["username"], ()):
+            worker_id = self.session_workers[session_id]
+            if worker_id != worker.worker_id and worker_id not in candidates:
+                candidates.append(worker_id)
+        handoff_id = next(self._handoff_ids)
+        self.handoffs[handoff_id] = Handoff(
+            worker, message["request_id"], message["username"], message["token"], candidates
+        )
+        self._ask_next(handoff_id)
+
+    def _ask_next(self, handoff_id):
+        handoff = self.handoffs[handoff_id]
+        while handoff.candidates:
+            holder = self.workers.get(handoff.candidates.pop(0))
+            if holder is not None:
+                handoff.asked = holder
+                holder.send_message({
+                    "type": "session_release", "handoff_id": handoff_id,
+                    "username": handoff.username, "token": handoff.token,
+                })
+                return
+        del self.handoffs[handoff_id]
+        handoff.worker.send_message({"type": "resume_handoff", "request_id": handoff.request_id, "session": None})
+
+    def handle_session_released(self, worker, message):
+        handoff_id = message["handoff_id"]
+        handoff = self.handoffs.get(handoff_id)
+        if handoff is None:
+            return
+        if message["session"] is None:
+            self._ask_next(handoff_id)
+            return
+        del self.handoffs[handoff_id]
+        handoff.worker.send_message({
+            "type": "resume_handoff", "request_id": handoff.request_id,
+            "session": message["session"], "results": message["results"],
+        })
+
+    def handle_playing_query(self, worker, message):
+        """Which of these sessions are in a game, on any worker (for session expiry)."""
+        playing = [session_id for session_id in message["session_ids"] if self.session_games.get(session_id)]
+        worker.send_message({"type": "playing_sessions", "session_ids": playing})
+
+    def handle_ratings_changed(self, worker, message):
+        for other in self.workers.values():
+            if other is not worker:
+                other.send_message(message)
+
+    def worker_lost(self, worker):
+        if self.workers.get(worker.worker_id) is not worker:
+            return
+        del self.workers[worker.worker_id]
+        print(f"Worker {worker.worker_id} disconnected")
+
+        lost_sessions = [sid for sid, wid in self.session_workers.items() if wid == worker.worker_id]
+        for session_id in lost_sessions:
+            self._forget_session(session_id)
+            self._cancel(session_id)
+            self.handle_player_lost(worker, {"session_id": session_id})
+
+        for handoff_id, handoff in list(self.handoffs.items()):
+            if handoff.worker is worker:
+                del self.handoffs[handoff_id]
+            elif handoff.asked is worker:
+                self._ask_next(handoff_id)
+
+        for game_id in [gid for gid, wid in self.game_owners.items() if wid == worker.worker_id]:
+            for session_id in self.game_sessions.get(game_id, ()):
+                self.deliver(session_id, {"type": "opponent_disconnected"})
+            self._close_game(game_id)
+
+
+class StateServiceFactory(Factory):
+    protocol = StateServiceProtocol
+
+    def __init__(self, service):
+        self.service = service
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared state service for multi-process chess servers.")
+    parser.add_argument("--socket", required=True, help="Unix socket path to listen on")
+    args = parser.parse_args()
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    reactor.listenUNIX(args.socket, StateServiceFactory(StateService()))
+    print(f"State service listening on {args.socket}")
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
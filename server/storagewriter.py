@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from concurrent.futures import Future
+from pathlib import Path
+
+import serverlog
+
+# Seconds before a commit that failed is tried again.
+RETRY_DELAY = 1.0
+
+
+def atomic_write(path, payload, fsync=True):
+    """Replace ``path`` with ``payload`` so readers never see a partial file."""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(payload)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class FlushStats:
+    def __init__(self):
+        self.requests = 0
+        self.commits = 0
+        self.files_written = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def record(self, latency, files):
+        self.commits += 1
+        self.files_written += files
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "commits": self.commits,
+            "files_written": self.files_written,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "avg_latency": self.total_latency / self.commits if self.commits else 0.0,
+        }
+
+
+class GroupCommitWriter:
+    """Coalesces writes to the same file into a single atomic replace.
+
+    ``submit`` registers a serializer for a path. Every submission that
+    arrives within ``window`` seconds of the first one is served by the same
+    commit, which calls the latest serializer once per file and writes the
+    result with ``atomic_write`` while holding that file's lock. The returned
+    future resolves when the commit that covers the submission is on disk.
+    ``before_write`` callbacks run in the writer thread just before their
+    file is replaced, for data that has to be durable ahead of it, and
+    ``on_commit`` callbacks run only after every file of the group is on
+    disk. Latency is measured from the first submission of a group to the
+    end of its commit.
+
+    Given a ``snapshot_lock``, a commit takes its group and calls every
+    serializer while holding it. Writers that mark files dirty under the
+    same lock then always see the files of one group reflect one moment.
+
+    A commit that fails puts its files back in the queue, under any newer
+    submission for the same file, and is retried after ``retry_delay``
+    seconds; its future resolves once a retry gets the files on disk.
+    """
+
+    def __init__(self, window=0.05, fsync=True, retry_delay=RETRY_DELAY, snapshot_lock=None):
+        self.window = window
+        self.fsync = fsync
+        self.retry_delay = retry_delay
+        self.snapshot_lock = snapshot_lock if snapshot_lock is not None else nullcontext()
+        self.stats = FlushStats()
+
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._file_locks = defaultdict(threading.Lock)
+        self._pending = {}
+        self._group_future = None
+        self._group_started = None
+        self._timer = None
+
+    def file_lock(self, path):
+        with self._lock:
+            return self._file_locks[Path(path)]
+
+    def submit(self, path, serialize, on_commit=None, before_write=None):
+        with self._lock:
+            self.stats.requests += 1
+            self._pending[Path(path)] = (serialize, on_commit, before_write)
+            if self._group_future is None:
+                self._group_future = Future()
+                self._group_started = time.perf_counter()
+                self._schedule(self.window)
+            return self._group_future
+
+    def _schedule(self, delay):
+        self._timer = threading.Timer(delay, self._timed_commit)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _timed_commit(self):
+        try:
+            self.commit()
+        except Exception:
+            # Already logged, and the files are queued for another try.
+            pass
+
+    def commit(self):
+        with self._commit_lock:
+            with self.snapshot_lock:
+                with self._lock:
+                    if self._timer is not None:
+                        self._timer.cancel()
+                    pending, self._pending = self._pending, {}
+                    future, self._group_future = self._group_future, None
+                    started, self._group_started = self._group_started, None
+                    self._timer = None
+                if not pending:
+                    return
+                try:
+                    payloads = {path: entry[0]() for path, entry in pending.items()}
+                except Exception:
+                    self._failed(pending, future, started)
+                    raise
+
+            try:
+                for path, payload in payloads.items():
+                    before_write = pending[path][2]
+                    if before_write is not None:
+                        before_write()
+                    with self.file_lock(path):
+                        atomic_write(path, payload, self.fsync)
+                for serialize, on_commit, before_write in pending.values():
+                    if on_commit is not None:
+                        on_commit()
+            except Exception:
+                self._failed(pending, future, started)
+                raise
+            self.stats.record(time.perf_counter() - started, len(pending))
+            future.set_result(len(pending))
+
+    def _failed(self, pending, future, started):
+        serverlog.error("storage commit failed, retrying", exc_info=True, files=len(pending))
+        self._requeue(pending, future, started)
+
+    def _requeue(self, pending, future, started):
+        with self._lock:
+            for path, entry in pending.items():
+                self._pending.setdefault(path, entry)
+            if self._group_future is None:
+                self._group_future = future
+                self._group_started = started
+                self._schedule(self.retry_delay)
+            else:
+                # A new group started meanwhile; the failed one is done when it is.
+                self._group_future.add_done_callback(lambda done: future.set_result(done.result()))
+
+    def write_now(self, path, payload):
+        with self.file_lock(path):
+            atomic_write(path, payload, self.fsync)
+
+    def close(self):
+        self.commit()
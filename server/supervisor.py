@@ -0,0 +1,109 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import config
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESTART_DELAY = 1.0
+SOCKET_WAIT = 5.0
+
+
+class Supervisor:
+    """Runs the state service and N server workers sharing one port.
+
+    Workers are separate interpreters rather than forks: by the time this
+    module could fork, the reactor and the database/hash thread pools would
+    already exist and would not survive it. Each worker binds the port with
+    SO_REUSEPORT so the kernel spreads incoming connections between them.
+    A worker that exits is restarted; SIGINT/SIGTERM stop everything and
+    SIGUSR1 is passed on to the workers to toggle debug logging.
+    """
+
+    def __init__(self, workers, state_socket):
+        self.workers = workers
+        self.state_socket = state_socket
+        self.state_service = None
+        self.children = {}
+        self.stopping = False
+
+    def _spawn(self, *args):
+        return subprocess.Popen([sys.executable, *args], cwd=HERE)
+
+    def start_state_service(self):
+        if os.path.exists(self.state_socket):
+            os.unlink(self.state_socket)
+        self.state_service = self._spawn("stateservice.py", "--socket", self.state_socket)
+        deadline = time.monotonic() + SOCKET_WAIT
+        while not os.path.exists(self.state_socket):
+            if self.state_service.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("State service failed to start")
+            time.sleep(0.05)
+
+    def start_worker(self, worker_id):
+        self.children[worker_id] = self._spawn(
+            "twistedserver.py", "--worker-id", str(worker_id), "--state-socket", self.state_socket
+        )
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def toggle_debug(self, *_):
+        for child in self.children.values():
+            if child.poll() is None:
+                child.send_signal(signal.SIGUSR1)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.toggle_debug)
+        self.start_state_service()
+        for worker_id in range(self.workers):
+            self.start_worker(worker_id)
+        print(f"Supervisor started {self.workers} workers")
+
+        while not self.stopping:
+            if self.state_service.poll() is not None:
+                print("State service exited, restarting it")
+                self.start_state_service()
+            for worker_id, child in list(self.children.items()):
+                if child.poll() is not None:
+                    print(f"Worker {worker_id} exited with code {child.returncode}, restarting")
+                    self.start_worker(worker_id)
+            time.sleep(RESTART_DELAY)
+
+        self.shutdown()
+
+    def shutdown(self):
+        print("Stopping workers...")
+        children = list(self.children.values()) + [self.state_service]
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+        for child in children:
+            try:
+                child.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                child.kill()
+        if os.path.exists(self.state_socket):
+            os.unlink(self.state_socket)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several chess server processes on one port.")
+    parser.add_argument("-w", "--workers", type=int, default=config.WORKERS, help="number of server processes")
+    args = parser.parse_args()
+
+    if args.workers > 1 and config.DB_BACKEND != "sqlite":
+        sys.exit("Several workers need CHESS_DB_BACKEND=sqlite; the JSON files cannot be shared between processes.")
+
+    state_socket = os.path.abspath(os.path.join(HERE, config.STATE_SOCKET))
+    os.makedirs(os.path.dirname(state_socket), exist_ok=True)
+    Supervisor(args.workers, state_socket).run()
+
+
+if __name__ == "__main__":
+    main()
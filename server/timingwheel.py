@@ -0,0 +1,78 @@
+import math
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+TICK = 0.1
+SLOTS = 1024
+
+
+class Timer:
+    __slots__ = ("expires", "slot", "callback", "args")
+
+    def __init__(self, expires, slot, callback, args):
+        self.expires = expires
+        self.slot = slot
+        self.callback = callback
+        self.args = args
+
+
+class TimingWheel:
+    """Hashed timing wheel: many timers driven by one repeating reactor call.
+
+    Time is cut into ``tick``-second ticks and a timer lives in slot
+    ``expiry_tick % slots``. Each tick only looks at one slot, firing the
+    timers in it that are due and leaving the ones due on a later turn of
+    the wheel. Scheduling and cancelling are set operations, so rescheduling
+    a game clock on every move costs O(1) whatever the number of games.
+    Timers fire up to one tick late, never early.
+    """
+
+    def __init__(self, tick=TICK, slots=SLOTS, clock=reactor):
+        self.tick = tick
+        self.clock = clock
+        self.slots = [set() for _ in range(slots)]
+        self.count = 0
+        self.current = math.floor(clock.seconds() / tick)
+        self._loop = LoopingCall(self._advance)
+        self._loop.clock = clock
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, deadline, callback, *args):
+        """Call ``callback(*args)`` once ``clock.seconds()`` reaches ``deadline``."""
+        if not self._loop.running:
+            self.current = math.floor(self.clock.seconds() / self.tick)
+            self._loop.start(self.tick, now=False)
+        expires = max(math.ceil(deadline / self.tick), self.current + 1)
+        timer = Timer(expires, expires % len(self.slots), callback, args)
+        self.slots[timer.slot].add(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        slot = self.slots[timer.slot]
+        if timer in slot:
+            slot.remove(timer)
+            self.count -= 1
+
+    def _advance(self):
+        target = math.floor(self.clock.seconds() / self.tick)
+        # After a stall longer than a full turn, one pass over every slot is enough.
+        first = max(self.current + 1, target - len(self.slots) + 1)
+        self.current = target
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            due = [timer for timer in slot if timer.expires <= target]
+            for timer in due:
+                slot.discard(timer)
+                self.count -= 1
+            for timer in due:
+                timer.callback(*timer.args)
+        if self.count == 0 and self._loop.running:
+            self._loop.stop()
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
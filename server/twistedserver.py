@@ -1,107 +1,246 @@
-from twisted.internet import reactor, ssl, defer
-from twisted.internet.defer import Deferred, ensureDeferred 
-from twisted.internet.protocol import Protocol, Factory
+from twisted.internet import reactor
+from twisted.internet.defer import ensureDeferred, maybeDeferred
+from twisted.internet.protocol import Factory
 from twisted.protocols.basic import NetstringReceiver
 from twisted.internet.task import LoopingCall
+from twisted.web.server import Site
 import pickle
-import bcrypt
 import chess
-from chessdatabase_json import ChessDatabase
-import secrets
-import uuid
+from chessdatabase import InvalidCursor, create_database
+from matchmaker import Matchmaker
+from leaderboard import Leaderboard
+from gameregistry import GameClock, GameRegistry, LiveGame, parse_time_control
+import wirecodec
+import ratings
+import metrics
+import serverlog
+import pgnexport
+from ratelimit import RateLimiter
+from passwordhasher import PasswordHasher, ServerBusy
+from sessionregistry import SessionRegistry
+from spectators import SpectatorHub, fan_out
+from timingwheel import TimingWheel
+from positioncache import PositionCache, claimable_draw
+from botplayer import BOT_PASSWORD, BOT_USERNAME, Bots, EnginePool
+from stateclient import StateClient, RemoteConnection, RemoteMatchmaker, SharedGameRegistry, SharedSessionRegistry
+import config
+import argparse
+import itertools
+import os
+import socket
 import time
-import asyncio
 from random import randint
+from collections import deque
 
 
 HOST = '127.0.0.1'
 PORT = 65432
-TOKEN_LENGTH = 32
-
-chdata = ChessDatabase()
+SESSION_SWEEP_INTERVAL = 60
+SERVER_BUSY = "Server busy, try again later"
+# A connection whose frames keep getting rejected is dropped.
+REJECT_LIMIT = 50
+# Messages that end a player's game; a detached player gets them on resume.
+GAME_RESULTS = ("game_end", "opponent_disconnected")
+HISTORY_PAGE = 20
+LEADERBOARD_PAGE = 10
+# How often a player whose bot wait is over looks again while every bot is busy.
+BOT_RETRY = 5
+MAX_HISTORY_PAGE = 50
+# PGN text per pgn_chunk reply, well under the client's netstring limit.
+PGN_CHUNK = 32 * 1024
+
+chdata = metrics.InstrumentedDatabase(create_database(config.DB_BACKEND, config.DB_PATH))
+matchmaker = Matchmaker()
+live_games = GameRegistry()
+hasher = PasswordHasher(config.HASH_WORKERS, config.HASH_QUEUE_LIMIT)
 connected_clients = set()
-logined_clients = {}
+sessions = SessionRegistry(config.SESSION_TTL)
+spectators = SpectatorHub()
+time_control = parse_time_control(config.TIME_CONTROL)
+# Flag-fall timers for every game clock in this process.
+clocks = TimingWheel()
+# Seeded from storage at startup, then updated on every rating change.
+leaderboard = Leaderboard()
+# Legal moves and mate/stalemate status by position, shared by all games here.
+positions = PositionCache(config.POSITION_CACHE_SIZE)
+# Computer opponents for players the queue has no match for; started in main.
+bots = Bots(EnginePool(config.BOT_WORKERS), config.BOT_GAMES, config.BOT_MOVE_TIME, lambda player, move: bot_move(player, move))
+# Set when running as one of several worker processes (see supervisor.py).
+shared_state = None
+# Sessions whose connection dropped: session id -> delayed call that gives up on them.
+detached = {}
+# Game results that came in for a detached session, sent again when it resumes.
+missed_results = {}
+# Resumes waiting for another worker to hand the session over: request id -> connection.
+resuming = {}
+resume_ids = itertools.count(1)
+
+# Read at scrape time, so they follow the registries swapped in by worker mode.
+metrics.registry.gauge("chess_queue_depth", "Players waiting for an opponent.", lambda: len(matchmaker))
+metrics.registry.gauge("chess_live_games", "Games in progress in this process.", lambda: len(live_games))
+metrics.registry.gauge("chess_connected_clients", "Open client connections.", lambda: len(connected_clients))
+metrics.registry.gauge("chess_logged_in_clients", "Sessions logged in to this process.", lambda: len(sessions))
+metrics.registry.gauge("chess_clock_timers", "Flag-fall timers waiting on the timing wheel.", lambda: len(clocks))
+metrics.registry.gauge("chess_position_cache_size", "Positions held in the position cache.", lambda: len(positions))
+metrics.registry.counter("chess_position_cache_hits_total", "Position lookups answered from the cache.", func=lambda: positions.hits)
+metrics.registry.counter("chess_position_cache_misses_total", "Position lookups that generated legal moves.", func=lambda: positions.misses)
+metrics.registry.gauge("chess_bot_games", "Games against the built-in bot in progress.", lambda: len(bots))
+metrics.registry.gauge("chess_spectators", "Connections watching at least one game.", lambda: len(spectators))
+metrics.registry.gauge("chess_password_hashes_pending", "bcrypt jobs running or queued.", lambda: hasher.pending)
+metrics.registry.gauge("chess_log_records_dropped", "Log records dropped because the log queue was full.", serverlog.dropped)
 
 class ChessProtocol(NetstringReceiver):
+    MAX_LENGTH = config.MAX_FRAME
+
     def connectionMade(self):
         self.addr = self.transport.getPeer()
+        self.codec = None
+        self.limiter = RateLimiter()
+        self.in_flight = 0
+        self.backlog = deque()
+        self.rejected = 0
+        self.last_seen = reactor.seconds()
+        # No pings until the client has said which codec it speaks.
+        self.negotiated = False
         connected_clients.add(self)
-        print(f"Player connected: {self.addr}")
+        serverlog.info("connected", peer=str(self.addr))
 
     def connectionLost(self, reason):
         connected_clients.discard(self)
+        spectators.drop(self)
 
-        session_to_remove = None
-        for session_id, details in logined_clients.items():
-            if details["connection"] == self:
-                session_to_remove = session_id
-                username = ensureDeferred(chdata.find_user_by_session(session_to_remove))
-                break
+        session = sessions.detach(self)
+        if session:
+            matchmaker.cancel(session.session_id)
+            park_session(session.session_id)
 
-        if session_to_remove:
-            logined_clients.pop(session_to_remove, None)
-            
-            disconnected_games = ensureDeferred(chdata.get_games_involving(username))
-            for game in disconnected_games:
-                opponent_username = (
-                    game["white"] if game["black"] == username else game["black"]
-                )
-                opponent_session_id = (
-                    game["whitesess"] if game["black"] == username else game["blacksess"]
-                )
-                if opponent_session_id in logined_clients:
-                    opponent_conn = logined_clients[opponent_session_id]["connection"]
-                    opponent_conn.send_message({"type": "opponent_disconnected"})
-                ensureDeferred(chdata.remove_game(game["game_id"]))
-
-        print(f"Player disconnected: {self.addr} |:| reason {reason}")
+        serverlog.info(
+            "disconnected", peer=str(self.addr), session=session.session_id if session else None,
+            reason=reason.getErrorMessage(),
+        )
 
     def stringReceived(self, data):
+        received = time.perf_counter()
+        self.last_seen = reactor.seconds()
         try:
-            message = pickle.loads(data)
-            print(message)
+            # Rate limits are checked on the raw frame, before any decoding.
+            if not self.limiter.allow_frame():
+                self.reject("*")
+                return
+            peeked_type = wirecodec.peek_type(data)
+            if peeked_type is not None and not self.limiter.allow(peeked_type):
+                self.reject(peeked_type)
+                return
+
+            message = self.decode(data)
+            if message is None:
+                self.send_error("Unsupported message encoding")
+                return
             if "type" not in message:
                 self.send_error("Invalid message format")
                 return
             
             message_type = message["type"]
+            # Legacy pickle frames only reveal their type once decoded.
+            if peeked_type is None and not self.limiter.allow(message_type):
+                self.reject(message_type)
+                return
+            self.rejected = 0
+
+            if message_type != "hello":
+                # A legacy client that never negotiates.
+                self.negotiated = True
+
+            session = sessions.for_connection(self)
+            serverlog.received(message, session.session_id if session else None)
             handler = getattr(self, f"handle_{message_type}", None)
             if handler:
-                ensureDeferred(handler(message))
+                self.dispatch(handler, message, received)
             else:
                 self.send_error("Unknown message type")
-        except Exception as e:
-            print(f"Error with player {self.addr}: {e}")
+        except Exception:
+            serverlog.error("message failed", exc_info=True, peer=str(self.addr))
+
+    def reject(self, message_type):
+        metrics.rejected_frames.inc(message_type)
+        self.rejected += 1
+        if self.rejected > REJECT_LIMIT:
+            serverlog.warning("flooding", peer=str(self.addr), type=message_type)
+            self.transport.loseConnection()
+            return
+        self.send_error("Rate limit exceeded")
+
+    def dispatch(self, handler, message, received):
+        """Run ``handler``, or queue it while this connection has too many in flight."""
+        if self.in_flight >= config.MAX_IN_FLIGHT:
+            if len(self.backlog) >= config.MAX_QUEUED:
+                self.reject(message["type"])
+            else:
+                self.backlog.append((handler, message, received))
+            return
+        self.in_flight += 1
+        d = metrics.time_handler(message["type"], ensureDeferred(handler(message)), received)
+        d.addBoth(self.handler_done)
+
+    def handler_done(self, result):
+        self.in_flight -= 1
+        if self.backlog and self.connected:
+            self.dispatch(*self.backlog.popleft())
+        return result
+
+    def decode(self, data):
+        if wirecodec.is_wirecodec(data):
+            return wirecodec.decode(data)
+        # Pickle is only accepted from legacy clients that never negotiated.
+        if self.codec is None and config.ALLOW_PICKLE:
+            return pickle.loads(data)
+        return None
+
+    def encode(self, message):
+        if self.codec == wirecodec.CODEC_NAME:
+            return wirecodec.encode(message)
+        return pickle.dumps(message)
 
     def send_message(self, message):
-        data = pickle.dumps(message)
-        self.sendString(data)
+        self.sendString(self.encode(message))
 
     def send_error(self, reason):
         self.send_message({"type": "error", "reason": reason})
         
     async def process_tokenauth(self, message):
-        token = message["token"]
-        username = message["username"]
-        usersession = await chdata.find_session(username)
-        if not usersession:
+        session = sessions.authenticate(message.get("username"), message.get("token"), self)
+        if not session:
             self.send_error("Unauthorized")
             return (None, None)
 
-        if logined_clients[usersession]["token"] != token:
-            self.send_error("Unauthorized")
-            return (None, None)
-        
-        return username, usersession
+        return session.username, session.session_id
 
     # Handlers for different message types
+    async def handle_hello(self, message):
+        if wirecodec.CODEC_NAME in message.get("codecs", ()):
+            self.codec = wirecodec.CODEC_NAME
+        self.negotiated = True
+        self.send_message({"type": "hello", "codec": self.codec or "pickle"})
+
+    async def handle_ping(self, message):
+        self.send_message({"type": "pong"})
+
+    async def handle_pong(self, message):
+        # Receiving it already refreshed last_seen.
+        pass
+
     async def handle_register(self, message):
         username = message["username"]
         password = message["password"]
-        hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+        try:
+            hashed_password = await hasher.hash(password)
+        except ServerBusy:
+            self.send_message({"type": "register_failed", "reason": SERVER_BUSY})
+            return
         success = await chdata.add_user(username, hashed_password)
 
         if success:
+            ratings_changed({username: ratings.DEFAULT_RATING})
             self.send_message({"type": "register_success"})
         else:
             self.send_message({"type": "register_failed", "reason": "Username already exists"})
@@ -110,52 +249,93 @@ class ChessProtocol(NetstringReceiver):
         username = message["username"]
         password = message["password"]
         user = await chdata.find_user(username)
-        print("letsago")
 
-        if user and bcrypt.checkpw(password.encode(), user["password"].encode()):
-            token = secrets.token_hex(TOKEN_LENGTH)
-            session_id = str(uuid.uuid4())
-            logined_clients[session_id] = {"token":token, "connection":self}
-            await chdata.add_session(username, session_id)
+        try:
+            verified = user is not None and await hasher.verify(password, user["password"])
+        except ServerBusy:
+            self.send_message({"type": "login_failed", "reason": SERVER_BUSY})
+            return
+
+        if verified:
+            session = sessions.create(username, self)
+            await chdata.add_session(username, session.session_id)
             elo = await chdata.get_elo(username)
-            self.send_message({"type": "login_success", "username": username, "token": token, "elo": elo})
+            self.send_message({"type": "login_success", "username": username, "token": session.token, "elo": elo})
         else:
             self.send_message({"type": "login_failed", "reason": "Invalid credentials"})
             
             
+    async def handle_resume(self, message):
+        """Take a session back after reconnecting, with the current state of its games."""
+        session = sessions.find(message.get("username"), message.get("token"))
+        if session is not None:
+            await self.resume_session(session)
+        elif shared_state is not None and isinstance(message.get("token"), str):
+            # The session may be held by the worker the player was connected to.
+            request_id = next(resume_ids)
+            resuming[request_id] = self
+            shared_state.send({
+                "type": "resume_request", "request_id": request_id,
+                "username": message.get("username"), "token": message["token"],
+            })
+        else:
+            self.send_message({"type": "resume_failed", "reason": "Session expired"})
+
+    async def resume_session(self, session):
+        pending = detached.pop(session.session_id, None)
+        if pending is not None and pending.active():
+            pending.cancel()
+        previous = session.connection
+        sessions.attach(session, self)
+        if previous is not None and previous is not self:
+            # The old connection is a half-open socket the reaper has not caught yet.
+            previous.transport.abortConnection()
+
+        elo = await chdata.get_elo(session.username)
+        self.send_message({"type": "resume_success", "username": session.username, "elo": elo})
+        for game in live_games.for_session(session.session_id):
+            color = game.color_of(session.session_id)
+            if color == "white":
+                game.whiteconn = self
+            else:
+                game.blackconn = self
+            self.send_message(resume_message(game, color))
+        for result in missed_results.pop(session.session_id, ()):
+            self.send_message(result)
+        if shared_state is not None:
+            shared_state.send({"type": "resume_games", "session_id": session.session_id})
+
     async def find_match(self, username, session_id, rating):
-        best_match = None
-        best_diff = float('inf')
-        current_time = time.time()
-        elo_range = 50  
-
-        while True:
-            queue = await chdata.get_queue()
-            for player in queue:
-                if player["session_id"] == session_id:
-                    continue
-
-                diff = abs(player["rating"] - rating)
-                if diff <= elo_range:
-                    if diff < best_diff:
-                        best_match = player
-                        best_diff = diff
-
-            if best_match:
-                queue = [p for p in queue if p["session_id"] != best_match["session_id"] and p["session_id"] != session_id]
-                await chdata.restore_queue(queue)
-                return best_match
-
-            if current_time + 5 < time.time(): 
-                elo_range += 50
-                current_time = time.time()
-
-            def sleep_callback():
-                pass  
-        
-            defered = defer.Deferred()
-            reactor.callLater(0.5, lambda: defered.callback(True))
-            await defered
+        queued = matchmaker.enqueue(username, session_id, rating)
+        if not bots.enabled:
+            return await queued
+        bot = None
+
+        def offer_bot():
+            nonlocal bot, wait
+            # Still in the queue means nobody has been paired with them yet.
+            if session_id not in matchmaker:
+                return
+            if bots.available():
+                bot = bots.opponent()
+                maybeDeferred(matchmaker.cancel, session_id).addCallback(keep_bot)
+            else:
+                wait = reactor.callLater(BOT_RETRY, offer_bot)
+
+        def keep_bot(cancelled):
+            nonlocal bot
+            if not cancelled:
+                # Their game with a player opened before the cancel took effect.
+                bots.release(bots.get(bot["session_id"]))
+                bot = None
+
+        wait = reactor.callLater(config.BOT_WAIT, offer_bot)
+        try:
+            opponent = await queued
+        finally:
+            if wait.active():
+                wait.cancel()
+        return bot or opponent
 
     async def handle_find_game(self, message):
         username, usersession = await self.process_tokenauth(message)
@@ -163,16 +343,16 @@ class ChessProtocol(NetstringReceiver):
         if username == None:
             return
         
-        elo = await chdata.get_elo(username)
-
-        await chdata.add_to_queue(username, usersession, elo)
-        
         elo = await chdata.get_elo(username)
         opponent = await self.find_match(username, usersession, elo)
 
         if opponent:
             board = chess.Board()
-            opponent_conn = logined_clients[opponent["session_id"]]["connection"]
+            opponent_conn = sessions.connection(opponent["session_id"])
+            if opponent_conn is None:
+                opponent_conn = bots.get(opponent["session_id"])
+            if opponent_conn is None and shared_state is not None:
+                opponent_conn = RemoteConnection(shared_state, opponent["session_id"])
             if randint(0, 1) % 2 == 0:
                 username_color = "white"
                 opponent_color = "black"
@@ -188,14 +368,28 @@ class ChessProtocol(NetstringReceiver):
                 board_fen=board.fen(),
             )
 
-            self.send_message({"type": "game_start", "color": username_color, "game_id": game_id, "board": board.fen()})
-            opponent_conn.send_message({"type": "game_start", "color": opponent_color, "game_id": game_id, "board": board.fen()})
+            clock = None
+            if time_control is not None:
+                clock = GameClock(*time_control, reactor.seconds())
+            game = LiveGame(
+                game_id, board,
+                white=username if username_color == "white" else opponent["username"],
+                whitesess=usersession if username_color == "white" else opponent["session_id"],
+                whiteconn=self if username_color == "white" else opponent_conn,
+                black=username if username_color == "black" else opponent["username"],
+                blacksess=usersession if username_color == "black" else opponent["session_id"],
+                blackconn=self if username_color == "black" else opponent_conn,
+                clock=clock,
+            )
+            live_games.add(game)
+
+            start = {"type": "game_start", "game_id": game_id, "board": board.fen()}
+            if clock is not None:
+                start_clock(game)
+                start.update(clock.as_message(reactor.seconds()), increment=round(clock.increment * 1000))
+            self.send_message({**start, "color": username_color})
+            opponent_conn.send_message({**start, "color": opponent_color})
             
-    def calculate_elo(self, current_rating, opponent_rating, score, k_factor=32):
-        expected_score = 1 / (1 + 10 ** ((opponent_rating - current_rating) / 400))
-        new_rating = current_rating + k_factor * (score - expected_score)
-        return round(new_rating)
-
     async def handle_move(self, message):
         username, usersession = await self.process_tokenauth(message)
         
@@ -203,49 +397,140 @@ class ChessProtocol(NetstringReceiver):
             return
 
         game_id = message["game_id"]
-        move = message["move"]
-        game = await chdata.find_game(game_id)
+        if game_id not in live_games and shared_state is not None:
+            # The game may be owned by another worker; let it decide.
+            shared_state.send({"type": "forward_move", "game_id": game_id, "session_id": usersession, "move": message["move"]})
+            return
+        await apply_move(self, usersession, game_id, message["move"])
 
-        if not game:
+    async def handle_claim_draw(self, message):
+        """Claim a threefold repetition or fifty-move draw, optionally with the move that completes it."""
+        username, usersession = await self.process_tokenauth(message)
+
+        if username == None:
+            return
+
+        game_id = message["game_id"]
+        if game_id not in live_games and shared_state is not None:
+            shared_state.send({
+                "type": "forward_move", "game_id": game_id, "session_id": usersession,
+                "move": message.get("move"), "claim_draw": True,
+            })
+            return
+        await claim_draw(self, usersession, game_id, message.get("move"))
+
+    async def handle_watch_game(self, message):
+        username, usersession = await self.process_tokenauth(message)
+
+        if username == None:
+            return
+
+        game_id = message["game_id"]
+        game = live_games.get(game_id)
+        if game is not None:
+            spectators.watch(self, game)
+        elif shared_state is not None:
+            shared_state.send({"type": "forward_watch", "game_id": game_id, "session_id": usersession, "watch": True})
+        else:
             self.send_error("Game not found")
+
+    async def handle_unwatch_game(self, message):
+        username, usersession = await self.process_tokenauth(message)
+
+        if username == None:
             return
 
-        board = chess.Board(game["board_fen"] if game["board_fen"] else None)
-        if move in [m.uci() for m in board.legal_moves]:
-            board.push_uci(move)
-            await chdata.update_game(game_id, board.fen())
-            self.send_message({"type": "update", "move": move})
-
-            opponent_color = "white" if username == game["black"] else "black"
-            opponent_conn = logined_clients[game[f"{opponent_color}sess"]]["connection"]
-            opponent_conn.send_message({"type": "update", "move": move})
-
-            if board.is_game_over():
-                result = board.result()
-                winner = "white" if result == "1-0" else "black" if result == "0-1" else "draw"
-                whiteelo = await chdata.get_elo(game["white"])
-                blackelo = await chdata.get_elo(game["black"])
-                
-                if winner == "white":
-                    white_score, black_score = 1, 0
-                elif winner == "black":
-                    white_score, black_score = 0, 1
-                else:  
-                    white_score, black_score = 0.5, 0.5
-                
-                new_white_elo = self.calculate_elo(whiteelo, blackelo, white_score)
-                new_black_elo = self.calculate_elo(blackelo, whiteelo, black_score)
-                
-                await chdata.update_elo(game["white"], new_white_elo)
-                await chdata.update_elo(game["black"], new_black_elo)
-    
-                whiteconn = logined_clients[game["whitesess"]]["connection"]
-                blackconn = logined_clients[game["blacksess"]]["connection"]
-                
-                whiteconn.send_message({"type": "game_end", "winner": winner, "elo": new_white_elo})
-                blackconn.send_message({"type": "game_end", "winner": winner, "elo": new_black_elo})
+        game_id = message["game_id"]
+        if not spectators.unwatch(self, game_id) and shared_state is not None:
+            shared_state.send({"type": "forward_watch", "game_id": game_id, "session_id": usersession, "watch": False})
+
+    async def handle_rank(self, message):
+        username, usersession = await self.process_tokenauth(message)
+
+        if username == None:
+            return
+
+        player = message.get("player") or username
+        self.send_message({
+            "type": "rank",
+            "player": player,
+            "rank": leaderboard.rank(player),
+            "rating": leaderboard.ratings.get(player),
+            "players": len(leaderboard),
+        })
+
+    async def handle_leaderboard(self, message):
+        """Top players from ``start``, or the players around ``around``."""
+        username, usersession = await self.process_tokenauth(message)
+
+        if username == None:
+            return
+
+        count = message.get("count")
+        if not isinstance(count, int) or count <= 0:
+            count = LEADERBOARD_PAGE
+        start = message.get("start")
+        if message.get("around"):
+            entries = leaderboard.around(message["around"], count)
         else:
-            self.send_error("Illegal move")
+            entries = leaderboard.top(count, start if isinstance(start, int) and start >= 0 else 0)
+        self.send_message({"type": "leaderboard", "entries": entries, "players": len(leaderboard)})
+
+    async def handle_game_history(self, message):
+        username, usersession = await self.process_tokenauth(message)
+
+        if username == None:
+            return
+
+        result = message.get("result")
+        color = message.get("color")
+        if result not in (None, "win", "loss", "draw") or color not in (None, "white", "black"):
+            self.send_error("Invalid history filter")
+            return
+        limit = message.get("limit")
+        if not isinstance(limit, int) or limit <= 0:
+            limit = HISTORY_PAGE
+        before = message.get("before")
+        player = message.get("player") or username
+        try:
+            games, cursor = await chdata.get_game_history(
+                player, before if isinstance(before, str) else None, min(limit, MAX_HISTORY_PAGE), result, color
+            )
+        except InvalidCursor:
+            self.send_error("Invalid history cursor")
+            return
+        self.send_message({"type": "history_page", "player": player, "games": games, "next": cursor})
+
+    async def handle_export_pgn(self, message):
+        """Send the PGN of a player's games in chunks; ``next`` resumes the export."""
+        username, usersession = await self.process_tokenauth(message)
+
+        if username == None:
+            return
+
+        since, until, after = message.get("since"), message.get("until"), message.get("after")
+        games = chdata.iter_games(
+            message.get("player") or username,
+            since if isinstance(since, (int, float)) else None,
+            until if isinstance(until, (int, float)) else None,
+            after if isinstance(after, str) else None,
+        )
+        chunk = []
+        size = 0
+        cursor = None
+        try:
+            async for game in games:
+                pgn = pgnexport.game_pgn(game)
+                if chunk and size + len(pgn) > PGN_CHUNK:
+                    break
+                chunk.append(pgn)
+                size += len(pgn)
+                cursor = game["game_id"]
+            else:
+                cursor = None
+        finally:
+            await games.aclose()
+        self.send_message({"type": "pgn_chunk", "pgn": "".join(chunk), "next": cursor})
 
     async def handle_logout(self, message):
         username, usersession = await self.process_tokenauth(message)
@@ -253,35 +538,437 @@ class ChessProtocol(NetstringReceiver):
         if username == None:
             return
         
-        logined_clients.pop(usersession)
-        
+        sessions.remove(usersession)
+        matchmaker.cancel(usersession)
+
         await chdata.delete_session(usersession)
 
 
+def game_on_move(conn, usersession, game_id):
+    """The game ``usersession`` is on move in, or None after telling ``conn`` why not."""
+    game = live_games.get(game_id)
+
+    if not game:
+        conn.send_message({"type": "error", "reason": "Game not found"})
+        return None
+
+    color = game.color_of(usersession)
+    if color is None or color != game.to_move():
+        conn.send_message({"type": "error", "reason": "Not your turn"})
+        return None
+    return game
+
+
+async def apply_move(conn, usersession, game_id, move_uci, claim=False):
+    """Validate and play a move in a game owned by this process.
+
+    ``conn`` receives any error; it is the mover's protocol, or a
+    RemoteConnection when the move was forwarded by another worker. With
+    ``claim`` the mover also claims a draw in the position the move leads to.
+    """
+    game = game_on_move(conn, usersession, game_id)
+    if game is None:
+        return
+
+    board = game.board
+    try:
+        move = chess.Move.from_uci(move_uci)
+    except ValueError:
+        move = None
+    if move is None or move not in positions.lookup(board).legal_moves:
+        conn.send_message({"type": "error", "reason": "Illegal move"})
+        return
+
+    now = reactor.seconds()
+    if game.clock is not None and not game.clock.press(now):
+        # The move arrived after the flag fell but before the wheel noticed.
+        await flag_fell(game_id)
+        return
+
+    ply = board.ply()
+    irreversible = board.is_irreversible(move)
+    board.push(move)
+    game.repetitions.record(board, irreversible)
+    ensureDeferred(chdata.append_move(game_id, ply, move.uci(), board.fen())).addErrback(
+        lambda failure: serverlog.error("move not stored", game_id=game_id, reason=failure.getErrorMessage())
+    )
+
+    update = {"type": "update", "move": move.uci()}
+    outcome = positions.outcome(board, game.repetitions)
+    unfounded = False
+    if outcome is None and claim:
+        outcome = claimable_draw(board, game.repetitions)
+        unfounded = outcome is None
+    if game.clock is not None:
+        update.update(game.clock.as_message(now))
+        if outcome is None:
+            start_clock(game)
+    fan_out(game.connections(), update)
+    spectators.broadcast(game_id, {**update, "game_id": game_id})
+
+    if unfounded:
+        # The move stands even though the claim does not.
+        conn.send_message({"type": "error", "reason": "No draw to claim"})
+    if outcome is None:
+        return
+
+    winner = "draw" if outcome.winner is None else "white" if outcome.winner == chess.WHITE else "black"
+    await end_game(game, winner, outcome.termination.name.lower())
+
+
+async def claim_draw(conn, usersession, game_id, move_uci=None):
+    """End the game as a draw if the claimant, on move, is entitled to one."""
+    if move_uci is not None:
+        await apply_move(conn, usersession, game_id, move_uci, claim=True)
+        return
+    game = game_on_move(conn, usersession, game_id)
+    if game is None:
+        return
+    if game.clock is not None and game.clock.left(game.clock.running, reactor.seconds()) <= 0:
+        await flag_fell(game_id)
+        return
+    outcome = claimable_draw(game.board, game.repetitions)
+    if outcome is None:
+        conn.send_message({"type": "error", "reason": "No draw to claim"})
+        return
+    await end_game(game, "draw", outcome.termination.name.lower())
+
+
+def bot_move(player, move_uci):
+    """Play the bot's move in its game, as a move message from it would."""
+    ensureDeferred(apply_move(player, player.session_id, player.game_id, move_uci)).addErrback(
+        lambda failure: serverlog.error("bot move failed", game_id=player.game_id, reason=failure.getErrorMessage())
+    )
+
+
+def start_clock(game):
+    """(Re)arm the flag-fall timer for the side now on move."""
+    if game.timer is not None:
+        clocks.cancel(game.timer)
+    game.timer = clocks.schedule(game.clock.deadline(), lambda: ensureDeferred(flag_fell(game.game_id)))
+
+
+async def flag_fell(game_id):
+    game = live_games.get(game_id)
+    if game is None:
+        return
+    loser = game.clock.running
+    if game.clock.left(loser, reactor.seconds()) > 0:
+        start_clock(game)
+        return
+    game.clock.remaining[loser] = 0.0
+    winner = "black" if loser == "white" else "white"
+    # Running out of time is only a loss if the opponent could still mate.
+    if game.board.has_insufficient_material(chess.WHITE if winner == "white" else chess.BLACK):
+        winner = "draw"
+    await end_game(game, winner, "timeout")
+
+
+async def end_game(game, winner, reason):
+    """Settle a finished game: ratings, storage, spectators and both players."""
+    game_id = game.game_id
+    live_games.remove(game_id)
+    if game.timer is not None:
+        clocks.cancel(game.timer)
+        game.timer = None
+    new_ratings = None
+    try:
+        white_delta, black_delta = ratings.game_deltas(
+            await chdata.get_rating(game.white), await chdata.get_rating(game.black), winner
+        )
+        new_ratings = await chdata.finish_game(game_id, winner, {game.white: white_delta, game.black: black_delta})
+        if new_ratings is None:
+            serverlog.warning("game not rated, storage has no record of it", game_id=game_id)
+        else:
+            ratings_changed(new_ratings)
+    finally:
+        # Players (and bots, which free their slot on it) always hear the result.
+        spectators.close_game(game_id, {"type": "game_end", "game_id": game_id, "winner": winner, "reason": reason})
+        for color in ("white", "black"):
+            message = {"type": "game_end", "winner": winner, "reason": reason}
+            if new_ratings is not None and game.username(color) in new_ratings:
+                message["elo"] = new_ratings[game.username(color)]
+            send_result(game.connection(color), game.session(color), message)
+
+
+def send_result(conn, session_id, message):
+    """Send a player the end of their game, or keep it if they are away."""
+    if session_id in detached:
+        missed_results.setdefault(session_id, []).append(message)
+    else:
+        conn.send_message(message)
+
+
+def ratings_changed(new_ratings):
+    """Apply new ratings to the leaderboard here and in the other workers."""
+    for username, rating in new_ratings.items():
+        leaderboard.update(username, rating)
+    if shared_state is not None:
+        shared_state.send({"type": "ratings_changed", "ratings": new_ratings})
+
+
+async def load_leaderboard():
+    leaderboard.load(await chdata.get_ratings())
+    serverlog.info("leaderboard loaded", players=len(leaderboard))
+
+
+async def start_bots():
+    """Make sure the bot has an account, then start its engine processes."""
+    if await chdata.add_user(BOT_USERNAME, BOT_PASSWORD):
+        ratings_changed({BOT_USERNAME: ratings.DEFAULT_RATING})
+    user = await chdata.find_user(BOT_USERNAME)
+    if user is None or user["password"] != BOT_PASSWORD:
+        serverlog.error("bot disabled, its username belongs to a player", username=BOT_USERNAME)
+        return
+    bots.start()
+    serverlog.info("bot started", games=config.BOT_GAMES, engines=config.BOT_WORKERS)
+
+
+def resume_message(game, color):
+    message = {"type": "game_resume", "game_id": game.game_id, "color": color, "board": game.board.fen()}
+    if game.clock is not None:
+        message.update(game.clock.as_message(reactor.seconds()))
+    return message
+
+
+def park_session(session_id):
+    """The player's connection is gone: keep the session ``RESUME_GRACE`` seconds for a resume."""
+    if config.RESUME_GRACE > 0:
+        detached[session_id] = reactor.callLater(config.RESUME_GRACE, drop_session, session_id)
+    else:
+        drop_session(session_id)
+
+
+def drop_session(session_id):
+    """The resume grace period ran out: forget the session and abandon its games."""
+    detached.pop(session_id, None)
+    missed_results.pop(session_id, None)
+    sessions.remove(session_id)
+    if shared_state is not None:
+        shared_state.send({"type": "player_lost", "session_id": session_id})
+    ensureDeferred(abandon_games(session_id))
+
+
+async def abandon_games(session_id):
+    for game in live_games.for_session(session_id):
+        live_games.remove(game.game_id)
+        if game.timer is not None:
+            clocks.cancel(game.timer)
+        spectators.close_game(game.game_id, {"type": "game_end", "game_id": game.game_id, "winner": "aborted"})
+        opponent_color = "black" if game.color_of(session_id) == "white" else "white"
+        opponent_session = game.session(opponent_color)
+        if opponent_session in sessions or opponent_session in bots or shared_state is not None:
+            send_result(game.connection(opponent_color), opponent_session, {"type": "opponent_disconnected"})
+        await chdata.remove_game(game.game_id)
+
+
 class ChessFactory(Factory):
     def buildProtocol(self, addr):
         return ChessProtocol()
     
     
+def reap_idle():
+    """Ping quiet connections and close the ones that stopped answering.
+
+    Peers that vanished without a FIN never trigger connectionLost on their
+    own; aborting them here releases their sessions, queue slots and games.
+    """
+    now = reactor.seconds()
+    for client in list(connected_clients):
+        idle = now - client.last_seen
+        if idle > config.IDLE_TIMEOUT:
+            serverlog.info("idle timeout", peer=str(client.addr), idle=round(idle, 1))
+            client.transport.abortConnection()
+        elif idle >= config.HEARTBEAT_INTERVAL and client.negotiated:
+            client.send_message({"type": "ping"})
+
+
+def expire_sessions(playing=None):
+    """Drop expired sessions, except those still in a game here or in ``playing``."""
+    if shared_state is not None and playing is None:
+        # Their games may be owned by other workers; the reply calls back in here.
+        expiring = [session.session_id for session in sessions.expiring()]
+        if expiring:
+            shared_state.send({"type": "playing_query", "session_ids": expiring})
+        return
+    playing = set(playing or ())
+    keep = lambda session: session.session_id in playing or live_games.for_session(session.session_id)
+    for session in sessions.expire(keep=keep):
+        matchmaker.cancel(session.session_id)
+        ensureDeferred(chdata.delete_session(session.session_id))
+
+
 def shutdown():
     """Clean up resources on server shutdown."""
     print("Shutting down server...")
     for client in connected_clients:
         client.transport.loseConnection()
     connected_clients.clear()
-    logined_clients.clear()
+    for pending in detached.values():
+        if pending.active():
+            pending.cancel()
+    detached.clear()
+    missed_results.clear()
+    resuming.clear()
+    sessions.clear()
+    clocks.stop()
+    bots.close()
+    chdata.close()
+    hasher.close()
     print("Server shut down successfully.")
+    serverlog.shutdown()
+
+
+def use_shared_state(worker_id, socket_path):
+    """Switch this process to worker mode, sharing state via the state service."""
+    global shared_state, matchmaker, live_games, sessions
+    shared_state = StateClient(worker_id)
+    matchmaker = RemoteMatchmaker(shared_state)
+    live_games = SharedGameRegistry(shared_state)
+    sessions = SharedSessionRegistry(shared_state, config.SESSION_TTL)
+
+    def deliver(message):
+        session_id = message["session_id"]
+        conn = sessions.connection(session_id)
+        if conn is not None:
+            conn.send_message(message["message"])
+        elif session_id in detached and message["message"]["type"] in GAME_RESULTS:
+            # The game is owned by another worker; the player was connected here.
+            missed_results.setdefault(session_id, []).append(message["message"])
+
+    def remote_move(message):
+        conn = RemoteConnection(shared_state, message["session_id"])
+        if message.get("claim_draw"):
+            ensureDeferred(claim_draw(conn, message["session_id"], message["game_id"], message["move"]))
+        else:
+            ensureDeferred(apply_move(conn, message["session_id"], message["game_id"], message["move"]))
+
+    def remote_resume(message):
+        game = live_games.get(message["game_id"])
+        if game is not None:
+            conn = RemoteConnection(shared_state, message["session_id"])
+            conn.send_message(resume_message(game, game.color_of(message["session_id"])))
+
+    def release_session(message):
+        """Hand a session over to the worker its player reconnected to."""
+        reply = {"type": "session_released", "handoff_id": message["handoff_id"], "session": None}
+        session = sessions.find(message["username"], message["token"])
+        if session is None:
+            shared_state.send(reply)
+            return
+        session_id = session.session_id
+        pending = detached.pop(session_id, None)
+        if pending is not None and pending.active():
+            pending.cancel()
+        matchmaker.cancel(session_id)
+        sessions.remove(session_id)
+        if session.connection is not None:
+            # A half-open socket the reaper has not caught yet.
+            session.connection.transport.abortConnection()
+        # Games stay here; the player is now reached through the state service.
+        conn = RemoteConnection(shared_state, session_id)
+        for game in live_games.for_session(session_id):
+            if game.color_of(session_id) == "white":
+                game.whiteconn = conn
+            else:
+                game.blackconn = conn
+        reply["session"] = {"session_id": session_id, "username": session.username, "token": session.token}
+        reply["results"] = missed_results.pop(session_id, [])
+        shared_state.send(reply)
+
+    def resume_handoff(message):
+        conn = resuming.pop(message["request_id"], None)
+        handed = message["session"]
+        if handed is None:
+            if conn is not None:
+                conn.send_message({"type": "resume_failed", "reason": "Session expired"})
+            return
+        session_id = handed["session_id"]
+        connected = conn is not None and conn.connected
+        sessions.adopt(session_id, handed["username"], handed["token"], conn if connected else None)
+        if message["results"]:
+            missed_results[session_id] = message["results"]
+        if connected:
+            ensureDeferred(conn.resume_session(sessions.get(session_id)))
+        else:
+            park_session(session_id)
+
+    def remote_ratings(message):
+        for username, rating in message["ratings"].items():
+            leaderboard.update(username, rating)
+
+    def remote_watch(message):
+        conn = RemoteConnection(shared_state, message["session_id"])
+        game = live_games.get(message["game_id"])
+        if not message["watch"]:
+            spectators.unwatch(conn, message["game_id"])
+        elif game is not None:
+            spectators.watch(conn, game)
+        else:
+            conn.send_message({"type": "error", "reason": "Game not found"})
+
+    shared_state.on("deliver", deliver)
+    shared_state.on("remote_watch", remote_watch)
+    shared_state.on("remote_move", remote_move)
+    shared_state.on("remote_resume", remote_resume)
+    shared_state.on("session_release", release_session)
+    shared_state.on("resume_handoff", resume_handoff)
+    shared_state.on("ratings_changed", remote_ratings)
+    shared_state.on("playing_sessions", lambda message: expire_sessions(message["session_ids"]))
+    shared_state.on("session_lost", lambda message: ensureDeferred(abandon_games(message["session_id"])))
+    shared_state.connect(socket_path)
+
+
+def listen_reuseport(port, factory):
+    """Listen on a socket that other worker processes share via SO_REUSEPORT."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("", port))
+    sock.listen(128)
+    sock.setblocking(False)
+    listening_port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    sock.close()
+    return listening_port
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chess server.")
+    parser.add_argument("--worker-id", type=int, help="run as a worker started by supervisor.py")
+    parser.add_argument("--state-socket", default=config.STATE_SOCKET, help="state service socket for workers")
+    args = parser.parse_args()
+
+    log_file = config.LOG_FILE
+    if log_file and args.worker_id is not None:
+        # Each worker rotates its own file.
+        root, ext = os.path.splitext(log_file)
+        log_file = f"{root}.{args.worker_id}{ext}"
+    serverlog.setup(log_file, config.LOG_MAX_BYTES, config.LOG_BACKUPS, config.LOG_LEVEL, config.LOG_SAMPLE)
+    serverlog.install_debug_toggle()
+
     print("Secure Chess Server started with Twisted. Waiting for players...")
 
     # Add a system event trigger for graceful shutdown
     reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
 
     try:
-        reactor.listenTCP(PORT, ChessFactory())
+        if args.worker_id is None:
+            reactor.listenTCP(PORT, ChessFactory())
+        else:
+            use_shared_state(args.worker_id, args.state_socket)
+            listen_reuseport(PORT, ChessFactory())
+            print(f"Running as worker {args.worker_id}")
+        if config.METRICS_PORT:
+            # Workers share the host, so each takes the next port up.
+            metrics_port = config.METRICS_PORT + (args.worker_id or 0)
+            reactor.listenTCP(metrics_port, Site(metrics.MetricsResource()), interface="127.0.0.1")
+        metrics.start_lag_monitor()
+        LoopingCall(expire_sessions).start(SESSION_SWEEP_INTERVAL, now=False)
+        reactor.callWhenRunning(lambda: ensureDeferred(load_leaderboard()))
+        if config.BOT_GAMES > 0:
+            reactor.callWhenRunning(lambda: ensureDeferred(start_bots()))
+        LoopingCall(reap_idle).start(config.HEARTBEAT_INTERVAL, now=False)
         reactor.run()
     except KeyboardInterrupt:
         print("KeyboardInterrupt received. Stopping the server...")
-        reactor.stop()
\ No newline at end of file
+        reactor.stop()
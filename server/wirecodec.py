@@ -0,0 +1,440 @@
+"""Compact binary encoding for protocol messages ("chesswire").
+
+A frame is ``MAGIC, VERSION, type id`` followed by the fields listed for that
+type in ``SCHEMAS``. A bitmap says which schema fields are present, and each
+present field is written in its declared kind: length-prefixed UTF-8 strings,
+zigzag varints, hex tokens as raw bytes, and UCI moves as 16-bit codes.
+Fields that are not in the schema, or whose value does not fit the declared
+kind, go into a trailing map of self-describing values. Unknown message types
+use type id 0 followed by the type name.
+
+This module is shared by the server and the client; server/wirecodec.py and
+game/wirecodec.py must stay identical.
+"""
+import struct
+
+CODEC_NAME = "chesswire/1"
+MAGIC = 0xC5
+VERSION = 1
+
+MAX_DEPTH = 16
+MAX_ITEMS = 65536
+
+# Message type ids are part of the wire format: only ever append.
+MESSAGE_TYPES = [
+    "hello",
+    "register",
+    "login",
+    "logout",
+    "find_game",
+    "move",
+    "register_success",
+    "register_failed",
+    "login_success",
+    "login_failed",
+    "game_start",
+    "update",
+    "game_end",
+    "error",
+    "opponent_disconnected",
+    "server_shutdown",
+    "watch_game",
+    "unwatch_game",
+    "game_snapshot",
+    "ping",
+    "pong",
+    "resume",
+    "resume_success",
+    "resume_failed",
+    "game_resume",
+    "game_history",
+    "history_page",
+    "export_pgn",
+    "pgn_chunk",
+    "rank",
+    "leaderboard",
+    "claim_draw",
+]
+TYPE_IDS = {name: i + 1 for i, name in enumerate(MESSAGE_TYPES)}
+
+AUTH = (("username", "str"), ("token", "hex"))
+
+SCHEMAS = {
+    "hello": (("codecs", "any"), ("codec", "str")),
+    "register": (("username", "str"), ("password", "str")),
+    "login": (("username", "str"), ("password", "str")),
+    "logout": AUTH,
+    "find_game": AUTH,
+    "move": AUTH + (("game_id", "str"), ("move", "move"), ("color", "str")),
+    "register_failed": (("reason", "str"),),
+    "login_success": (("username", "str"), ("token", "hex"), ("elo", "int")),
+    "login_failed": (("reason", "str"),),
+    "game_start": (
+        ("color", "str"), ("game_id", "str"), ("board", "str"),
+        ("white_clock", "int"), ("black_clock", "int"), ("increment", "int"),
+    ),
+    "update": (("move", "move"), ("white_clock", "int"), ("black_clock", "int")),
+    "game_end": (("winner", "str"), ("elo", "int"), ("reason", "str")),
+    "error": (("reason", "str"),),
+    "watch_game": AUTH + (("game_id", "str"),),
+    "unwatch_game": AUTH + (("game_id", "str"),),
+    "game_snapshot": (("game_id", "str"), ("board", "str"), ("white", "str"), ("black", "str"), ("moves", "any")),
+    "resume": AUTH,
+    "resume_success": (("username", "str"), ("elo", "int")),
+    "resume_failed": (("reason", "str"),),
+    "game_resume": (
+        ("color", "str"), ("game_id", "str"), ("board", "str"), ("white_clock", "int"), ("black_clock", "int"),
+    ),
+    "game_history": AUTH + (("player", "str"), ("before", "str"), ("limit", "int"), ("result", "str"), ("color", "str")),
+    "history_page": (("player", "str"), ("games", "any"), ("next", "str")),
+    "export_pgn": AUTH + (("player", "str"), ("since", "int"), ("until", "int"), ("after", "str")),
+    "pgn_chunk": (("pgn", "str"), ("next", "str")),
+    "rank": AUTH + (("player", "str"), ("rank", "int"), ("rating", "int"), ("players", "int")),
+    "leaderboard": AUTH + (("start", "int"), ("count", "int"), ("around", "str"), ("entries", "any"), ("players", "int")),
+    "claim_draw": AUTH + (("game_id", "str"), ("move", "move")),
+}
+
+T_NONE, T_FALSE, T_TRUE, T_INT, T_FLOAT, T_STR, T_BYTES, T_LIST, T_DICT = range(9)
+
+FILES = "abcdefgh"
+PROMOTIONS = "nbrqk"
+_DOUBLE = struct.Struct(">d")
+_UINT16 = struct.Struct(">H")
+
+
+class CodecError(ValueError):
+    pass
+
+
+def is_wirecodec(data):
+    return len(data) >= 3 and data[0] == MAGIC
+
+
+def _pack(from_square, to_square, promotion):
+    return from_square | to_square << 6 | promotion << 12
+
+
+def _square_name(square):
+    return FILES[square % 8] + str(square // 8 + 1)
+
+
+def _build_move_tables():
+    packed = {}
+    for from_square in range(64):
+        for to_square in range(64):
+            uci = _square_name(from_square) + _square_name(to_square)
+            packed[uci] = _pack(from_square, to_square, 0)
+            if from_square // 8 in (1, 6) and to_square // 8 in (0, 7):
+                for i, piece in enumerate(PROMOTIONS):
+                    packed[uci + piece] = _pack(from_square, to_square, i + 1)
+    return packed, {code: uci for uci, code in packed.items()}
+
+
+# Every UCI move between two squares, plus promotions from the 2nd/7th rank,
+# mapped to its 16-bit code: 6 bits from-square, 6 bits to-square, 4 bits
+# promotion piece.
+_MOVE_CODES, _MOVE_NAMES = _build_move_tables()
+
+
+def pack_move(uci):
+    return _MOVE_CODES.get(uci)
+
+
+def unpack_move(packed):
+    uci = _MOVE_NAMES.get(packed)
+    if uci is None:
+        raise CodecError("Invalid move code")
+    return uci
+
+
+# Encoding
+
+def _write_varint(out, value):
+    if value < 0x80:
+        out.append(value)
+        return
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_str(out, value):
+    data = value.encode()
+    _write_varint(out, len(data))
+    out += data
+
+
+def _write_int(out, value):
+    _write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+
+
+def _write_value(out, value, depth=0):
+    if depth > MAX_DEPTH:
+        raise CodecError("Value nested too deeply")
+    if value is None:
+        out.append(T_NONE)
+    elif value is True:
+        out.append(T_TRUE)
+    elif value is False:
+        out.append(T_FALSE)
+    elif isinstance(value, int):
+        out.append(T_INT)
+        _write_int(out, value)
+    elif isinstance(value, float):
+        out.append(T_FLOAT)
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, str):
+        out.append(T_STR)
+        _write_str(out, value)
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(T_BYTES)
+        _write_varint(out, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out.append(T_LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _write_value(out, item, depth + 1)
+    elif isinstance(value, dict):
+        out.append(T_DICT)
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            _write_str(out, str(key))
+            _write_value(out, item, depth + 1)
+    else:
+        raise CodecError(f"Cannot encode {type(value).__name__}")
+
+
+# Field writers return False when the value does not fit the declared kind;
+# the field is then carried in the extras map instead.
+
+def _put_str(out, value):
+    if value.__class__ is not str:
+        return False
+    _write_str(out, value)
+    return True
+
+
+def _put_int(out, value):
+    if value.__class__ is not int:
+        return False
+    _write_int(out, value)
+    return True
+
+
+def _put_hex(out, value):
+    if value.__class__ is not str:
+        return False
+    try:
+        raw = bytes.fromhex(value)
+    except ValueError:
+        return False
+    if len(raw) > 0x7F or raw.hex() != value:
+        return False
+    out.append(len(raw))
+    out += raw
+    return True
+
+
+def _put_move(out, value):
+    code = _MOVE_CODES.get(value) if value.__class__ is str else None
+    if code is None:
+        return False
+    out += _UINT16.pack(code)
+    return True
+
+
+def _put_any(out, value):
+    _write_value(out, value)
+    return True
+
+
+_WRITERS = {"str": _put_str, "int": _put_int, "hex": _put_hex, "move": _put_move, "any": _put_any}
+_ENCODE_PLANS = {
+    name: tuple((field, 1 << bit, _WRITERS[kind]) for bit, (field, kind) in enumerate(SCHEMAS.get(name, ())))
+    for name in MESSAGE_TYPES
+}
+
+
+def encode(message):
+    message_type = message.get("type")
+    if message_type.__class__ is not str:
+        raise CodecError("Message has no type")
+    type_id = TYPE_IDS.get(message_type, 0)
+
+    out = bytearray((MAGIC, VERSION, type_id))
+    if type_id == 0:
+        _write_str(out, message_type)
+
+    plan = _ENCODE_PLANS.get(message_type, ())
+    present = 0
+    body = bytearray()
+    for field, bit, write in plan:
+        if field in message and write(body, message[field]):
+            present |= bit
+
+    _write_varint(out, present)
+    out += body
+    # Everything except "type" and the fields written above.
+    extras = len(message) - 1 - present.bit_count()
+    _write_varint(out, extras)
+    if extras:
+        encoded = {field for field, bit, _ in plan if present & bit}
+        for key, value in message.items():
+            if key != "type" and key not in encoded:
+                _write_str(out, key)
+                _write_value(out, value)
+    return bytes(out)
+
+
+# Decoding. Readers take the buffer and a position and return (value, position).
+
+def _read_varint(data, pos):
+    try:
+        b = data[pos]
+    except IndexError:
+        raise CodecError("Truncated frame") from None
+    if b < 0x80:
+        return b, pos + 1
+    result = 0
+    shift = 0
+    while True:
+        try:
+            b = data[pos]
+        except IndexError:
+            raise CodecError("Truncated frame") from None
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise CodecError("Varint too long")
+
+
+def _take(data, pos, n):
+    end = pos + n
+    if end > len(data):
+        raise CodecError("Truncated frame")
+    return data[pos:end], end
+
+
+def _read_str(data, pos):
+    n, pos = _read_varint(data, pos)
+    raw, pos = _take(data, pos, n)
+    try:
+        return raw.decode(), pos
+    except UnicodeDecodeError as e:
+        raise CodecError("Invalid UTF-8") from e
+
+
+def _read_int(data, pos):
+    value, pos = _read_varint(data, pos)
+    return (value >> 1 if not value & 1 else -((value + 1) >> 1)), pos
+
+
+def _read_hex(data, pos):
+    n, pos = _read_varint(data, pos)
+    raw, pos = _take(data, pos, n)
+    return raw.hex(), pos
+
+
+def _read_move(data, pos):
+    raw, pos = _take(data, pos, 2)
+    return unpack_move(raw[0] << 8 | raw[1]), pos
+
+
+def _read_count(data, pos):
+    n, pos = _read_varint(data, pos)
+    if n > MAX_ITEMS:
+        raise CodecError("Too many items")
+    return n, pos
+
+
+def _read_value(data, pos, depth=0):
+    if depth > MAX_DEPTH:
+        raise CodecError("Value nested too deeply")
+    raw, pos = _take(data, pos, 1)
+    tag = raw[0]
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_INT:
+        return _read_int(data, pos)
+    if tag == T_FLOAT:
+        raw, pos = _take(data, pos, 8)
+        return _DOUBLE.unpack(raw)[0], pos
+    if tag == T_STR:
+        return _read_str(data, pos)
+    if tag == T_BYTES:
+        n, pos = _read_varint(data, pos)
+        return _take(data, pos, n)
+    if tag == T_LIST:
+        n, pos = _read_count(data, pos)
+        items = []
+        for _ in range(n):
+            item, pos = _read_value(data, pos, depth + 1)
+            items.append(item)
+        return items, pos
+    if tag == T_DICT:
+        n, pos = _read_count(data, pos)
+        items = {}
+        for _ in range(n):
+            key, pos = _read_str(data, pos)
+            items[key], pos = _read_value(data, pos, depth + 1)
+        return items, pos
+    raise CodecError(f"Unknown value tag {tag}")
+
+
+_READERS = {"str": _read_str, "int": _read_int, "hex": _read_hex, "move": _read_move, "any": _read_value}
+_DECODE_PLANS = {
+    name: tuple((field, 1 << bit, _READERS[kind]) for bit, (field, kind) in enumerate(SCHEMAS.get(name, ())))
+    for name in MESSAGE_TYPES
+}
+
+
+def peek_type(data):
+    """Return the message type of a frame without decoding its body."""
+    if not is_wirecodec(data):
+        return None
+    type_id = data[2]
+    if type_id == 0:
+        return _read_str(bytes(data), 3)[0]
+    if type_id > len(MESSAGE_TYPES):
+        return None
+    return MESSAGE_TYPES[type_id - 1]
+
+
+def decode(data):
+    data = bytes(data)
+    if len(data) < 3 or data[0] != MAGIC:
+        raise CodecError("Not a chesswire frame")
+    if data[1] != VERSION:
+        raise CodecError("Unsupported chesswire version")
+    type_id = data[2]
+    pos = 3
+    if type_id == 0:
+        message_type, pos = _read_str(data, pos)
+    elif type_id <= len(MESSAGE_TYPES):
+        message_type = MESSAGE_TYPES[type_id - 1]
+    else:
+        raise CodecError(f"Unknown message type id {type_id}")
+
+    message = {"type": message_type}
+    present, pos = _read_varint(data, pos)
+    if present:
+        for field, bit, read in _DECODE_PLANS.get(message_type, ()):
+            if present & bit:
+                message[field], pos = read(data, pos)
+
+    extras, pos = _read_count(data, pos)
+    for _ in range(extras):
+        key, pos = _read_str(data, pos)
+        message[key], pos = _read_value(data, pos)
+    if pos != len(data):
+        raise CodecError("Trailing bytes in frame")
+    return message